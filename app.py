@@ -1,12 +1,19 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
+import asyncio
 import os
-import json
 from recorder.manager import RecordingManager
 from recorder.config import Config
+from recorder import json_codec
+from recorder import danmaku_index
+from recorder import danmaku_archive
+from recorder import danmaku_heatmap
+from recorder.session_meta import session_timeline, wall_time, media_offset
+from recorder.range_response import RangeFileResponse
+from recorder.utils import get_bilibili_stream_candidates, stream_resolver
 from pydantic import BaseModel
 from typing import Optional
 
@@ -34,31 +41,51 @@ class StartRecordRequest(BaseModel):
     custom_stream_url: Optional[str] = None
     duration_seconds: Optional[int] = None
     output_dir: Optional[str] = None
+    segment_seconds: Optional[int] = None  # 分段时长（秒），不填则使用配置中的默认值
+    engine: Optional[str] = None  # 录制引擎：ffmpeg 或 native，不填则使用配置中的默认值
 
 class StopRecordRequest(BaseModel):
     task_id: str
 
+class WatchRequest(BaseModel):
+    room_id: str
+    segment_seconds: Optional[int] = None
+    engine: Optional[str] = None
+
+class ClipRequest(BaseModel):
+    session_id: str
+    start: float  # 播放位置（秒）
+    end: float
+    precise: bool = False  # True时重新编码开头不完整的GOP，起点精确
+
 @app.get("/")
 async def read_root():
     return FileResponse("web/index.html")
 
 @app.post("/api/record/start")
 async def start_record(request: StartRecordRequest):
+    if request.engine not in (None, "ffmpeg", "native"):
+        raise HTTPException(status_code=400, detail="录制引擎只能是 ffmpeg 或 native")
     try:
         # 如果没有提供自定义流地址，则获取真实的流地址
         stream_url = request.custom_stream_url
+        candidates = None
         if not stream_url:
-            from recorder.utils import get_bilibili_stream_url
-            stream_url = get_bilibili_stream_url(request.room_id)
-            if not stream_url:
+            # 所有CDN节点并发测速，从最快的开始录制，其余作为断线时的备用节点
+            candidates = await get_bilibili_stream_candidates(request.room_id)
+            if not candidates:
                 raise HTTPException(status_code=400, detail="无法获取直播间流地址")
+            stream_url = candidates[0]
         
         # 启动录制任务
         task = await recording_manager.start_task(
             room_id=request.room_id,
             stream_url=stream_url,
             duration_seconds=request.duration_seconds,
-            output_dir=request.output_dir
+            output_dir=request.output_dir,
+            segment_seconds=request.segment_seconds,
+            stream_candidates=candidates,
+            engine=request.engine
         )
         
         return {
@@ -85,156 +112,211 @@ async def stop_record(request: StopRecordRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/record/status")
-async def get_record_status():
-    tasks = recording_manager.get_all_tasks()
-    task_list = []
-    
-    for task in tasks:
-        task_info = {
-            "task_id": task.task_id,
-            "room_id": task.room_id,
-            "stream_url": task.stream_url,
-            "start_time": task.start_time.isoformat() if task.start_time else None,
-            "duration_seconds": task.duration_seconds,
-            "video_file": task.video_file,
-            "danmaku_file": task.danmaku_file,
-            "status": task.status,
-            "record_progress": task.record_progress,
-            "convert_progress": task.convert_progress,
-            "elapsed_time": task.elapsed_time
-        }
-        task_list.append(task_info)
-        
+async def get_record_status(response: Response, limit: int = Config.TASK_HISTORY_PAGE_SIZE, offset: int = 0):
+    """
+    录制中和转换中的任务全部返回；已结束的任务保存在任务库中，按开始时间倒序分页，
+    总数在X-Total-Count响应头中
+    """
+    if limit <= 0 or offset < 0:
+        raise HTTPException(status_code=400, detail="分页参数无效")
+    task_list, total = _status_snapshot(limit, offset)
+    response.headers["X-Total-Count"] = str(total)
     return task_list
 
+def _status_snapshot(limit=Config.TASK_HISTORY_PAGE_SIZE, offset=0):
+    """未结束的任务全部返回，已结束的任务从任务库分页取，返回 (任务列表, 已结束任务总数)"""
+    task_list = [task.to_status() for task in recording_manager.get_all_tasks() if task.status != "stopped"]
+    history, total = recording_manager.list_history(min(limit, 500), offset)
+    task_list.extend(history)
+    return task_list, total
+
+@app.get("/api/record/events")
+async def record_events(request: Request):
+    """
+    任务状态推送（Server-Sent Events）
+    连接后先发送一次全量快照（snapshot），之后只在任务有变化时发送变化的字段（task）；
+    连接消费太慢、积压的事件被丢弃时重新发送快照
+    """
+    queue = recording_manager.events.subscribe()
+
+    def snapshot_event():
+        task_list, total = _status_snapshot()
+        return b"event: snapshot\ndata: " + json_codec.dumps_bytes({"tasks": task_list, "total": total}) + b"\n\n"
+
+    async def event_stream():
+        try:
+            yield snapshot_event()
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=Config.STATUS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if event["type"] == "resync":
+                    yield snapshot_event()
+                else:
+                    yield b"event: task\ndata: " + json_codec.dumps_bytes(event) + b"\n\n"
+        finally:
+            recording_manager.events.unsubscribe(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.get("/api/watch")
+async def get_watchlist():
+    """关注的直播间：直播状态、弹幕连接是否正常、自动开始的录制任务"""
+    return {"rooms": recording_manager.watchlist.list(), "hub": recording_manager.danmu_hub.get_stats()}
+
+@app.post("/api/watch")
+async def add_watch(request: WatchRequest):
+    """关注直播间，开播时自动开始录制，下播时停止并转换；已关注时更新录制参数"""
+    if request.engine not in (None, "ffmpeg", "native"):
+        raise HTTPException(status_code=400, detail="录制引擎只能是 ffmpeg 或 native")
+    try:
+        return await recording_manager.watchlist.add(request.room_id, request.segment_seconds, request.engine)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"关注直播间失败: {str(e)}")
+
+@app.delete("/api/watch/{room_id}")
+async def remove_watch(room_id: str):
+    """取消关注，正在进行的录制不受影响"""
+    if not await recording_manager.watchlist.remove(room_id):
+        raise HTTPException(status_code=404, detail="没有关注该直播间")
+    return {"message": "已取消关注", "room_id": room_id}
+
+@app.get("/api/stream/stats")
+async def get_stream_stats():
+    """流地址解析的缓存统计和各CDN节点的测速结果"""
+    return stream_resolver.get_stats()
+
 @app.get("/api/recordings")
 async def get_recordings():
-    recordings = []
-    # 使用字典来避免重复的session_id
-    session_map = {}
-    
-    # 遍历输出目录，查找所有录制会话
-    if os.path.exists(Config.OUTPUT_DIR):
-        for room_id in os.listdir(Config.OUTPUT_DIR):
-            room_path = os.path.join(Config.OUTPUT_DIR, room_id)
-            if os.path.isdir(room_path):
-                # 查找该房间下的所有视频文件
-                for file in os.listdir(room_path):
-                    if file.endswith((".flv", ".mp4")):
-                        # 从视频文件名中提取时间戳
-                        if file.endswith(".flv"):
-                            base_name = file[:-4]  # 去掉.flv后缀
-                        else:  # .mp4
-                            base_name = file[:-4]  # 去掉.mp4后缀
-                        
-                        video_file = os.path.join(room_path, file)
-                        
-                        # 查找对应的弹幕文件
-                        danmaku_file = None
-                        danmaku_filename = f"{base_name}_danmaku.jsonl"
-                        danmaku_path = os.path.join(room_path, danmaku_filename)
-                        if os.path.exists(danmaku_path):
-                            danmaku_file = danmaku_path
-                        
-                        # 从文件名中提取时间戳
-                        start_time_str = base_name
-                        if "_" in base_name:
-                            parts = base_name.split("_")
-                            if len(parts) >= 3:
-                                start_time_str = f"{parts[-2]}_{parts[-1]}"
-                        
-                        # 优先选择MP4格式，如果同时存在FLV和MP4
-                        session_id = base_name
-                        if session_id not in session_map:
-                            # 如果session_id不存在，直接添加
-                            session_map[session_id] = {
-                                "session_id": session_id,
-                                "room_id": room_id,
-                                "start_time": start_time_str,
-                                "video_file": video_file,
-                                "danmaku_file": danmaku_file,
-                                "is_limited": False  # 简化处理，实际应该从任务信息中获取
-                            }
-                        else:
-                            # 如果session_id已存在，优先选择MP4格式
-                            existing_file = session_map[session_id]["video_file"]
-                            if file.endswith(".mp4") and existing_file.endswith(".flv"):
-                                # 如果当前文件是MP4而现有文件是FLV，替换为MP4
-                                session_map[session_id]["video_file"] = video_file
-                                if danmaku_file:  # 如果有弹幕文件也更新
-                                    session_map[session_id]["danmaku_file"] = danmaku_file
+    # 从录制索引读取，只有房间目录发生变化时才重新扫描
+    grouped_recordings, recordings = recording_manager.catalog.list_sessions()
+    return {"grouped": grouped_recordings, "flat": recordings}
+
+@app.get("/api/recordings/{session_id}")
+async def get_recording_detail(session_id: str):
+    # 按session_id直接查索引，不再遍历所有房间目录
+    recording = recording_manager.catalog.get(session_id)
+    if recording is None:
+        raise HTTPException(status_code=404, detail="录制会话不存在")
+    return recording
+
+@app.get("/api/recordings/{session_id}/danmaku")
+async def get_danmaku_window(session_id: str, t: float = 0, before: float = 2, after: float = 30):
+    """
+    返回播放位置t（秒，相对于录制开始）附近 [t-before, t+after] 的弹幕，用于与视频同步显示
+    通过弹幕索引定位，只读取窗口内的数据；每条弹幕附带offset（相对t0的秒数）
+    """
+    recording = recording_manager.catalog.get(session_id)
+    danmaku_file = danmaku_archive.locate(recording["danmaku_file"]) if recording and recording["danmaku_file"] else None
+    if danmaku_file is None or not os.path.exists(danmaku_file):
+        raise HTTPException(status_code=404, detail="弹幕文件不存在")
     
-    # 将字典的值转换为列表
-    recordings = list(session_map.values())
+    base_name = os.path.join(os.path.dirname(danmaku_file), session_id)
+    timeline = session_timeline(base_name)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail="无法确定录制开始时间")
+    t0 = timeline["t0"]
     
-    # 按房间号分组并按时间排序
-    grouped_recordings = {}
-    for recording in recordings:
-        room_id = recording["room_id"]
-        if room_id not in grouped_recordings:
-            grouped_recordings[room_id] = []
-        grouped_recordings[room_id].append(recording)
+    # 播放位置先换算成实际时间（断线重连造成的空档不在视频中）
+    window_from = max(0.0, t - max(0.0, before))
+    window_to = t + min(max(0.0, after), Config.DANMU_WINDOW_MAX_SECONDS)
+    try:
+        result = await asyncio.to_thread(danmaku_index.page, danmaku_file, limit=Config.DANMU_PAGE_MAX,
+                                         from_ts=wall_time(timeline, window_from), to_ts=wall_time(timeline, window_to))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"读取弹幕文件出错: {str(e)}")
     
-    # 对每个房间的录制内容按时间排序（降序）
-    for room_id in grouped_recordings:
-        grouped_recordings[room_id].sort(key=lambda x: x["start_time"], reverse=True)
+    items = result["items"]
+    for item in items:
+        item["offset"] = round(media_offset(timeline, item.get("timestamp") or t0), 3)
+    return Response(content=json_codec.dumps_bytes({
+        "t0": t0,
+        "from": window_from,
+        "to": window_to,
+        "items": items,
+        # 窗口内弹幕超过单页上限时为True，客户端从最后一条的offset继续请求
+        "truncated": result["next_cursor"] is not None
+    }), media_type="application/json")
+
+@app.get("/api/recordings/{session_id}/heatmap")
+async def get_danmaku_heatmap(session_id: str):
+    """
+    会话的弹幕热度：每秒的弹幕数、礼物数、SC数和金额（按播放位置，不含断线空档），
+    以及自动找出的高能片段（highlights，可作为剪辑候选）；录制中的会话增量统计
+    """
+    recording = recording_manager.catalog.get(session_id)
+    danmaku_file = danmaku_archive.locate(recording["danmaku_file"]) if recording and recording["danmaku_file"] else None
+    if danmaku_file is None or not os.path.exists(danmaku_file):
+        raise HTTPException(status_code=404, detail="弹幕文件不存在")
     
-    return {"grouped": grouped_recordings, "flat": recordings}
+    base_name = os.path.join(os.path.dirname(danmaku_file), session_id)
+    live = recording_manager.is_recording(base_name)
+    try:
+        result = await asyncio.to_thread(danmaku_heatmap.load, base_name, danmaku_file, live)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"统计弹幕热度出错: {str(e)}")
+    if result is None:
+        raise HTTPException(status_code=404, detail="无法确定录制开始时间")
+    return Response(content=json_codec.dumps_bytes(result), media_type="application/json")
 
-@app.get("/api/recordings/{session_id}")
-async def get_recording_detail(session_id: str):
-    # 查找指定会话的详细信息
-    if os.path.exists(Config.OUTPUT_DIR):
-        for room_id in os.listdir(Config.OUTPUT_DIR):
-            room_path = os.path.join(Config.OUTPUT_DIR, room_id)
-            if os.path.isdir(room_path):
-                # 直接在房间目录下查找文件
-                video_file = None
-                danmaku_file = None
-                
-                # 优先查找MP4文件，如果没有再查找FLV文件
-                mp4_file = None
-                flv_file = None
-                
-                for file in os.listdir(room_path):
-                    if file.startswith(session_id):
-                        if file.endswith(".mp4"):
-                            mp4_file = os.path.join(room_path, file)
-                        elif file.endswith(".flv"):
-                            flv_file = os.path.join(room_path, file)
-                
-                # 优先使用MP4文件
-                if mp4_file:
-                    video_file = mp4_file
-                elif flv_file:
-                    video_file = flv_file
-                
-                # 查找对应的弹幕文件
-                if video_file:
-                    danmaku_filename = f"{session_id}_danmaku.jsonl"
-                    danmaku_path = os.path.join(room_path, danmaku_filename)
-                    if os.path.exists(danmaku_path):
-                        danmaku_file = danmaku_path
-                    
-                    return {
-                        "session_id": session_id,
-                        "room_id": room_id,
-                        "video_file": video_file,
-                        "danmaku_file": danmaku_file,
-                        "start_time": session_id.split("_")[-2] + "_" + session_id.split("_")[-1] if "_" in session_id else session_id
-                    }
-
-    raise HTTPException(status_code=404, detail="录制会话不存在")
+@app.post("/api/clips")
+async def create_clip(request: ClipRequest):
+    """
+    导出会话 [start, end]（秒，播放位置）的剪辑和对应的弹幕
+    默认从start之前的关键帧开始直接复制，precise为True时只重新编码开头不完整的GOP；
+    相同的请求直接返回已导出的结果
+    """
+    if request.start < 0 or request.end <= request.start:
+        raise HTTPException(status_code=400, detail="剪辑时间段无效")
+    if request.end - request.start > Config.CLIP_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"剪辑时长不能超过 {Config.CLIP_MAX_SECONDS} 秒")
+    recording = recording_manager.catalog.get(request.session_id)
+    if recording is None:
+        raise HTTPException(status_code=404, detail="录制会话不存在")
+    if recording["video_file"] and recording_manager.is_recording(
+            os.path.join(os.path.dirname(recording["video_file"]), request.session_id)):
+        raise HTTPException(status_code=409, detail="会话正在录制，结束后才能剪辑")
+    try:
+        return recording_manager.clips.submit(recording, request.start, request.end, request.precise)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/api/clips/{clip_id}")
+async def get_clip(clip_id: str):
+    """剪辑的导出状态，完成后包含视频和弹幕的下载地址"""
+    clip = recording_manager.clips.get(clip_id)
+    if clip is None:
+        raise HTTPException(status_code=404, detail="剪辑不存在")
+    return clip
+
+@app.api_route("/clips/{filename}", methods=["GET", "HEAD"])
+async def get_clip_file(filename: str, request: Request):
+    """下载导出的剪辑视频（支持Range）或弹幕"""
+    file_path = os.path.join(Config.CLIP_DIR, filename)
+    if filename != os.path.basename(filename) or not filename.endswith(('.mp4', '_danmaku.jsonl')) or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="剪辑文件不存在")
+    if filename.endswith('.mp4'):
+        return RangeFileResponse(file_path, request, 'video/mp4')
+    return FileResponse(file_path, media_type='application/x-ndjson')
 
 @app.get("/danmaku/{room_id}/{filename}")
 async def get_danmaku_file(room_id: str, filename: str):
-    """获取弹幕文件内容"""
-    file_path = os.path.join(Config.OUTPUT_DIR, room_id, filename)
+    """获取弹幕文件内容（已归档的弹幕还原为逐行JSON）"""
+    file_path = danmaku_archive.locate(os.path.join(Config.OUTPUT_DIR, room_id, filename))
     
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="弹幕文件不存在")
     
     def iterfile():
+        if danmaku_archive.is_archive(file_path):
+            for record in danmaku_archive.get_archive(file_path).iter_records():
+                yield json_codec.dumps(record) + "\n"
+            return
         with open(file_path, encoding="utf-8") as f:
             yield from f
     
@@ -243,36 +325,122 @@ async def get_danmaku_file(room_id: str, filename: str):
 @app.get("/api/danmaku/{room_id}/{filename}")
 async def get_danmaku_data(room_id: str, filename: str, limit: int = 100):
     """获取弹幕数据（JSON格式）"""
-    file_path = os.path.join(Config.OUTPUT_DIR, room_id, filename)
+    file_path = danmaku_archive.locate(os.path.join(Config.OUTPUT_DIR, room_id, filename))
     
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="弹幕文件不存在")
     
-    danmaku_list = []
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            # 读取最后limit行
-            for line in lines[-limit:]:
-                try:
-                    danmaku_list.append(json.loads(line.strip()))
-                except json.JSONDecodeError:
-                    continue
+        # 从文件末尾倒着读取最后limit行，不读取整个文件
+        danmaku_list = await asyncio.to_thread(danmaku_index.tail, file_path, min(limit, Config.DANMU_PAGE_MAX))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"读取弹幕文件出错: {str(e)}")
     
-    return danmaku_list
+    # 直接用快速JSON后端编码，跳过FastAPI默认的逐字段序列化
+    return Response(content=json_codec.dumps_bytes(danmaku_list), media_type="application/json")
 
-@app.get("/video/{path:path}")
-async def get_video_file(path: str, request: Request):
-    """获取视频文件，支持Range请求用于流式播放"""
-    file_path = os.path.join(Config.OUTPUT_DIR, path)
+@app.get("/api/danmaku/{room_id}/{filename}/page")
+async def get_danmaku_page(room_id: str, filename: str, cursor: Optional[str] = None, offset: Optional[int] = None,
+                           limit: int = 100, from_ts: Optional[float] = None, to_ts: Optional[float] = None):
+    """
+    分页读取弹幕，通过弹幕索引直接定位，不需要从头读取
+    cursor为上一页返回的next_cursor，offset为起始行号；from_ts/to_ts为时间范围（Unix时间戳）
+    游标和弹幕文件对不上（例如翻页途中弹幕文件被归档）时返回400，需要从头重新读取
+    """
+    file_path = danmaku_archive.locate(os.path.join(Config.OUTPUT_DIR, room_id, filename))
     
     if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="视频文件不存在")
+        raise HTTPException(status_code=404, detail="弹幕文件不存在")
+    if limit <= 0 or (offset is not None and offset < 0):
+        raise HTTPException(status_code=400, detail="分页参数无效")
     
-    # 获取文件大小
-    file_size = os.path.getsize(file_path)
+    try:
+        result = await asyncio.to_thread(danmaku_index.page, file_path, cursor, offset,
+                                         min(limit, Config.DANMU_PAGE_MAX), from_ts, to_ts)
+    except danmaku_index.CursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"读取弹幕文件出错: {str(e)}")
+    
+    return Response(content=json_codec.dumps_bytes(result), media_type="application/json")
+
+@app.get("/api/analytics/superchats")
+async def get_super_chats(min_price: float = 0, room_id: Optional[str] = None,
+                          from_ts: Optional[float] = None, to_ts: Optional[float] = None):
+    """
+    查询所有录制会话中的醒目留言（SC），按时间排序
+    已归档的会话只读取需要的几列，并按文件头中的最高价格和时间范围直接跳过；还没有归档的会话逐行扫描
+    """
+    # 录制索引只在事件循环中访问（刷新时会修改索引和写数据库），线程中只使用这里取出的快照
+    _, sessions = recording_manager.catalog.list_sessions()
+    sessions = [
+        (info["session_id"], info["danmaku_file"]) for info in sessions
+        if info["danmaku_file"] and (not room_id or info["room_id"] == room_id)
+    ]
+
+    def scan():
+        items = []
+        archived = scanned = 0
+        for session_id, danmaku_file in sessions:
+            danmaku_file = danmaku_archive.locate(danmaku_file)
+            if not os.path.exists(danmaku_file):
+                continue
+            scanned += 1
+            if danmaku_archive.is_archive(danmaku_file):
+                archived += 1
+                found = danmaku_archive.get_archive(danmaku_file).super_chats(min_price, from_ts, to_ts)
+            else:
+                found = danmaku_archive.super_chats_jsonl(danmaku_file, min_price, from_ts, to_ts)
+            for item in found:
+                item["session_id"] = session_id
+            items.extend(found)
+        items.sort(key=lambda item: item["timestamp"] or 0)
+        return {
+            "count": len(items),
+            "total_price": sum(item["price"] for item in items),
+            "items": items[:Config.SC_QUERY_MAX],
+            "truncated": len(items) > Config.SC_QUERY_MAX,
+            "sessions_scanned": scanned,
+            "sessions_archived": archived
+        }
+    
+    try:
+        # 扫描在线程中进行，不阻塞事件循环
+        result = await asyncio.to_thread(scan)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"查询SC出错: {str(e)}")
+    return Response(content=json_codec.dumps_bytes(result), media_type="application/json")
+
+@app.get("/api/search")
+async def search_danmaku(q: str, room_id: Optional[str] = None, session_id: Optional[str] = None, cmd: Optional[str] = None,
+                         from_ts: Optional[float] = None, to_ts: Optional[float] = None, limit: int = 50, offset: int = 0):
+    """
+    在所有录制会话的弹幕和SC内容中搜索，按时间倒序分页
+    每条结果带有room_id、session_id和offset（录像中的秒数），播放器可以直接跳转
+    """
+    if not recording_manager.search:
+        raise HTTPException(status_code=404, detail="没有启用弹幕搜索")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="搜索内容不能为空")
+    try:
+        result = await asyncio.to_thread(
+            recording_manager.search.search, q, room_id, session_id, cmd, from_ts, to_ts,
+            max(1, min(limit, Config.SEARCH_PAGE_MAX)), max(0, offset)
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"搜索出错: {str(e)}")
+    result["index"] = recording_manager.search.get_stats()
+    return Response(content=json_codec.dumps_bytes(result), media_type="application/json")
+
+@app.api_route("/video/{path:path}", methods=["GET", "HEAD"])
+async def get_video_file(path: str, request: Request):
+    """获取视频文件，支持Range（含多区间）、ETag和条件请求，用于流式播放和拖动"""
+    output_dir = os.path.realpath(Config.OUTPUT_DIR)
+    file_path = os.path.realpath(os.path.join(output_dir, path))
+    
+    # 只允许访问输出目录下的文件
+    if os.path.commonpath([output_dir, file_path]) != output_dir or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="视频文件不存在")
     
     # 根据文件扩展名确定媒体类型
     if file_path.endswith('.mp4'):
@@ -282,88 +450,57 @@ async def get_video_file(path: str, request: Request):
     else:
         media_type = 'video/mp4'  # 默认
     
-    # 获取Range请求头
-    range_header = request.headers.get('range')
+    return RangeFileResponse(file_path, request, media_type)
+
+@app.get("/live/{task_id}/{filename}")
+async def get_live_file(task_id: str, filename: str):
+    """实时预览：返回录制中任务的HLS播放列表和切片"""
+    task = recording_manager.get_task(task_id)
+    if not task or not task.live_dir or filename != os.path.basename(filename):
+        raise HTTPException(status_code=404, detail="预览不存在")
+    file_path = os.path.join(task.live_dir, filename)
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="预览不存在")
     
-    if range_header:
-        # 解析Range请求
-        bytes_start, bytes_end = range_header.replace('bytes=', '').split('-')
-        start = int(bytes_start) if bytes_start else 0
-        end = int(bytes_end) if bytes_end else file_size - 1
-        
-        # 确保end不超过文件大小
-        if end >= file_size:
-            end = file_size - 1
-            
-        # 计算chunk大小
-        chunk_size = end - start + 1
-        
-        def iterfile():
-            with open(file_path, 'rb') as f:
-                f.seek(start)
-                remaining = chunk_size
-                while remaining > 0:
-                    chunk = f.read(min(8192, remaining))
-                    if not chunk:
-                        break
-                    remaining -= len(chunk)
-                    yield chunk
-        
-        return StreamingResponse(
-            iterfile(),
-            status_code=206,
-            media_type=media_type,
-            headers={
-                'Content-Range': f'bytes {start}-{end}/{file_size}',
-                'Accept-Ranges': 'bytes',
-                'Content-Length': str(chunk_size)
-            }
-        )
-    else:
-        # 非Range请求，返回整个文件
-        def iterfile():
-            with open(file_path, 'rb') as f:
-                yield from f
-        
-        return StreamingResponse(
-            iterfile(),
-            media_type=media_type,
-            headers={
-                'Content-Length': str(file_size),
-                'Accept-Ranges': 'bytes'
-            }
-        )
+    if filename.endswith('.m3u8'):
+        # 播放列表一直在被ffmpeg替换，整体读入后返回，并且不能缓存
+        with open(file_path, 'rb') as f:
+            playlist = f.read()
+        return Response(content=playlist, media_type='application/vnd.apple.mpegurl', headers={'Cache-Control': 'no-cache'})
+    media_type = 'video/mp2t' if filename.endswith('.ts') else 'video/mp4'
+    return FileResponse(file_path, media_type=media_type)
 
 @app.delete("/api/recordings/{session_id}")
 async def delete_recording(session_id: str):
     """删除指定的录制文件"""
     try:
-        # 遍历输出目录，查找匹配的会话
-        if os.path.exists(Config.OUTPUT_DIR):
-            for room_id in os.listdir(Config.OUTPUT_DIR):
-                room_path = os.path.join(Config.OUTPUT_DIR, room_id)
-                if os.path.isdir(room_path):
-                    # 查找匹配session_id的文件
-                    for file in os.listdir(room_path):
-                        if file.startswith(session_id):
-                            file_path = os.path.join(room_path, file)
-                            if os.path.isfile(file_path):
-                                os.remove(file_path)
-                                print(f"已删除文件: {file_path}")
-                    
-                    # 检查房间目录是否为空，如果是则删除目录
-                    if os.path.isdir(room_path) and not os.listdir(room_path):
-                        os.rmdir(room_path)
-                        print(f"已删除空房间目录: {room_path}")
-        
+        # 通过索引找到会话所在的房间目录，只在该目录下删除
+        recording_manager.catalog.delete(session_id)
+        if recording_manager.search:
+            recording_manager.search.remove(session_id)
         return {"message": "删除成功", "session_id": session_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除失败: {str(e)}")
 
 @app.on_event('startup')
-def startup_event():
+async def startup_event():
     # 确保输出目录存在
     os.makedirs(Config.OUTPUT_DIR, exist_ok=True)
+    # 按目录mtime增量重建录制索引
+    recording_manager.catalog.refresh(force=True)
+    # 在后台恢复上次没有结束的录制和转换，不阻塞启动
+    asyncio.create_task(recording_manager.recover())
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    # 保存所有未结束任务的最新进度，下次启动时从这里继续
+    for task in recording_manager.get_all_tasks():
+        recording_manager.persist_task(task)
+    # 关闭流地址解析器的连接池
+    await stream_resolver.aclose()
+    # 写入搜索索引队列中剩余的弹幕
+    if recording_manager.search:
+        await asyncio.to_thread(recording_manager.search.shutdown)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""
+弹幕连接的线程数和内存占用：DanmuHub共享事件循环 和 原来每个房间一个线程+事件循环
+本地起一个模拟B站弹幕服务器的WebSocket服务（单独的进程），每个连接定时推送zlib压缩的弹幕帧并回复心跳，
+N个房间全部连上后运行一段时间，统计线程数、RSS增量和CPU时间。只支持Linux（读取/proc）。
+
+    python -m bench.bench_danmu_hub --rooms 10 50 100 --seconds 10
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+import websockets
+from recorder import danmu_client
+from recorder.danmu_client import DanmuClient
+from recorder.danmu_hub import DanmuHub
+from bench.common import packet, proc_stat, sample_message, thread_count
+
+def serve(port, ready, messages_per_second):
+    """模拟弹幕服务器：认证后每0.5秒推送一帧，收到心跳回复人气值"""
+    inner = b''.join(packet(json.dumps(sample_message(i), ensure_ascii=False).encode(), 0)
+                     for i in range(max(1, messages_per_second // 2)))
+    frame = packet(zlib.compress(inner), 2)
+    heartbeat_reply = packet(struct.pack('>I', 1), 1, 3)
+
+    async def handle(websocket, path=None):
+        await websocket.recv()
+        await websocket.send(packet(b'{"code":0}', 1, 8))
+
+        async def push():
+            while True:
+                await websocket.send(frame)
+                await asyncio.sleep(0.5)
+
+        pusher = asyncio.create_task(push())
+        try:
+            async for message in websocket:
+                if struct.unpack_from('>I', message, 8)[0] == 2:
+                    await websocket.send(heartbeat_reply)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            pusher.cancel()
+
+    async def main():
+        async with websockets.serve(handle, '127.0.0.1', 0, max_queue=None) as server:
+            port.value = server.sockets[0].getsockname()[1]
+            ready.set()
+            await asyncio.Future()
+
+    asyncio.run(main())
+
+def redirect_to(url):
+    """让DanmuClient连接本地的模拟服务器（弹幕服务器地址写死在_connect中）"""
+    connect = websockets.connect
+
+    def local_connect(uri, **kwargs):
+        return connect(url, **kwargs)
+
+    danmu_client.websockets.connect = local_connect
+
+async def run_hub(clients, seconds, loops):
+    hub = DanmuHub(loops)
+    for client in clients:
+        hub.register(client)
+    await asyncio.sleep(seconds)
+    sample = thread_count(), proc_stat(os.getpid())
+    for client in clients:
+        await hub.unregister(client)
+    return sample
+
+def run_loop(loop):
+    loop.run_forever()
+    # 关闭线程池，避免残留的线程计入下一轮的统计
+    loop.run_until_complete(loop.shutdown_default_executor())
+    loop.close()
+
+async def run_threads(clients, seconds):
+    """原来的方式：每个房间一个线程，线程中运行单独的事件循环"""
+    threads = []
+    for client in clients:
+        loop = asyncio.new_event_loop()
+        client.loop = loop
+        client.running = True
+        thread = threading.Thread(target=run_loop, args=(loop,), daemon=True)
+        thread.start()
+        threads.append((thread, loop, asyncio.run_coroutine_threadsafe(client.run(), loop)))
+    await asyncio.sleep(seconds)
+    sample = thread_count(), proc_stat(os.getpid())
+    for client in clients:
+        await client.stop()
+    for thread, loop, future in threads:
+        await asyncio.wrap_future(future)
+        loop.call_soon_threadsafe(loop.stop)
+        await asyncio.to_thread(thread.join)
+    return sample
+
+def measure(mode, rooms, seconds, loops, work_dir):
+    clients = [DanmuClient(str(1000 + i), os.path.join(work_dir, f'{mode}_{rooms}_{i}_danmaku.jsonl'))
+               for i in range(rooms)]
+    base_threads = thread_count()
+    base_cpu, base_rss = proc_stat(os.getpid())
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == 'hub':
+            coro = run_hub(clients, seconds, loops)
+        else:
+            coro = run_threads(clients, seconds)
+        threads, (cpu, rss) = asyncio.run(coro)
+    records = 0
+    for client in clients:
+        if os.path.exists(client.output_file):
+            with open(client.output_file, 'rb') as f:
+                records += sum(1 for _ in f)
+    return threads - base_threads, rss - base_rss, cpu - base_cpu, records
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--seconds', type=float, default=10, help="所有房间连上后运行的时长")
+    parser.add_argument('--loops', type=int, default=1, help="DanmuHub的事件循环数")
+    parser.add_argument('--rate', type=int, default=20, help="每个房间每秒的弹幕数")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    port = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(target=serve, args=(port, ready, args.rate), daemon=True)
+    server.start()
+    if not ready.wait(10):
+        sys.exit("模拟弹幕服务器启动失败")
+    redirect_to(f'ws://127.0.0.1:{port.value}/sub')
+    work_dir = tempfile.mkdtemp(prefix='bench_hub_')
+    print(f"每个房间 {args.rate} 条/秒，运行 {args.seconds} 秒，DanmuHub事件循环数 {args.loops}")
+    print(f"{'方式':<10}{'房间':>6}{'新增线程':>10}{'RSS增量MB':>12}{'CPU秒':>8}{'写入弹幕':>10}")
+    try:
+        for rooms in args.rooms:
+            for mode in ('thread', 'hub'):
+                threads, rss, cpu, records = measure(mode, rooms, args.seconds, args.loops, work_dir)
+                print(f"{mode:<10}{rooms:>6}{threads:>10}{rss / 1e6:>12.1f}{cpu:>8.2f}{records:>10}")
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+原生FLV录制（FlvRecorder）和ffmpeg录制（VideoRecorder）的资源占用对比
+本地起一个模拟CDN的HTTP-FLV服务（单独的进程），按实际码率推送同一个样本文件，
+同时录制N个房间，统计每个房间的CPU时间和内存占用。只支持Linux（读取/proc）。
+
+    python -m bench.bench_flv_capture --rooms 1 4 8 --ffmpeg /usr/bin/ffmpeg
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from recorder.flv_capture import FlvRecorder
+from recorder.video_recorder import VideoRecorder
+from bench.common import proc_stat
+
+CHUNK_SIZE = 64 * 1024
+
+def make_sample(ffmpeg, path, seconds, bitrate):
+    """用ffmpeg生成H.264+AAC的FLV样本"""
+    subprocess.run([
+        ffmpeg, "-v", "error", "-y",
+        "-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30",
+        "-f", "lavfi", "-i", "sine=frequency=440",
+        "-t", str(seconds),
+        "-c:v", "libx264", "-preset", "ultrafast", "-b:v", bitrate, "-g", "60",
+        "-c:a", "aac", "-f", "flv", path
+    ], check=True)
+
+def serve(sample, seconds, port, ready):
+    """模拟CDN：每个请求按实际码率发送整个样本，发完后关闭连接"""
+    with open(sample, 'rb') as f:
+        data = f.read()
+    interval = seconds * CHUNK_SIZE / len(data)
+
+    async def handle(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: video/x-flv\r\nConnection: close\r\n\r\n")
+        start = time.monotonic()
+        try:
+            for i, offset in enumerate(range(0, len(data), CHUNK_SIZE)):
+                writer.write(data[offset:offset + CHUNK_SIZE])
+                await writer.drain()
+                await asyncio.sleep(max(0, start + (i + 1) * interval - time.monotonic()))
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port.value = server.sockets[0].getsockname()[1]
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+async def record(engine, rooms, url, out_dir, ffmpeg):
+    if engine == 'native':
+        recorders = [FlvRecorder(url, os.path.join(out_dir, f'{i}.flv')) for i in range(rooms)]
+    else:
+        recorders = [VideoRecorder(url, os.path.join(out_dir, f'{i}.flv'), ffmpeg) for i in range(rooms)]
+    base_cpu, base_rss = proc_stat(os.getpid())
+    start = time.monotonic()
+    # 只看录制本身：屏蔽录制器的日志输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        for recorder in recorders:
+            await recorder.start()
+        peak_rss = 0
+        child_stats = {}
+        while any(recorder.is_running for recorder in recorders):
+            await asyncio.sleep(0.2)
+            rss = proc_stat(os.getpid())[1] - base_rss
+            if engine == 'ffmpeg':
+                for recorder in recorders:
+                    if recorder.is_running:
+                        with contextlib.suppress(OSError):
+                            child_stats[recorder.process.pid] = proc_stat(recorder.process.pid)
+                rss += sum(r for _, r in child_stats.values())
+            peak_rss = max(peak_rss, rss)
+        for recorder in recorders:
+            await recorder.stop()
+    wall = time.monotonic() - start
+    cpu = proc_stat(os.getpid())[0] - base_cpu + sum(c for c, _ in child_stats.values())
+    sizes = [os.path.getsize(os.path.join(out_dir, f'{i}.flv')) for i in range(rooms)]
+    return {"wall": wall, "cpu": cpu, "rss": peak_rss, "min_size": min(sizes)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--seconds', type=int, default=20, help="样本时长，也就是每轮录制的时长")
+    parser.add_argument('--bitrate', default='3M')
+    parser.add_argument('--ffmpeg', default=shutil.which('ffmpeg') or 'ffmpeg')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_flv_')
+    sample = os.path.join(work_dir, 'sample.flv')
+    make_sample(args.ffmpeg, sample, args.seconds, args.bitrate)
+    ready = multiprocessing.Event()
+    port = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(target=serve, args=(sample, args.seconds, port, ready), daemon=True)
+    server.start()
+    if not ready.wait(10):
+        sys.exit("模拟CDN启动失败")
+    url = f'http://127.0.0.1:{port.value}/live/sample.flv'
+    print(f"样本: {os.path.getsize(sample) / 1e6:.1f} MB, {args.seconds} 秒")
+    print(f"{'引擎':<8}{'房间':>6}{'CPU秒/房间':>14}{'CPU%/房间':>12}{'内存MB/房间':>14}")
+    try:
+        for rooms in args.rooms:
+            for engine in ('ffmpeg', 'native'):
+                out_dir = os.path.join(work_dir, f'{engine}_{rooms}')
+                os.makedirs(out_dir)
+                result = asyncio.run(record(engine, rooms, url, out_dir, args.ffmpeg))
+                if result["min_size"] < os.path.getsize(sample) * 0.9:
+                    print(f"警告: {engine} 录制的文件不完整", file=sys.stderr)
+                print(f"{engine:<8}{rooms:>6}{result['cpu'] / rooms:>14.3f}"
+                      f"{result['cpu'] / rooms / result['wall'] * 100:>12.2f}{result['rss'] / rooms / 1e6:>14.1f}")
+                shutil.rmtree(out_dir)
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+弹幕帧解码的吞吐量对比：原来的递归解码（每个包切片复制）和 iter_notify_bodies
+用合成的帧（每帧若干条DANMU_MSG，zlib或brotli压缩）测试，分别统计只拆包和拆包+解析JSON的消息数/秒；
+两种实现都用标准库json解析，只比较拆包的差别（JSON后端的对比见bench_json_codec）
+
+    python -m bench.bench_frame_decode --messages 30 --frames 2000
+"""
+import argparse
+import json
+import struct
+import time
+import zlib
+from recorder.danmu_client import iter_notify_bodies, brotli
+from bench.common import packet, sample_message
+
+def make_frame(messages, compress, proto_ver, start):
+    inner = b''.join(packet(json.dumps(sample_message(start + i), ensure_ascii=False).encode(), 0)
+                     for i in range(messages))
+    return packet(compress(inner), proto_ver), len(inner)
+
+def old_decode(message, out):
+    """原来的实现（同步版本）：每个包切片复制，压缩包递归解析"""
+    offset = 0
+    while offset < len(message):
+        if len(message) < offset + 16:
+            break
+        header = message[offset:offset + 16]
+        packet_len, header_len, proto_ver, op_code, seq_id = struct.unpack('>IHHII', header)
+        body = message[offset + header_len:offset + packet_len]
+        if op_code == 5:
+            if proto_ver == 2:
+                old_decode(zlib.decompress(body), out)
+            elif proto_ver == 0:
+                out.append(body)
+        offset += packet_len
+
+def old_split(frames):
+    count = 0
+    for frame in frames:
+        bodies = []
+        old_decode(frame, bodies)
+        count += len(bodies)
+    return count
+
+def old_parse(frames):
+    count = 0
+    for frame in frames:
+        bodies = []
+        old_decode(frame, bodies)
+        for body in bodies:
+            json.loads(body.decode('utf-8'))
+            count += 1
+    return count
+
+def new_split(frames):
+    count = 0
+    for frame in frames:
+        for _ in iter_notify_bodies(frame):
+            count += 1
+    return count
+
+def new_parse(frames):
+    count = 0
+    for frame in frames:
+        for body in iter_notify_bodies(frame):
+            json.loads(str(body, 'utf-8'))
+            count += 1
+    return count
+
+def rate(func, frames, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func(frames)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=30, help="每帧的消息数")
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    codecs = [('zlib', zlib.compress, 2)]
+    if brotli is not None:
+        codecs.append(('brotli', brotli.compress, 3))
+    else:
+        print("没有安装brotli，只测试zlib")
+    print(f"每帧 {args.messages} 条消息")
+    print(f"{'压缩':<8}{'字节/帧':>10}{'实现':>6}{'拆包 条/秒':>14}{'拆包+JSON 条/秒':>18}")
+    for name, compress, proto_ver in codecs:
+        built = [make_frame(args.messages, compress, proto_ver, i * args.messages) for i in range(args.frames)]
+        frames = [frame for frame, _ in built]
+        size = sum(len(frame) for frame in frames) / len(frames)
+        raw = sum(inner for _, inner in built) / len(built)
+        if proto_ver == 2:
+            # 原来的实现不支持brotli
+            print(f"{name:<8}{size:>10.0f}{'old':>6}{rate(old_split, frames, args.repeat):>14.0f}"
+                  f"{rate(old_parse, frames, args.repeat):>18.0f}")
+        print(f"{name:<8}{size:>10.0f}{'new':>6}{rate(new_split, frames, args.repeat):>14.0f}"
+              f"{rate(new_parse, frames, args.repeat):>18.0f}")
+    print(f"未压缩: {raw:.0f} 字节/帧")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+弹幕JSON编解码的吞吐量：标准库json和json_codec当前的后端（orjson / msgspec）
+编码用DanmuWriter写入的记录，解码用B站下发的DANMU_MSG原始数据
+
+    python -m bench.bench_json_codec --count 20000
+"""
+import argparse
+import json
+import time
+from recorder import json_codec
+from bench.common import sample_message
+
+def make_record(i):
+    raw = sample_message(i)
+    return {
+        "timestamp": 1700000000.0 + i / 10,
+        "room_id": "21452505",
+        "cmd": raw["cmd"],
+        "raw": raw,
+        "username": raw["info"][2][1],
+        "content": raw["info"][1]
+    }
+
+def rate(func, items, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(items) / best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    records = [make_record(i) for i in range(args.count)]
+    # 解码的输入和DanmuClient一样是数据包中的memoryview
+    bodies = [memoryview(json.dumps(sample_message(i), ensure_ascii=False).encode()) for i in range(args.count)]
+    rows = [
+        ("json", lambda obj: json.dumps(obj, ensure_ascii=False).encode('utf-8'),
+         lambda body: json.loads(str(body, 'utf-8'))),
+        (json_codec.BACKEND, json_codec.dumps_bytes, json_codec.loads),
+    ]
+    print(f"{'后端':<10}{'编码 条/秒':>14}{'解码 条/秒':>14}")
+    for name, dumps, loads in rows:
+        print(f"{name:<10}{rate(dumps, records, args.repeat):>14.0f}{rate(loads, bodies, args.repeat):>14.0f}")
+    if json_codec.BACKEND == "json":
+        print("没有安装orjson或msgspec，json_codec使用标准库")
+
+if __name__ == '__main__':
+    main()
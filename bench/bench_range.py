@@ -0,0 +1,139 @@
+"""
+视频文件响应的吞吐量和服务端CPU：RangeFileResponse 和原来的 StreamingResponse 生成器
+（Range请求每次读8KB；非Range请求按行迭代整个文件）
+uvicorn在单独的进程中运行，客户端完整下载同一个文件，统计MB/秒和服务进程的CPU时间。只支持Linux（读取/proc）。
+
+    python -m bench.bench_range --size 50 --repeat 3
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from recorder.range_response import RangeFileResponse
+from bench.common import proc_stat
+
+def make_app(file_path):
+    app = FastAPI()
+
+    @app.get("/new")
+    async def new(request: Request):
+        return RangeFileResponse(file_path, request, 'video/mp4')
+
+    @app.get("/old")
+    async def old(request: Request):
+        # 原来 /video/{path} 的实现
+        file_size = os.path.getsize(file_path)
+        range_header = request.headers.get('range')
+        if range_header:
+            bytes_start, bytes_end = range_header.replace('bytes=', '').split('-')
+            start = int(bytes_start) if bytes_start else 0
+            end = int(bytes_end) if bytes_end else file_size - 1
+            if end >= file_size:
+                end = file_size - 1
+            chunk_size = end - start + 1
+
+            def iterfile():
+                with open(file_path, 'rb') as f:
+                    f.seek(start)
+                    remaining = chunk_size
+                    while remaining > 0:
+                        chunk = f.read(min(8192, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        yield chunk
+
+            return StreamingResponse(iterfile(), status_code=206, media_type='video/mp4', headers={
+                'Content-Range': f'bytes {start}-{end}/{file_size}',
+                'Accept-Ranges': 'bytes',
+                'Content-Length': str(chunk_size)
+            })
+
+        def iterfile():
+            with open(file_path, 'rb') as f:
+                yield from f
+
+        return StreamingResponse(iterfile(), media_type='video/mp4', headers={
+            'Content-Length': str(file_size),
+            'Accept-Ranges': 'bytes'
+        })
+
+    return app
+
+def serve(file_path, port):
+    uvicorn.run(make_app(file_path), host='127.0.0.1', port=port, log_level='warning')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def fetch(url, headers):
+    received = 0
+    # 每次用新连接，避免长时间的下载撞上上一个请求留下的keep-alive超时
+    with httpx.Client(timeout=None) as client, client.stream('GET', url, headers=headers) as response:
+        response.raise_for_status()
+        for chunk in response.iter_raw(1024 * 1024):
+            received += len(chunk)
+    return received
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=50, help="测试文件大小（MB）")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_range_')
+    file_path = os.path.join(work_dir, 'video.mp4')
+    # 随机内容，逐行迭代时的行长度接近真实的视频文件
+    with open(file_path, 'wb') as f:
+        for _ in range(args.size):
+            f.write(os.urandom(1024 * 1024))
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(file_path, port), daemon=True)
+    server.start()
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f'{base}/docs')
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        else:
+            sys.exit("uvicorn启动失败")
+        cases = [
+            ("旧 Range bytes=0-", '/old', {'range': 'bytes=0-'}),
+            ("旧 整个文件", '/old', {}),
+            ("新 Range bytes=0-", '/new', {'range': 'bytes=0-'}),
+            ("新 整个文件", '/new', {}),
+        ]
+        print(f"文件: {args.size} MB，每项取{args.repeat}次中最快的一次")
+        print(f"{'实现':<20}{'MB/秒':>10}{'服务端CPU秒':>14}")
+        for name, path, headers in cases:
+            best = None
+            for _ in range(args.repeat):
+                cpu = proc_stat(server.pid)[0]
+                start = time.perf_counter()
+                received = fetch(base + path, headers)
+                elapsed = time.perf_counter() - start
+                cpu = proc_stat(server.pid)[0] - cpu
+                if received != args.size * 1024 * 1024:
+                    print(f"警告: {name} 收到 {received} 字节", file=sys.stderr)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, cpu)
+            print(f"{name:<20}{args.size * 1.048576 / best[0]:>10.1f}{best[1]:>14.2f}")
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
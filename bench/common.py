@@ -0,0 +1,41 @@
+"""
+性能测试脚本共用的工具：进程资源统计（读取/proc，只支持Linux）和合成的弹幕数据包
+"""
+import os
+import struct
+
+HEADER_STRUCT = struct.Struct('>IHHII')
+
+def proc_stat(pid):
+    """(CPU秒数, RSS字节数)"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+def thread_count():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+
+def packet(body, proto_ver, op_code=5):
+    """B站弹幕协议的数据包：16字节头部 + 数据体"""
+    return HEADER_STRUCT.pack(HEADER_STRUCT.size + len(body), HEADER_STRUCT.size, proto_ver, op_code, 0) + body
+
+def sample_message(i):
+    """一条典型的DANMU_MSG通知"""
+    return {
+        "cmd": "DANMU_MSG",
+        "info": [
+            [0, 1, 25, 16777215, 1700000000000 + i, 0, 0, "a1b2c3d4", 0, 0, 0, "", 0, "{}", "{}",
+             {"mode": 0, "show_player_type": 0, "extra": "{\"send_from_me\":false,\"color\":16777215}"}],
+            f"第{i}条弹幕内容，测试一下解码速度",
+            [10000 + i, f"用户{i}", 0, 0, 0, 10000, 1, ""],
+            [21, "粉丝牌", "主播", 5000, 398668, "", 0, 398668, 398668, 398668, 0, 1, 20000],
+            [12, 0, 6406234, ">50000", 0],
+            ["", ""], 0, 0, None, {"ts": 1700000000, "ct": "ABCDEF"}, 0, 0, None, None, 0, 105
+        ],
+        "dm_v2": ""
+    }
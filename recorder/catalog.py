@@ -0,0 +1,212 @@
+import os
+import re
+import sqlite3
+import time
+from recorder.config import Config
+from recorder import json_codec
+
+# 录制文件名：{房间号}_{YYYYmmdd}_{HHMMSS}[_{分段序号}].flv/mp4
+VIDEO_NAME_PATTERN = re.compile(r'^(?P<session>.+_\d{8}_\d{6})(?:_(?P<part>\d{3}))?\.(?P<ext>flv|mp4)$')
+
+def parse_start_time(session_id):
+    """从会话ID中取出开始时间 YYYYmmdd_HHMMSS"""
+    parts = session_id.split("_")
+    if len(parts) >= 3:
+        return f"{parts[-2]}_{parts[-1]}"
+    return session_id
+
+class RecordingsCatalog:
+    """
+    录制文件索引，按session_id和房间号保存在内存中
+    启动时按房间目录的mtime增量重建：目录内文件没有增删时mtime不变，无需重新列目录。
+    录制任务开始和结束时由RecordingManager直接更新，详情和删除可以O(1)查到会话所在目录。
+    db_path不为None时索引同时保存到SQLite，重启后只需重新扫描有变化的房间目录。
+    """
+    def __init__(self, output_dir=None, db_path=None, refresh_interval=None):
+        self.output_dir = output_dir or Config.OUTPUT_DIR
+        self.db_path = db_path if db_path is not None else Config.CATALOG_DB_PATH
+        self.refresh_interval = refresh_interval if refresh_interval is not None else Config.CATALOG_REFRESH_INTERVAL
+        self.sessions = {}  # session_id -> 会话信息
+        self.rooms = {}  # room_id -> {session_id, ...}
+        self.room_mtimes = {}  # room_id -> 上次扫描时目录的mtime_ns
+        self.last_refresh = 0
+        self.rooms_scanned = 0  # 统计：实际重新扫描的房间目录次数
+        self.db = None
+        if self.db_path:
+            self._open_db()
+
+    def _open_db(self):
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS rooms (room_id TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, room_id TEXT, data TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_room ON sessions (room_id)")
+        self.db.commit()
+        for room_id, mtime_ns in self.db.execute("SELECT room_id, mtime_ns FROM rooms"):
+            self.room_mtimes[room_id] = mtime_ns
+        for session_id, room_id, data in self.db.execute("SELECT session_id, room_id, data FROM sessions"):
+            self.sessions[session_id] = json_codec.loads(data)
+            self.rooms.setdefault(room_id, set()).add(session_id)
+
+    def refresh(self, force=False):
+        """按目录mtime增量更新索引，两次刷新之间至少间隔refresh_interval秒"""
+        now = time.time()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return
+        self.last_refresh = now
+
+        room_ids = set()
+        if os.path.exists(self.output_dir):
+            for entry in os.scandir(self.output_dir):
+                if not entry.is_dir():
+                    continue
+                room_ids.add(entry.name)
+                mtime_ns = entry.stat().st_mtime_ns
+                if self.room_mtimes.get(entry.name) != mtime_ns:
+                    self.refresh_room(entry.name, mtime_ns)
+        # 房间目录已被删除
+        for room_id in list(self.room_mtimes):
+            if room_id not in room_ids:
+                self._replace_room(room_id, {}, None)
+
+    def refresh_room(self, room_id, mtime_ns=None):
+        """重新扫描一个房间目录"""
+        room_id = str(room_id)
+        room_path = os.path.join(self.output_dir, room_id)
+        try:
+            if mtime_ns is None:
+                mtime_ns = os.stat(room_path).st_mtime_ns
+            filenames = os.listdir(room_path)
+        except OSError:
+            self._replace_room(room_id, {}, None)
+            return
+        self.rooms_scanned += 1
+        self._replace_room(room_id, self._scan_files(room_id, room_path, filenames), mtime_ns)
+
+    def _scan_files(self, room_id, room_path, filenames):
+        """把一个房间目录下的文件按会话分组"""
+        names = set(filenames)
+        grouped = {}
+        for filename in filenames:
+            match = VIDEO_NAME_PATTERN.match(filename)
+            if match:
+                session_id, part = match.group('session'), match.group('part')
+            elif filename.endswith((".flv", ".mp4")):
+                session_id, part = filename[:-4], None
+            else:
+                continue
+            grouped.setdefault(session_id, {"full": [], "parts": []})
+            grouped[session_id]["parts" if part else "full"].append(filename)
+
+        sessions = {}
+        for session_id, files in grouped.items():
+            # 优先选择完整的MP4，其次完整的FLV，最后是第一个分段（同样优先MP4）
+            full = sorted(files["full"], key=lambda name: not name.endswith(".mp4"))
+            parts = sorted(files["parts"], key=lambda name: (name[:-4], not name.endswith(".mp4")))
+            video_name = (full or parts)[0]
+            # 录制中或还没有归档的会话是JSONL，归档后是列式文件
+            danmaku_name = f"{session_id}_danmaku.jsonl"
+            if danmaku_name not in names and f"{session_id}_danmaku.dca" in names:
+                danmaku_name = f"{session_id}_danmaku.dca"
+            sessions[session_id] = {
+                "session_id": session_id,
+                "room_id": room_id,
+                "start_time": parse_start_time(session_id),
+                "video_file": os.path.join(room_path, video_name),
+                "danmaku_file": os.path.join(room_path, danmaku_name) if danmaku_name in names else None,
+                "parts": [os.path.join(room_path, name) for name in parts] if not full else [],
+                "is_limited": False
+            }
+        return sessions
+
+    def _replace_room(self, room_id, sessions, mtime_ns):
+        for session_id in self.rooms.pop(room_id, set()):
+            self.sessions.pop(session_id, None)
+        if mtime_ns is None:
+            self.room_mtimes.pop(room_id, None)
+        else:
+            self.room_mtimes[room_id] = mtime_ns
+        if sessions:
+            self.rooms[room_id] = set(sessions)
+            self.sessions.update(sessions)
+
+        if self.db:
+            with self.db:
+                self.db.execute("DELETE FROM sessions WHERE room_id = ?", (room_id,))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, room_id, data) VALUES (?, ?, ?)",
+                    [(sid, room_id, json_codec.dumps(info)) for sid, info in sessions.items()]
+                )
+                if mtime_ns is None:
+                    self.db.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+                else:
+                    self.db.execute("INSERT OR REPLACE INTO rooms (room_id, mtime_ns) VALUES (?, ?)", (room_id, mtime_ns))
+
+    def add_session(self, session_id, room_id, video_file, danmaku_file=None):
+        """录制开始时登记会话，此时视频文件可能还没有创建"""
+        room_id = str(room_id)
+        info = {
+            "session_id": session_id,
+            "room_id": room_id,
+            "start_time": parse_start_time(session_id),
+            "video_file": video_file,
+            "danmaku_file": danmaku_file,
+            "parts": [],
+            "is_limited": False
+        }
+        self.sessions[session_id] = info
+        self.rooms.setdefault(room_id, set()).add(session_id)
+        if self.db:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO sessions (session_id, room_id, data) VALUES (?, ?, ?)",
+                    (session_id, room_id, json_codec.dumps(info))
+                )
+
+    def get(self, session_id):
+        """按session_id查找会话，找不到时刷新一次索引（可能是外部新增的文件）"""
+        info = self.sessions.get(session_id)
+        if info is None:
+            self.refresh()
+            info = self.sessions.get(session_id)
+        return info
+
+    def list_sessions(self):
+        """返回 (按房间分组, 全部会话)，都按开始时间倒序"""
+        self.refresh()
+        flat = sorted(self.sessions.values(), key=lambda x: x["start_time"], reverse=True)
+        grouped = {}
+        for info in flat:
+            grouped.setdefault(info["room_id"], []).append(info)
+        return grouped, flat
+
+    def delete(self, session_id):
+        """删除会话的所有文件（视频、分段、弹幕及其它附属文件），返回删除的文件列表"""
+        info = self.get(session_id)
+        if info is None:
+            return []
+        room_id = info["room_id"]
+        room_path = os.path.join(self.output_dir, room_id)
+        removed = []
+        if os.path.isdir(room_path):
+            # 只列出该会话所在的房间目录
+            for filename in os.listdir(room_path):
+                if filename.startswith(session_id):
+                    file_path = os.path.join(room_path, filename)
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                        removed.append(file_path)
+                        print(f"已删除文件: {file_path}")
+            # 检查房间目录是否为空，如果是则删除目录
+            if not os.listdir(room_path):
+                os.rmdir(room_path)
+                print(f"已删除空房间目录: {room_path}")
+        self.refresh_room(room_id)
+        return removed
+
+    def get_stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "rooms": len(self.rooms),
+            "rooms_scanned": self.rooms_scanned,
+            "persistent": self.db is not None
+        }
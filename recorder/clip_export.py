@@ -0,0 +1,344 @@
+import asyncio
+import os
+import re
+import time
+from recorder.config import Config
+from recorder import json_codec
+from recorder import danmaku_index
+from recorder import danmaku_archive
+from recorder.convert_queue import ConversionScheduler
+from recorder.ffmpeg_tools import run_ffmpeg, low_priority_command, drain_stream, probe_media, concat_files
+from recorder.session_meta import session_timeline, wall_time, media_offset
+
+PTS_TIME_PATTERN = re.compile(r'pts_time:\s*(-?[\d.]+)')
+VIDEO_CODEC_PATTERN = re.compile(r'Stream #0:\d+.*?: Video: (\w+)')
+TIMESCALE_PATTERN = re.compile(r'([\d.]+)(k?) tbn')
+
+def make_clip_id(session_id, start, end, precise=False):
+    """同一会话、同一时间段（精确到毫秒）、同一模式的剪辑只导出一次"""
+    clip_id = f"{session_id}_{int(round(start * 1000))}_{int(round(end * 1000))}"
+    return clip_id + "_precise" if precise else clip_id
+
+def clip_paths(clip_id, clip_dir=None):
+    """返回 (视频, 弹幕, 信息文件) 的路径"""
+    base = os.path.join(clip_dir or Config.CLIP_DIR, clip_id)
+    return f"{base}.mp4", f"{base}_danmaku.jsonl", f"{base}.json"
+
+def session_sources(info):
+    """会话的视频文件：完整文件，或者按顺序排列的分段（同一分段有MP4时不用FLV）"""
+    if not info.get("parts"):
+        return [info["video_file"]] if info.get("video_file") and os.path.exists(info["video_file"]) else []
+    by_stem = {}
+    for path in info["parts"]:
+        stem = path[:-4]
+        if stem not in by_stem or path.endswith(".mp4"):
+            by_stem[stem] = path
+    return [by_stem[stem] for stem in sorted(by_stem) if os.path.exists(by_stem[stem])]
+
+async def probe_keyframes(video_file, start, window=None):
+    """
+    只解码关键帧，找出start之前最近的关键帧和之后的关键帧（相对文件开头的秒数）
+    -noaccurate_seek让seek到的那个关键帧也输出（时间为负），一次调用就能得到两侧的关键帧
+    返回 (关键帧时间列表, 视频编码, 视频轨道的时间刻度)
+    """
+    cmd = [
+        Config.FFMPEG_PATH, '-hide_banner', '-nostats',
+        '-skip_frame', 'nokey', '-noaccurate_seek', '-ss', f"{start:.3f}",
+        '-i', video_file,
+        '-t', str(window or Config.CLIP_KEYFRAME_PROBE),
+        '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-'
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    lines, _ = await asyncio.gather(drain_stream(process.stderr, keep_lines=2000), process.wait())
+    keyframes = []
+    codec = None
+    timescale = None
+    for line in lines:
+        if codec is None:
+            match = VIDEO_CODEC_PATTERN.search(line)
+            if match:
+                codec = match.group(1)
+                scale = TIMESCALE_PATTERN.search(line)
+                if scale:
+                    timescale = int(float(scale.group(1)) * (1000 if scale.group(2) else 1))
+        if 'iskey:1' in line:
+            match = PTS_TIME_PATTERN.search(line)
+            if match:
+                keyframes.append(round(start + float(match.group(1)), 3))
+    return keyframes, codec, timescale
+
+def export_danmaku(danmaku_file, base_name, media_start, media_end, output_file):
+    """
+    导出剪辑时间段内的弹幕（JSONL），每条附带offset（相对剪辑开头的秒数）
+    通过弹幕索引或归档直接定位，不读取整个文件；返回导出的条数
+    """
+    timeline = session_timeline(base_name)
+    if timeline is None:
+        return 0
+    from_ts = wall_time(timeline, media_start)
+    to_ts = wall_time(timeline, media_end)
+    count = 0
+    cursor = None
+    tmp_path = output_file + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        while True:
+            result = danmaku_index.page(danmaku_file, cursor=cursor, limit=Config.DANMU_PAGE_MAX, from_ts=from_ts, to_ts=to_ts)
+            for item in result["items"]:
+                item["offset"] = round(media_offset(timeline, item.get("timestamp") or timeline["t0"]) - media_start, 3)
+                f.write(json_codec.dumps_bytes(item) + b'\n')
+                count += 1
+            cursor = result["next_cursor"]
+            if cursor is None:
+                break
+    os.replace(tmp_path, output_file)
+    return count
+
+class ClipJob:
+    """
+    一个剪辑导出任务
+    copy模式：从start之前最近的关键帧开始直接复制音视频流，不转码，剪辑会比start早不到一个GOP；
+    precise模式：start到下一个关键帧之间的不完整GOP重新编码，其余部分直接复制，起点精确。
+    跨分段的剪辑每个分段单独截取（在单个文件内seek才能定位到关键帧），最后用concat分离器拼接
+    """
+    def __init__(self, info, start, end, precise=False, clip_dir=None):
+        self.session_id = info["session_id"]
+        self.start = start
+        self.end = end
+        self.precise = precise
+        self.clip_id = make_clip_id(self.session_id, start, end, precise)
+        self.clip_dir = clip_dir or Config.CLIP_DIR
+        self.output_file, self.danmaku_output, self.info_file = clip_paths(self.clip_id, self.clip_dir)
+        self.sources = session_sources(info)
+        self.video_file = self.sources[0] if self.sources else None
+        self.base_name = os.path.join(os.path.dirname(self.video_file), self.session_id) if self.video_file else None
+        self.danmaku_file = danmaku_archive.locate(info["danmaku_file"]) if info.get("danmaku_file") else None
+        self.state = "queued"
+        self.progress = 0
+        self.error = None
+        self.result = None
+        self.job = None
+
+    async def _pieces(self):
+        """把剪辑的时间段映射到各个分段上，返回 [(文件, 分段内起点, 分段内终点), ...]"""
+        if len(self.sources) == 1:
+            return [(self.sources[0], self.start, self.end)]
+        pieces = []
+        offset = 0.0
+        for path in self.sources:
+            info = await probe_media(path)
+            if not info or not info["duration"]:
+                raise RuntimeError(f"无法读取分段时长: {path}")
+            part_end = offset + info["duration"]
+            if part_end > self.start and offset < self.end:
+                pieces.append((path, max(self.start - offset, 0.0), min(self.end, part_end) - offset))
+            offset = part_end
+            if offset >= self.end:
+                break
+        if not pieces:
+            raise ValueError("剪辑时间超出了录制时长")
+        return pieces
+
+    async def run(self):
+        self.state = "running"
+        os.makedirs(self.clip_dir, exist_ok=True)
+        tmp_files = []
+        try:
+            pieces = await self._pieces()
+            first_file, first_start, first_end = pieces[0]
+            keyframes, codec, timescale = await probe_keyframes(first_file, first_start)
+            before = [t for t in keyframes if t <= first_start + 0.001]
+            after = [t for t in keyframes if first_start + 0.05 < t < first_end]
+            # 只有H.264能可靠地把重新编码的开头和复制的部分拼在一起，其它编码退回copy模式
+            if self.precise and after and codec == 'h264':
+                mode = "precise"
+                clip_start = self.start
+                outputs = await self._cut_precise(pieces, after[0], timescale, tmp_files)
+            else:
+                mode = "copy"
+                clip_start = self.start - (first_start - before[-1]) if before else self.start
+                outputs = await self._cut_copy(pieces, tmp_files)
+            if outputs is None:
+                self.state = "failed"
+                return False
+            tmp_output = self.output_file + '.tmp.mp4'
+            tmp_files.append(tmp_output)
+            if len(outputs) == 1:
+                os.replace(outputs[0], tmp_output)
+            elif not await concat_files(outputs, tmp_output):
+                self.error = "拼接剪辑失败"
+                self.state = "failed"
+                return False
+            os.replace(tmp_output, self.output_file)
+
+            danmaku_count = 0
+            if self.danmaku_file and os.path.exists(self.danmaku_file):
+                danmaku_count = await asyncio.to_thread(
+                    export_danmaku, self.danmaku_file, self.base_name, clip_start, self.end, self.danmaku_output
+                )
+            self.result = {
+                "clip_id": self.clip_id,
+                "session_id": self.session_id,
+                "start": self.start,
+                "end": self.end,
+                "clip_start": round(clip_start, 3),
+                "mode": mode,
+                "file_size": os.path.getsize(self.output_file),
+                "danmaku_count": danmaku_count,
+                "video_url": f"/clips/{os.path.basename(self.output_file)}",
+                "danmaku_url": f"/clips/{os.path.basename(self.danmaku_output)}" if danmaku_count else None,
+                "created_at": time.time()
+            }
+            with open(self.info_file, 'wb') as f:
+                f.write(json_codec.dumps_bytes(self.result))
+            self.state = "done"
+            self.progress = 100
+            return True
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            raise
+        finally:
+            for path in tmp_files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _on_percent(self, percent):
+        self.progress = percent
+
+    async def _ffmpeg(self, args, duration):
+        cmd = [Config.FFMPEG_PATH, '-y', *args, '-progress', 'pipe:1', '-nostats', '-loglevel', 'error']
+        cmd, kwargs = low_priority_command(cmd)
+        returncode, stderr_tail = await run_ffmpeg(cmd, duration, self._on_percent, **kwargs)
+        if returncode != 0:
+            self.error = "\n".join(stderr_tail[-5:]) or f"FFmpeg返回码: {returncode}"
+            print(f"导出剪辑 {self.clip_id} 失败: {self.error}")
+            return False
+        return True
+
+    async def _copy_piece(self, path, start, end, output):
+        """从start之前的关键帧开始直接复制，时间戳从0开始"""
+        return await self._ffmpeg([
+            '-ss', f"{start:.3f}", '-i', path,
+            '-t', f"{end - start:.3f}",
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c', 'copy', '-avoid_negative_ts', 'make_zero',
+            '-movflags', '+faststart',
+            output
+        ], end - start)
+
+    async def _cut_copy(self, pieces, tmp_files):
+        """每个分段直接复制，返回截取出的文件列表，失败返回None"""
+        outputs = []
+        for index, (path, start, end) in enumerate(pieces):
+            output = os.path.join(self.clip_dir, f"{self.clip_id}_{index}.mp4")
+            tmp_files.append(output)
+            if not await self._copy_piece(path, start, end, output):
+                return None
+            outputs.append(output)
+        return outputs
+
+    async def _cut_precise(self, pieces, keyframe, timescale, tmp_files):
+        """
+        第一个分段的start到关键帧之间重新编码，关键帧之后和其余分段直接复制。
+        拼接时concat分离器会给MP4中的H.264加上h264_mp4toannexb，
+        每个关键帧都带有参数集，重新编码的开头和复制的部分编码参数不同也能接上。
+        拼接后沿用第一个文件的时间刻度，开头必须和原视频的刻度一致，否则后面复制的部分时长会被拉伸
+        """
+        path, start, end = pieces[0]
+        head = os.path.join(self.clip_dir, f"{self.clip_id}_head.mp4")
+        tmp_files.append(head)
+        ok = await self._ffmpeg([
+            '-ss', f"{start:.3f}", '-i', path,
+            '-t', f"{keyframe - start:.3f}",
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c:v', 'libx264', '-preset', Config.CLIP_EDGE_PRESET, '-crf', str(Config.CLIP_EDGE_CRF),
+            '-c:a', 'aac',
+            *(['-video_track_timescale', str(timescale)] if timescale else []),
+            head
+        ], keyframe - start)
+        if not ok:
+            return None
+        # seek到关键帧之后一点点，保证选中的就是这个关键帧而不是前一个
+        rest = await self._cut_copy([(path, keyframe + 0.001, end)] + pieces[1:], tmp_files)
+        return [head] + rest if rest is not None else None
+
+    def to_dict(self):
+        info = {
+            "clip_id": self.clip_id,
+            "session_id": self.session_id,
+            "start": self.start,
+            "end": self.end,
+            "precise": self.precise,
+            "state": self.state,
+            "progress": self.progress,
+            "error": self.error,
+            "job": self.job.to_dict() if self.job and self.state != "done" else None
+        }
+        if self.result:
+            info.update(self.result)
+        return info
+
+class ClipExporter:
+    """
+    剪辑导出，由RecordingManager持有
+    导出任务进入有并发上限的队列（复用转换队列的实现，和录制后的转换分开排队）；
+    导出结果按 (会话, 起点, 终点, 模式) 保存在CLIP_DIR中，相同的请求直接返回已有结果，进行中的请求合并
+    """
+    def __init__(self, clip_dir=None, max_workers=None):
+        self.clip_dir = clip_dir or Config.CLIP_DIR
+        self.scheduler = ConversionScheduler(max_workers or Config.CLIP_MAX_WORKERS, "fifo")
+        self.jobs = {}  # clip_id -> 排队中、进行中或失败的ClipJob
+        self.cache_hits = 0
+
+    def _cached(self, clip_id):
+        video_file, _, info_file = clip_paths(clip_id, self.clip_dir)
+        if not os.path.exists(video_file):
+            return None
+        try:
+            with open(info_file, 'rb') as f:
+                info = json_codec.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        info.update({"state": "done", "progress": 100, "cached": True})
+        return info
+
+    def submit(self, info, start, end, precise=False):
+        """提交剪辑，返回剪辑状态（已导出过的直接返回结果）"""
+        clip_id = make_clip_id(info["session_id"], start, end, precise)
+        cached = self._cached(clip_id)
+        if cached:
+            self.cache_hits += 1
+            return cached
+        job = self.jobs.get(clip_id)
+        if job and job.state in ("queued", "running"):
+            return job.to_dict()
+        job = ClipJob(info, start, end, precise, self.clip_dir)
+        if not job.sources:
+            raise FileNotFoundError("视频文件不存在")
+        self.jobs[clip_id] = job
+
+        async def runner():
+            try:
+                return await job.run()
+            finally:
+                if job.state == "done":
+                    # 完成后由信息文件提供结果，不再保留在内存中
+                    self.jobs.pop(clip_id, None)
+
+        job.job = self.scheduler.submit(job, source_file=job.video_file, runner=runner)
+        return job.to_dict()
+
+    def get(self, clip_id):
+        job = self.jobs.get(clip_id)
+        if job:
+            return job.to_dict()
+        return self._cached(clip_id)
+
+    def get_stats(self):
+        stats = self.scheduler.get_stats()
+        stats["cache_hits"] = self.cache_hits
+        return stats
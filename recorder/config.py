@@ -7,9 +7,141 @@ class Config:
     
     # FFmpeg路径 - 按顺序尝试多个可能的位置
     FFMPEG_PATH = "D:\\ffmpeg\\ffmpeg-8.0-essentials_build\\bin\\ffmpeg.exe"
+    # FFprobe路径，为None时使用FFmpeg同目录下的ffprobe
+    FFPROBE_PATH = None
+    
+    # 录制结束后转MP4的方式：remux（直接复制音视频流，只换封装）或 transcode（libx264/aac重新编码）
+    # remux模式下如果源编码无法放进MP4，会自动改为transcode
+    CONVERT_MODE = "remux"
+    # 同时运行的转换进程数上限，超出的任务排队等待
+    CONVERT_MAX_WORKERS = 2
+    # 排队顺序：fifo（先结束先转换）或 shortest（文件小的优先）
+    CONVERT_PRIORITY = "fifo"
+    # 转换进程的nice值（0表示不调整，Windows下>=15为空闲优先级，否则为低于正常）
+    CONVERT_NICE = 10
+    # 转换进程的ionice调度类（Linux）：2为best-effort最低级，3为idle，None表示不调整
+    CONVERT_IONICE_CLASS = 2
+    
+    # 视频文件接口每次读取发送的块大小（字节）
+    VIDEO_CHUNK_SIZE = 1024 * 1024
     
     # B站API相关配置
     BILIBILI_API_HEADERS = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         'Referer': 'https://www.bilibili.com/'
-    }
\ No newline at end of file
+    }
+    BILIBILI_API_BASE = "https://api.live.bilibili.com"
+    RESOLVER_TIMEOUT = 10  # 请求超时（秒）
+    RESOLVER_ROOM_TTL = 3600  # 短号到真实房间号映射的缓存时间（秒）
+    RESOLVER_PLAY_INFO_TTL = 60  # 流地址的缓存时间（秒），流地址本身带有过期时间，不宜过长
+    
+    # 多CDN节点测速：并发请求各候选地址，按首字节时间和起始下载速度排序
+    CDN_PROBE_MAX = 8  # 最多测速的候选地址数
+    CDN_PROBE_BYTES = 256 * 1024  # 每个节点读取的数据量
+    CDN_PROBE_TIMEOUT = 3  # 单个节点测速超时（秒）
+    CDN_STATS_ALPHA = 0.3  # 节点统计的指数加权系数，越大越看重最近一次
+    CDN_FAILURE_PENALTY = 5  # 每次近期失败的罚时（秒）
+    CDN_EXPIRE_MARGIN = 60  # 流地址距离过期不足该时间（秒）时，重连前重新获取
+    # 同一格式内先按视频编码排序，再按节点速度排序（HEVC在浏览器播放和转封装时兼容性较差）
+    STREAM_CODEC_PREFERENCE = ['avc', 'hevc']
+    
+    # 实时预览：录制时同一个ffmpeg额外输出HLS，录制中即可在网页上观看
+    LIVE_PREVIEW = True
+    LIVE_DIR = "live"  # HLS切片目录，每个任务一个子目录，任务停止后删除
+    LIVE_HLS_TIME = 2  # 每个切片的目标时长（秒），越小延迟越低
+    LIVE_HLS_LIST_SIZE = 6  # 播放列表中保留的切片数
+    LIVE_SEGMENT_TYPE = "mpegts"  # mpegts 或 fmp4（HEVC直播流需要fmp4才能在浏览器中播放）
+    
+    # 录制文件索引：保存到SQLite的路径，None表示只保存在内存中（启动时重新扫描）
+    CATALOG_DB_PATH = None
+    CATALOG_REFRESH_INTERVAL = 5  # 两次检查输出目录变化的最短间隔（秒）
+    
+    # 录制任务状态保存到SQLite，服务重启后继续未完成的录制和转换；None表示只保存在内存中
+    TASK_DB_PATH = "tasks.db"
+    TASK_STATE_INTERVAL = 10  # 录制中的任务每隔多少秒保存一次状态
+    TASK_HISTORY_PAGE_SIZE = 50  # 状态接口每页返回的已结束任务数
+    
+    # 任务状态推送（SSE）
+    STATUS_TICK_INTERVAL = 1  # 更新进度并推送变化的间隔（秒）
+    STATUS_EVENT_QUEUE_SIZE = 256  # 每个连接最多积压的事件数，超过后改为重新发送全量快照
+    STATUS_KEEPALIVE = 15  # 没有事件时发送注释行保持连接的间隔（秒）
+    
+    # 断线重连：ffmpeg退出或输出停止增长时重新获取流地址，继续录到新的分段
+    RECORD_STALL_TIMEOUT = 20  # 超过该时间（秒）没有新数据写入视为卡住
+    RECORD_RECONNECT_DELAY = 2  # 第一次重连前的等待时间（秒），连续失败时逐渐加长
+    RECORD_RECONNECT_MAX_DELAY = 30  # 重连等待时间上限（秒）
+    
+    # 录制引擎：ffmpeg（每路直播一个ffmpeg进程，支持HLS源和实时预览）
+    # 或 native（进程内直接拉取HTTP-FLV写入文件，内存和CPU占用小，不支持HLS源和实时预览）
+    RECORD_ENGINE = "ffmpeg"
+    FLV_READ_SIZE = 256 * 1024  # 每次从网络读取的最大字节数
+    FLV_WRITE_BUFFER = 1024 * 1024  # 攒够这么多数据再写入磁盘
+    FLV_MAX_TIMESTAMP_JUMP = 3000  # 相邻tag时间戳跳变超过该值（毫秒）视为不连续，接着上一帧继续
+    
+    # 分段录制：每段的时长（秒），0表示录成单个文件
+    # 每个分段关闭后立即在后台转成MP4，录制结束时只需快速拼接
+    SEGMENT_SECONDS = 0
+    
+    # 弹幕集线器配置
+    DANMU_HUB_LOOPS = 1  # 共享事件循环数量，房间按房间号分片到各个循环
+    DANMU_RECONNECT_DELAY = 5  # 弹幕连接掉线后的重连间隔（秒）
+    
+    # 开播自动录制：关注的直播间各保持一个只接收开播/下播通知的弹幕连接，关注列表保存在任务库中
+    WATCH_CONNECT_INTERVAL = 0.2  # 启动时恢复关注列表，两个连接之间的间隔（秒）
+    WATCH_START_RETRIES = 5  # 开播后取不到流地址时的尝试次数（刚开播时可能还没有流）
+    WATCH_RETRY_DELAY = 2  # 两次尝试之间的间隔（秒）
+    
+    # 弹幕文件写入配置
+    DANMU_FLUSH_BYTES = 64 * 1024  # 缓冲区达到该大小时写入文件
+    DANMU_FLUSH_INTERVAL = 0.5  # 最长缓冲时间（秒）
+    DANMU_FSYNC_INTERVAL = 10  # fsync间隔（秒），None表示不主动fsync，0表示每次写入都fsync
+    DANMU_INDEX_EVERY_LINES = 1000  # 弹幕索引每隔多少行记一项（另外每秒的第一条也会记一项）
+    DANMU_PAGE_MAX = 1000  # 分页接口每页最多返回的弹幕数
+    DANMU_WINDOW_MAX_SECONDS = 60  # 播放同步接口单次请求的最长时间窗口（秒）
+    
+    # 弹幕归档：录制结束后把JSONL弹幕压缩为列式文件（*_danmaku.dca），接口读取时自动识别
+    DANMU_ARCHIVE = True
+    DANMU_ARCHIVE_BACKFILL = True  # 启动时把已结束会话里还没有归档的JSONL弹幕也压缩
+    DANMU_ARCHIVE_LEVEL = 6  # 压缩级别（zstd或zlib），9比6小约7%，但压缩用时约为两倍
+    DANMU_ARCHIVE_BLOCK_ROWS = 4096  # raw字段每块的行数，读取时按块解压
+    DANMU_ARCHIVE_CACHE = 8  # 同时保留在内存中的归档文件数
+    SC_QUERY_MAX = 5000  # SC查询接口最多返回的条数
+    
+    # 弹幕热度：录制结束后按秒统计弹幕、礼物、SC，保存为 *_heatmap.json，并找出热度峰值作为剪辑候选
+    HEATMAP = True
+    HIGHLIGHT_WINDOW = 30  # 峰值窗口长度（秒）
+    HIGHLIGHT_PRE_ROLL = 10  # 剪辑候选的起点比峰值窗口提前的秒数
+    HIGHLIGHT_MAX = 10  # 每个会话最多的候选数
+    HIGHLIGHT_MIN_RATIO = 2.0  # 窗口热度至少是全场中位数的几倍
+    HIGHLIGHT_MIN_SCORE = 20  # 窗口热度的下限，避免冷清的会话里把几条弹幕当成峰值
+    HIGHLIGHT_SC_WEIGHT = 5  # 一条SC相当于几条弹幕
+    HIGHLIGHT_VALUE_WEIGHT = 1  # 每元礼物/SC金额相当于几条弹幕
+    
+    # 剪辑导出：按关键帧直接复制音视频流，可选只重新编码开头不完整的GOP
+    CLIP_DIR = "clips"  # 导出的剪辑和对应的弹幕，按 (会话, 起点, 终点) 缓存
+    CLIP_MAX_WORKERS = 2  # 同时运行的导出数
+    CLIP_MAX_SECONDS = 600  # 单个剪辑的最长时长（秒）
+    CLIP_KEYFRAME_PROBE = 10  # 从起点往后查找关键帧的范围（秒），应大于直播流的GOP长度
+    CLIP_EDGE_PRESET = "veryfast"  # 精确模式重新编码开头时的x264 preset
+    CLIP_EDGE_CRF = 18
+    
+    # 弹幕全文搜索：DANMU_MSG和SC的内容按二元组建立SQLite FTS5索引；None表示不建立索引
+    SEARCH_DB_PATH = "search.db"
+    SEARCH_BACKFILL = True  # 启动时为已有的弹幕文件补建索引
+    SEARCH_QUEUE_SIZE = 50000  # 等待写入索引的弹幕上限，超过时先丢弃，会话结束时从弹幕文件补上
+    SEARCH_BATCH_SIZE = 2000  # 每个事务最多写入的条数
+    SEARCH_COMMIT_INTERVAL = 1  # 攒批的最长时间（秒）
+    SEARCH_PAGE_MAX = 200  # 搜索接口每页最多返回的条数
+    
+    # 弹幕cmd过滤配置：先在原始字节中取出cmd再决定是否解析
+    # DANMU_CMD_ALLOW为空列表表示保存所有cmd，DANMU_CMD_DENY优先于DANMU_CMD_ALLOW
+    DANMU_CMD_ALLOW = [
+        'DANMU_MSG',
+        'SUPER_CHAT_MESSAGE',
+        'SEND_GIFT',
+        'GUARD_BUY',
+        'INTERACT_WORD',
+        'LIVE',
+        'PREPARING'
+    ]
+    DANMU_CMD_DENY = []
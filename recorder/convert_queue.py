@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import os
+import time
+from recorder.config import Config
+
+class ConversionJob:
+    """一个排队中的转换任务，runner是实际执行转换的协程函数，返回False表示失败"""
+    def __init__(self, task, scheduler, source_file=None, runner=None):
+        self.task = task
+        self.scheduler = scheduler
+        self.source_file = source_file or task.video_file
+        self.runner = runner or task._convert_to_mp4
+        self.file_size = os.path.getsize(self.source_file) if self.source_file and os.path.exists(self.source_file) else 0
+        self.state = "queued"  # queued / running / done / failed
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = asyncio.Event()
+
+    async def wait(self):
+        """等待转换结束"""
+        await self.done.wait()
+        return self.state == "done"
+
+    @property
+    def wait_time(self):
+        end = self.started_at or time.time()
+        return end - self.enqueued_at
+
+    @property
+    def run_time(self):
+        if not self.started_at:
+            return 0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def to_dict(self):
+        run_time = self.run_time
+        return {
+            "state": self.state,
+            "position": self.scheduler.position_of(self),
+            "queue_depth": self.scheduler.queue_depth,
+            "running_jobs": len(self.scheduler.running),
+            "file_size": self.file_size,
+            "wait_seconds": round(self.wait_time, 1),
+            "run_seconds": round(run_time, 1),
+            # 处理速度（MB/s），按源文件大小计算
+            "throughput_mbps": round(self.file_size / run_time / 1024 / 1024, 2) if run_time > 0 and self.state != "queued" else None
+        }
+
+class ConversionScheduler:
+    """
+    录制结束后的转换调度器，由RecordingManager持有
+    所有任务的转换进入同一个队列，最多同时运行max_workers个ffmpeg，
+    避免一批任务同时结束时几十个转换一起抢占CPU和磁盘。
+    """
+    def __init__(self, max_workers=None, priority=None):
+        self.max_workers = max(1, max_workers or Config.CONVERT_MAX_WORKERS)
+        # fifo：按提交顺序；shortest：文件小的优先
+        self.priority = priority or Config.CONVERT_PRIORITY
+        self.queue = None
+        self.workers = []
+        self.waiting = []
+        self.running = []
+        self.counter = itertools.count()
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.waiting)
+
+    def position_of(self, job):
+        if job not in self.waiting:
+            return 0
+        ordered = sorted(self.waiting, key=self._sort_key)
+        return ordered.index(job) + 1
+
+    def _sort_key(self, job):
+        if self.priority == "shortest":
+            return (job.file_size, job.enqueued_at)
+        return (0, job.enqueued_at)
+
+    def _ensure_started(self):
+        # 队列和工作协程需要在事件循环中创建，第一次提交时再启动
+        if self.queue is not None:
+            return
+        self.queue = asyncio.PriorityQueue()
+        for _ in range(self.max_workers):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    def submit(self, task, source_file=None, runner=None):
+        """把转换放入队列，立即返回；默认转换整个任务的视频文件"""
+        self._ensure_started()
+        job = ConversionJob(task, self, source_file, runner)
+        self.waiting.append(job)
+        self.queue.put_nowait((self._sort_key(job), next(self.counter), job))
+        print(f"转换任务已排队: {job.source_file}，队列长度: {self.queue_depth}")
+        return job
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            self.waiting.remove(job)
+            self.running.append(job)
+            job.state = "running"
+            job.started_at = time.time()
+            print(f"开始转换: {job.source_file}，排队等待 {job.wait_time:.1f} 秒")
+            try:
+                result = await job.runner()
+                job.state = "failed" if result is False else "done"
+            except Exception as e:
+                print(f"转换任务出错: {e}")
+                job.state = "failed"
+            finally:
+                job.finished_at = time.time()
+                self.running.remove(job)
+                if job.state == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                job.done.set()
+                self.queue.task_done()
+
+    def get_stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "priority": self.priority,
+            "queue_depth": self.queue_depth,
+            "running": len(self.running),
+            "completed": self.completed,
+            "failed": self.failed
+        }
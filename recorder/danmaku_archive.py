@@ -0,0 +1,602 @@
+"""
+弹幕列式归档
+录制结束后把逐行JSON的 *_danmaku.jsonl 压缩成 *_danmaku.dca：
+常用字段各自一列（时间戳、价格等数值列用定长数组，用户名、cmd等重复多的字段用字典编码），
+体积最大的raw按块单独压缩。查询只读取用到的列，不需要解析每一行JSON。
+
+文件结构（和Parquet类似，元数据放在末尾）：
+    各列数据块 | 头部JSON（列的位置、编码、行数和统计信息） | 头部长度(u32) | MAGIC
+安装了zstandard时用zstd压缩，否则用标准库zlib，头部记录每个文件使用的压缩方式。
+"""
+import array
+import bisect
+import math
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from recorder.config import Config
+from recorder import json_codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'DCA1'
+TRAILER_STRUCT = struct.Struct('<I4s')
+JSONL_SUFFIX = '_danmaku.jsonl'
+ARCHIVE_SUFFIX = '_danmaku.dca'
+SUPER_CHAT_CMD = 'SUPER_CHAT_MESSAGE'
+
+# 单独成列的字段和编码方式，其余字段（以及类型不符合的值）放入extra列
+# f64：数值，缺失为NaN；dict：字典编码，编号0表示缺失；text：变长字符串
+COLUMNS = [
+    ('timestamp', 'f64'),
+    ('room_id', 'dict'),
+    ('cmd', 'dict'),
+    ('username', 'dict'),
+    ('content', 'text'),
+    ('price', 'f64'),
+    ('gift_name', 'dict'),
+    ('gift_count', 'f64'),
+    ('guard_level', 'f64'),
+]
+# 还原记录时的字段顺序，与DanmuClient写入时一致
+FIELD_ORDER = ['timestamp', 'room_id', 'cmd', 'raw', 'username', 'content', 'price', 'gift_name', 'gift_count', 'guard_level']
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_SUFFIX)
+
+def archive_path(danmaku_file):
+    """JSONL弹幕文件对应的归档文件路径"""
+    if danmaku_file.endswith(JSONL_SUFFIX):
+        return danmaku_file[:-len(JSONL_SUFFIX)] + ARCHIVE_SUFFIX
+    return danmaku_file + '.dca'
+
+def locate(danmaku_file):
+    """弹幕文件已经压缩归档时返回归档文件路径，否则原样返回"""
+    if not os.path.exists(danmaku_file) and danmaku_file.endswith(JSONL_SUFFIX):
+        archived = archive_path(danmaku_file)
+        if os.path.exists(archived):
+            return archived
+    return danmaku_file
+
+def _compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=Config.DANMU_ARCHIVE_LEVEL).compress(data)
+    return zlib.compress(data, Config.DANMU_ARCHIVE_LEVEL)
+
+def _decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("该弹幕归档使用zstd压缩，需要安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+class _DictColumn:
+    def __init__(self):
+        self.values = [None]
+        self.codes_by_value = {}
+        self.codes = array.array('I')
+
+    def add(self, value):
+        if value is None:
+            self.codes.append(0)
+            return
+        key = (type(value), value)
+        code = self.codes_by_value.get(key)
+        if code is None:
+            code = self.codes_by_value[key] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+class _TextColumn:
+    """
+    每行记录结束位置（累计字节数），任意一行都能直接定位：第i行为 data[ends[i-1]:ends[i]]
+    缺失的行记为 -1-结束位置（负数），结束位置不变
+    """
+    def __init__(self):
+        self.ends = array.array('q')
+        self.data = bytearray()
+
+    def add(self, value):
+        if value is None:
+            self.ends.append(-1 - len(self.data))
+            return
+        self.data += value.encode('utf-8')
+        self.ends.append(len(self.data))
+
+def _text_at(ends, data, row):
+    end = ends[row]
+    if end < 0:
+        return None
+    start = ends[row - 1] if row else 0
+    if start < 0:
+        start = -1 - start
+    return data[start:end].decode('utf-8')
+
+def _accepts(kind, value):
+    """值能否放进对应类型的列，放不进的（包括显式的null）原样保存在extra列"""
+    if kind == 'f64':
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if kind == 'dict':
+        return isinstance(value, (str, int)) and not isinstance(value, bool)
+    return isinstance(value, str)
+
+class ArchiveWriter:
+    """逐条追加记录，raw每凑够一块就压缩写出，其余列在finish时写出"""
+    def __init__(self, file, codec=None):
+        self.file = file
+        self.codec = codec or ('zstd' if zstandard is not None else 'zlib')
+        self.block_rows = Config.DANMU_ARCHIVE_BLOCK_ROWS
+        self.count = 0
+        self.numbers = {name: array.array('d') for name, kind in COLUMNS if kind == 'f64'}
+        self.ints = {name: True for name in self.numbers}
+        self.dicts = {name: _DictColumn() for name, kind in COLUMNS if kind == 'dict'}
+        self.texts = {name: _TextColumn() for name, kind in COLUMNS if kind == 'text'}
+        self.extra = _TextColumn()
+        self.raw_lengths = array.array('I')
+        self.raw_data = bytearray()
+        self.raw_blocks = []
+        # 每条记录在原JSONL文件中的行号，line_count为原文件的总行数
+        self.lines = array.array('q')
+        self.line_count = 0
+        self.cmd_counts = {}
+        self.price_max = None
+
+    def add(self, record, line=None):
+        """追加一条记录，line为它在原JSONL文件中的行号，默认紧接上一条"""
+        self.lines.append(self.line_count if line is None else line)
+        self.line_count = max(self.line_count, self.lines[-1] + 1)
+        extra = {}
+        for name, kind in COLUMNS:
+            value = record.get(name)
+            if value is not None and not _accepts(kind, value) or value is None and name in record:
+                extra[name] = value
+                value = None
+            if kind == 'f64':
+                if value is None:
+                    self.numbers[name].append(math.nan)
+                else:
+                    self.numbers[name].append(value)
+                    if isinstance(value, float):
+                        self.ints[name] = False
+            elif kind == 'dict':
+                self.dicts[name].add(value)
+            else:
+                self.texts[name].add(value)
+        for key, value in record.items():
+            if key != 'raw' and key not in self.numbers and key not in self.dicts and key not in self.texts:
+                extra[key] = value
+        self.extra.add(json_codec.dumps(extra) if extra else None)
+
+        raw = json_codec.dumps_bytes(record['raw']) if 'raw' in record else b''
+        # 长度0表示没有raw字段（raw编码后至少有1个字节）
+        self.raw_lengths.append(len(raw))
+        self.raw_data += raw
+        if len(self.raw_lengths) >= self.block_rows:
+            self._flush_raw()
+
+        cmd = record.get('cmd')
+        if isinstance(cmd, str):
+            cmd = cmd.split(':', 1)[0]
+            self.cmd_counts[cmd] = self.cmd_counts.get(cmd, 0) + 1
+            price = record.get('price')
+            if cmd == SUPER_CHAT_CMD and _accepts('f64', price):
+                self.price_max = price if self.price_max is None else max(self.price_max, price)
+        self.count += 1
+
+    def _write(self, data):
+        compressed = _compress(bytes(data), self.codec)
+        position = self.file.tell()
+        self.file.write(compressed)
+        return [position, len(compressed)]
+
+    def _flush_raw(self):
+        if not self.raw_lengths:
+            return
+        location = self._write(self.raw_lengths.tobytes() + self.raw_data)
+        self.raw_blocks.append(location + [len(self.raw_lengths)])
+        self.raw_lengths = array.array('I')
+        self.raw_data = bytearray()
+
+    def finish(self):
+        self._flush_raw()
+        columns = {}
+        for name, kind in COLUMNS:
+            if kind == 'f64':
+                columns[name] = {"kind": kind, "int": self.ints[name], "data": self._write(self.numbers[name].tobytes())}
+            elif kind == 'dict':
+                column = self.dicts[name]
+                columns[name] = {
+                    "kind": kind,
+                    "values": self._write(json_codec.dumps_bytes(column.values)),
+                    "codes": self._write(column.codes.tobytes())
+                }
+            else:
+                columns[name] = self._text_column(self.texts[name])
+        columns["extra"] = self._text_column(self.extra)
+        timestamps = [t for t in self.numbers['timestamp'] if not math.isnan(t)]
+        # 压缩时跳过了无法解析的行，行号和行序号对不上时才写出行号列
+        lines = None
+        if any(line != row for row, line in enumerate(self.lines)):
+            lines = self._write(self.lines.tobytes())
+        header = {
+            "version": 1,
+            "codec": self.codec,
+            "count": self.count,
+            "line_count": self.line_count,
+            "byteorder": sys.byteorder,
+            "columns": columns,
+            "lines": lines,
+            "raw_blocks": self.raw_blocks,
+            "stats": {
+                "t_min": min(timestamps) if timestamps else None,
+                "t_max": max(timestamps) if timestamps else None,
+                "cmd_counts": self.cmd_counts,
+                "sc_price_max": self.price_max
+            }
+        }
+        data = json_codec.dumps_bytes(header)
+        self.file.write(data)
+        self.file.write(TRAILER_STRUCT.pack(len(data), MAGIC))
+        return header
+
+    def _text_column(self, column):
+        return {"kind": "text", "ends": self._write(column.ends.tobytes()), "data": self._write(column.data)}
+
+def compact(danmaku_file, remove_source=True):
+    """
+    把JSONL弹幕文件压缩为列式归档（先写临时文件，完成后替换），成功后删除原文件
+    最后一行不完整或无法解析的行会被跳过，其余记录保留原来的行号。返回统计信息
+    """
+    start = time.perf_counter()
+    target = archive_path(danmaku_file)
+    tmp_path = target + '.tmp'
+    skipped = 0
+    source_bytes = os.path.getsize(danmaku_file)
+    with open(danmaku_file, 'rb') as source, open(tmp_path, 'wb') as f:
+        writer = ArchiveWriter(f)
+        line_no = 0
+        for line_no, line in enumerate(source, 1):
+            try:
+                record = json_codec.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(record, dict):
+                skipped += 1
+                continue
+            writer.add(record, line_no - 1)
+        writer.line_count = line_no
+        header = writer.finish()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, target)
+    forget(target)
+    if remove_source:
+        os.remove(danmaku_file)
+    archive_bytes = os.path.getsize(target)
+    return {
+        "archive_file": target,
+        "records": header["count"],
+        "skipped": skipped,
+        "source_bytes": source_bytes,
+        "archive_bytes": archive_bytes,
+        "ratio": round(source_bytes / archive_bytes, 2) if archive_bytes else None,
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+
+class DanmakuArchive:
+    """
+    打开的归档文件：头部在打开时读取，各列用到时才读取并解压，解压后的列保留在内存中
+    raw按块读取，只缓存最近用到的一块
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        with open(path, 'rb') as f:
+            f.seek(-TRAILER_STRUCT.size, os.SEEK_END)
+            header_length, magic = TRAILER_STRUCT.unpack(f.read(TRAILER_STRUCT.size))
+            if magic != MAGIC:
+                raise ValueError(f"不是弹幕归档文件: {path}")
+            f.seek(-TRAILER_STRUCT.size - header_length, os.SEEK_END)
+            self.header = json_codec.loads(f.read(header_length))
+        self.codec = self.header["codec"]
+        self.count = self.header["count"]
+        # 旧的归档没有记录行号，行号就是行序号
+        self.line_count = self.header.get("line_count", self.count)
+        self.line_numbers = None
+        self.stats = self.header["stats"]
+        self.columns = {}
+        self.arrays = {}
+        self.times = None
+        # 每个raw块的起始行号
+        self.block_starts = []
+        start = 0
+        for _, _, rows in self.header["raw_blocks"]:
+            self.block_starts.append(start)
+            start += rows
+        self.cached_block = (None, None)
+        self.lock = threading.Lock()
+
+    def _read(self, location):
+        position, length = location
+        with open(self.path, 'rb') as f:
+            f.seek(position)
+            return _decompress(f.read(length), self.codec)
+
+    def _array(self, typecode, location):
+        values = array.array(typecode)
+        values.frombytes(self._read(location))
+        if self.header["byteorder"] != sys.byteorder:
+            values.byteswap()
+        return values
+
+    def column_arrays(self, name):
+        """列的原始数组（不转换为Python对象），供扫描使用：f64为数值数组，dict为 (取值列表, 编号数组)"""
+        with self.lock:
+            arrays = self.arrays.get(name)
+            if arrays is None:
+                spec = self.header["columns"][name]
+                if spec["kind"] == 'f64':
+                    arrays = self._array('d', spec["data"])
+                elif spec["kind"] == 'dict':
+                    arrays = (json_codec.loads(self._read(spec["values"])), self._array('I', spec["codes"]))
+                else:
+                    arrays = (self._array('q', spec["ends"]), self._read(spec["data"]))
+                self.arrays[name] = arrays
+            return arrays
+
+    def _text_rows(self, name, rows):
+        """只取出文本列中指定行的内容"""
+        ends, data = self.column_arrays(name)
+        return [_text_at(ends, data, row) for row in rows]
+
+    def _value(self, name, row):
+        """只解码列中第row行的值（缺失为None），不把整列转换为Python对象"""
+        spec = self.header["columns"][name]
+        arrays = self.column_arrays(name)
+        if spec["kind"] == 'f64':
+            value = arrays[row]
+            if math.isnan(value):
+                return None
+            return int(value) if spec["int"] else value
+        if spec["kind"] == 'dict':
+            values, codes = arrays
+            return values[codes[row]]
+        ends, data = arrays
+        return _text_at(ends, data, row)
+
+    def _lines(self):
+        """各行在原JSONL文件中的行号，和行序号一致（没有行号列）时为None"""
+        location = self.header.get("lines")
+        if location is None:
+            return None
+        with self.lock:
+            if self.line_numbers is None:
+                self.line_numbers = self._array('q', location)
+            return self.line_numbers
+
+    def line_of(self, row):
+        """第row条记录在原JSONL文件中的行号"""
+        lines = self._lines()
+        return row if lines is None else lines[row]
+
+    def row_of(self, line):
+        """原JSONL文件第line行或其后第一条记录的行序号"""
+        lines = self._lines()
+        if lines is None:
+            return min(line, self.count)
+        return bisect.bisect_left(lines, line)
+
+    def column(self, name):
+        """解码后的整列，缺失的值为None（整列扫描用，取少量行用_value）"""
+        with self.lock:
+            values = self.columns.get(name)
+            if values is None:
+                values = self.columns[name] = self._decode(self.header["columns"][name])
+            return values
+
+    def _decode(self, spec):
+        kind = spec["kind"]
+        if kind == 'f64':
+            numbers = self._array('d', spec["data"])
+            if spec["int"]:
+                return [None if math.isnan(x) else int(x) for x in numbers]
+            return [None if math.isnan(x) else x for x in numbers]
+        if kind == 'dict':
+            values = json_codec.loads(self._read(spec["values"]))
+            return [values[code] for code in self._array('I', spec["codes"])]
+        ends = self._array('q', spec["ends"])
+        data = self._read(spec["data"])
+        return [_text_at(ends, data, row) for row in range(len(ends))]
+
+    def _raw_block(self, index):
+        with self.lock:
+            if self.cached_block[0] == index:
+                return self.cached_block[1]
+        position, length, rows = self.header["raw_blocks"][index]
+        data = self._read([position, length])
+        lengths = array.array('I')
+        lengths.frombytes(data[:rows * lengths.itemsize])
+        if self.header["byteorder"] != sys.byteorder:
+            lengths.byteswap()
+        items = []
+        offset = rows * lengths.itemsize
+        for length in lengths:
+            items.append(data[offset:offset + length] if length else None)
+            offset += length
+        with self.lock:
+            self.cached_block = (index, items)
+        return items
+
+    def _raw(self, row):
+        """第row条记录raw字段编码后的字节，没有raw字段时为None"""
+        index = bisect.bisect_right(self.block_starts, row) - 1
+        return self._raw_block(index)[row - self.block_starts[index]]
+
+    def raw(self, row):
+        """只解码第row条记录的raw字段，没有时返回None"""
+        if not self.header["raw_blocks"]:
+            return None
+        raw = self._raw(row)
+        return json_codec.loads(raw) if raw is not None else None
+
+    def _timeline(self):
+        """单调不减的时间戳列表，用于按时间二分（时钟回退时保持前一个值）"""
+        if self.times is None:
+            times = []
+            last = 0.0
+            for t in self.column_arrays('timestamp'):
+                # 缺失的时间戳为NaN，比较结果为False，保持前一个值
+                if t > last:
+                    last = t
+                times.append(last)
+            self.times = times
+        return self.times
+
+    def record(self, row):
+        """还原第row条记录，和写入JSONL时的内容一致"""
+        extra_text = self._value('extra', row)
+        extra = json_codec.loads(extra_text) if extra_text else {}
+        record = {}
+        for name in FIELD_ORDER:
+            if name == 'raw':
+                if self.header["raw_blocks"]:
+                    raw = self._raw(row)
+                    if raw is not None:
+                        record['raw'] = json_codec.loads(raw)
+                continue
+            value = self._value(name, row)
+            if value is not None:
+                record[name] = value
+            elif name in extra:
+                record[name] = extra.pop(name)
+        record.update(extra)
+        return record
+
+    def iter_records(self):
+        for row in range(self.count):
+            yield self.record(row)
+
+    def tail(self, limit):
+        if limit <= 0:
+            return []
+        return [self.record(row) for row in range(max(0, self.count - limit), self.count)]
+
+    def page(self, cursor=None, offset=None, limit=100, from_ts=None, to_ts=None):
+        """
+        和danmaku_index.page相同的分页接口，cursor为行序号，offset为原JSONL文件中的行号
+        游标的格式和校验由danmaku_index.page处理
+        """
+        if cursor is not None:
+            row = cursor
+        elif offset is not None:
+            row = self.row_of(offset)
+        elif from_ts is not None:
+            row = bisect.bisect_left(self._timeline(), from_ts)
+        else:
+            row = 0
+        timestamps = self.column_arrays('timestamp')
+        items = []
+        next_cursor = None
+        while row < self.count:
+            timestamp = timestamps[row]
+            if math.isnan(timestamp):
+                timestamp = 0
+            row += 1
+            if from_ts is not None and timestamp < from_ts:
+                continue
+            if to_ts is not None and timestamp > to_ts:
+                break
+            items.append(self.record(row - 1))
+            if len(items) >= limit:
+                next_cursor = row if row < self.count else None
+                break
+        return {"items": items, "next_cursor": next_cursor}
+
+    def super_chats(self, min_price=0, from_ts=None, to_ts=None):
+        """醒目留言（SC），只读取cmd、价格、时间、用户名和内容这几列"""
+        price_max = self.stats.get("sc_price_max")
+        if price_max is None or price_max < min_price:
+            return []
+        if from_ts is not None and self.stats["t_max"] is not None and self.stats["t_max"] < from_ts:
+            return []
+        if to_ts is not None and self.stats["t_min"] is not None and self.stats["t_min"] > to_ts:
+            return []
+        # 直接比较cmd的字典编号和价格数组，不把整列转换为Python对象；缺失的价格为NaN，比较结果总是False
+        cmd_values, cmd_codes = self.column_arrays('cmd')
+        sc_codes = {code for code, value in enumerate(cmd_values)
+                    if isinstance(value, str) and value.split(':', 1)[0] == SUPER_CHAT_CMD}
+        prices = self.column_arrays('price')
+        timestamps = self.column_arrays('timestamp')
+        rows = [
+            row for row, code in enumerate(cmd_codes)
+            if code in sc_codes and prices[row] >= min_price
+            and (from_ts is None or timestamps[row] >= from_ts)
+            and (to_ts is None or timestamps[row] <= to_ts)
+        ]
+        if not rows:
+            return []
+        price_is_int = self.header["columns"]["price"]["int"]
+        usernames, username_codes = self.column_arrays('username')
+        room_ids, room_codes = self.column_arrays('room_id')
+        contents = self._text_rows('content', rows)
+        return [{
+            "timestamp": timestamps[row],
+            "room_id": room_ids[room_codes[row]],
+            "username": usernames[username_codes[row]],
+            "content": content,
+            "price": int(prices[row]) if price_is_int else prices[row]
+        } for row, content in zip(rows, contents)]
+
+def super_chats_jsonl(danmaku_file, min_price=0, from_ts=None, to_ts=None):
+    """还没有归档的弹幕文件（录制中或旧文件）逐行扫描，先在原始字节中过滤cmd"""
+    needle = SUPER_CHAT_CMD.encode()
+    result = []
+    with open(danmaku_file, 'rb') as f:
+        for line in f:
+            if needle not in line or not line.endswith(b'\n'):
+                continue
+            try:
+                record = json_codec.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record.get('cmd'), str) or record['cmd'].split(':', 1)[0] != SUPER_CHAT_CMD:
+                continue
+            price = record.get('price')
+            timestamp = record.get('timestamp') or 0
+            if not _accepts('f64', price) or price < min_price:
+                continue
+            if (from_ts is not None and timestamp < from_ts) or (to_ts is not None and timestamp > to_ts):
+                continue
+            result.append({key: record.get(key) for key in ("timestamp", "room_id", "username", "content", "price")})
+    return result
+
+_archives = OrderedDict()
+_archives_lock = threading.Lock()
+
+def get_archive(path):
+    """打开的归档按路径缓存（最多DANMU_ARCHIVE_CACHE个），文件被替换后重新打开"""
+    key = os.path.abspath(path)
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive is not None and archive.mtime_ns == mtime_ns:
+            _archives.move_to_end(key)
+            return archive
+    archive = DanmakuArchive(path)
+    with _archives_lock:
+        _archives[key] = archive
+        while len(_archives) > Config.DANMU_ARCHIVE_CACHE:
+            _archives.popitem(last=False)
+    return archive
+
+def forget(path):
+    with _archives_lock:
+        _archives.pop(os.path.abspath(path), None)
@@ -0,0 +1,297 @@
+"""
+弹幕热度统计
+按录制的媒体时间（相对t0，不含断线空档）每秒统计弹幕数、礼物数、SC数和付费金额，
+保存为会话旁边的 *_heatmap.json；并找出热度明显高于平时的时间段，作为剪辑候选。
+已归档的会话只读取时间、cmd、价格几列（礼物只解码对应行的raw），安装了numpy时整列计算每行所在的秒再用bincount累加；
+录制中的会话按弹幕文件增量统计，每次只读取新增的行。
+"""
+import math
+import os
+import threading
+import time
+from recorder.config import Config
+from recorder import json_codec
+from recorder import danmaku_archive
+from recorder.session_meta import session_timeline, media_offset, in_gap
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SERIES = ("danmaku", "gifts", "gift_value", "sc", "sc_value")
+# cmd -> 统计类别
+KINDS = {
+    'DANMU_MSG': 'danmaku',
+    'SEND_GIFT': 'gift',
+    'GUARD_BUY': 'gift',
+    'SUPER_CHAT_MESSAGE': 'sc'
+}
+
+def heatmap_path(base_name):
+    return f"{base_name}_heatmap.json"
+
+def _kind(cmd):
+    return KINDS.get(cmd.split(':', 1)[0]) if isinstance(cmd, str) else None
+
+def gift_value(raw):
+    """礼物和上舰的金额（元）：1000金瓜子为1元，银瓜子礼物不计"""
+    data = raw.get('data') if isinstance(raw, dict) else None
+    if not isinstance(data, dict):
+        return 0.0
+    try:
+        if raw.get('cmd') == 'GUARD_BUY':
+            return (data.get('price') or 0) * (data.get('num') or 1) / 1000
+        if data.get('coin_type') != 'gold':
+            return 0.0
+        return (data.get('total_coin') or (data.get('price') or 0) * (data.get('num') or 0)) / 1000
+    except TypeError:
+        return 0.0
+
+class HeatmapBuilder:
+    """
+    逐条累加到每秒的统计中；offset记录已经读到的弹幕文件位置（增量统计用）
+    只统计到会话结束的时刻，时间戳异常的弹幕不会把统计数组撑大
+    """
+    def __init__(self, timeline, end):
+        self.series = {name: [] for name in SERIES}
+        self.records = 0
+        self.offset = 0
+        self.set_timeline(timeline, end)
+
+    def set_timeline(self, timeline, end):
+        self.timeline = timeline
+        self.last_second = int(media_offset(timeline, end))
+
+    def add(self, timestamp, kind, price=None, raw=None):
+        # 断线空档内的弹幕没有对应的画面，不计入（否则会全部堆在空档开始的那一秒）
+        second = int(media_offset(self.timeline, timestamp))
+        if second < 0 or second > self.last_second or in_gap(self.timeline, timestamp):
+            return
+        missing = second + 1 - len(self.series["danmaku"])
+        if missing > 0:
+            for values in self.series.values():
+                values.extend([0] * missing)
+        self.records += 1
+        if kind == 'danmaku':
+            self.series["danmaku"][second] += 1
+        elif kind == 'gift':
+            self.series["gifts"][second] += 1
+            if raw is not None:
+                self.series["gift_value"][second] += gift_value(raw)
+        else:
+            self.series["sc"][second] += 1
+            if isinstance(price, (int, float)) and not math.isnan(price):
+                self.series["sc_value"][second] += price
+
+    def add_record(self, record):
+        kind = _kind(record.get('cmd'))
+        timestamp = record.get('timestamp')
+        if kind and isinstance(timestamp, (int, float)):
+            self.add(timestamp, kind, record.get('price'), record.get('raw'))
+
+    def result(self):
+        series = {
+            name: [round(value, 2) for value in values] if name.endswith('_value') else values
+            for name, values in self.series.items()
+        }
+        return {
+            "version": 1,
+            "bin_seconds": 1,
+            "t0": self.timeline["t0"],
+            "duration": len(series["danmaku"]),
+            "records": self.records,
+            "totals": {name: round(sum(values), 2) for name, values in series.items()},
+            "series": series,
+            "highlights": detect_highlights(series)
+        }
+
+def detect_highlights(series, window=None, limit=None):
+    """
+    热度峰值：每秒的热度 = 弹幕数 + SC数×权重 + 金额（元）×权重，按window秒滑动求和，
+    超过全场中位数HIGHLIGHT_MIN_RATIO倍的窗口按热度从高到低取互不重叠的前limit个。
+    起点提前HIGHLIGHT_PRE_ROLL秒（弹幕的反应总是晚于画面）
+    """
+    window = window or Config.HIGHLIGHT_WINDOW
+    limit = limit or Config.HIGHLIGHT_MAX
+    length = len(series["danmaku"])
+    if not length:
+        return []
+    scores = [
+        series["danmaku"][i] + series["sc"][i] * Config.HIGHLIGHT_SC_WEIGHT
+        + (series["gift_value"][i] + series["sc_value"][i]) * Config.HIGHLIGHT_VALUE_WEIGHT
+        for i in range(length)
+    ]
+    window = min(window, length)
+    # 前缀和求每个窗口的总热度
+    prefix = [0.0]
+    for score in scores:
+        prefix.append(prefix[-1] + score)
+    sums = [prefix[i + window] - prefix[i] for i in range(length - window + 1)]
+    baseline = sorted(sums)[len(sums) // 2]
+    threshold = max(baseline * Config.HIGHLIGHT_MIN_RATIO, Config.HIGHLIGHT_MIN_SCORE)
+
+    highlights = []
+    for start in sorted(range(len(sums)), key=lambda i: sums[i], reverse=True):
+        if sums[start] < threshold or len(highlights) >= limit:
+            break
+        if any(abs(start - item["window_start"]) < window for item in highlights):
+            continue
+        end = start + window
+        peak = max(range(start, end), key=lambda i: scores[i])
+        highlights.append({
+            "window_start": start,
+            "start": max(0, start - Config.HIGHLIGHT_PRE_ROLL),
+            "end": end,
+            "peak": peak,
+            "score": round(sums[start], 1),
+            "ratio": round(sums[start] / baseline, 1) if baseline else None,
+            "danmaku": sum(series["danmaku"][start:end]),
+            "gifts": sum(series["gifts"][start:end]),
+            "sc": sum(series["sc"][start:end]),
+            "value": round(sum(series["gift_value"][start:end]) + sum(series["sc_value"][start:end]), 2)
+        })
+    for rank, item in enumerate(highlights, 1):
+        item["rank"] = rank
+        del item["window_start"]
+    return highlights
+
+def _session_end(timeline, danmaku_file):
+    """会话结束的时刻；较早的录制元数据中没有结束时间，用弹幕文件最后写入的时间"""
+    if timeline.get("end"):
+        return timeline["end"]
+    return os.path.getmtime(danmaku_file)
+
+def _build_from_archive(archive, timeline, end):
+    if np is not None:
+        return _bin_archive(archive, timeline, end)
+    builder = HeatmapBuilder(timeline, end)
+    timestamps = archive.column_arrays('timestamp')
+    cmd_values, cmd_codes = archive.column_arrays('cmd')
+    prices = archive.column_arrays('price')
+    kinds = [_kind(value) for value in cmd_values]
+    for row, code in enumerate(cmd_codes):
+        kind = kinds[code]
+        if kind is None or math.isnan(timestamps[row]):
+            continue
+        builder.add(timestamps[row], kind, prices[row], archive.raw(row) if kind == 'gift' else None)
+    return builder
+
+def _bin_archive(archive, timeline, end):
+    """
+    _build_from_archive的numpy版本，结果相同：按media_offset/in_gap的规则整列换算媒体时间并过滤，
+    各统计量用bincount按秒累加（累加顺序和逐行相同）
+    """
+    builder = HeatmapBuilder(timeline, end)
+    timestamps = np.frombuffer(archive.column_arrays('timestamp'), dtype=np.float64)
+    cmd_values, cmd_codes = archive.column_arrays('cmd')
+    prices = np.frombuffer(archive.column_arrays('price'), dtype=np.float64)
+    # 类别编号：0为不统计，1弹幕，2礼物，3SC
+    kind_ids = {'danmaku': 1, 'gift': 2, 'sc': 3}
+    kinds = np.array([kind_ids.get(_kind(value), 0) for value in cmd_values], dtype=np.int8)
+    kinds = kinds[np.frombuffer(cmd_codes, dtype=np.uint32)]
+    keep = (kinds > 0) & ~np.isnan(timestamps)
+
+    # 空档内的弹幕不计入，空档之后的时刻减去此前所有空档的时长
+    shift = np.zeros(len(timestamps))
+    gap_shift = 0
+    for gap in timeline["gaps"]:
+        gap_start = timeline["t0"] + gap["at"] + gap_shift
+        gap_end = gap_start + gap["seconds"]
+        keep &= ~((timestamps >= gap_start) & (timestamps < gap_end))
+        shift += np.where(timestamps >= gap_end, gap["seconds"], 0)
+        gap_shift += gap["seconds"]
+    # 和int()一样向0取整
+    seconds = np.trunc(timestamps - timeline["t0"] - shift)
+    keep &= (seconds >= 0) & (seconds <= builder.last_second)
+    rows = np.flatnonzero(keep)
+    if not len(rows):
+        return builder
+
+    seconds = seconds[rows].astype(np.int64)
+    kinds = kinds[rows]
+    length = int(seconds.max()) + 1
+    sc_prices = np.nan_to_num(prices[rows], nan=0.0)
+    gift_rows = rows[kinds == 2]
+    gift_values = [gift_value(raw) if raw is not None else 0.0 for raw in map(archive.raw, gift_rows.tolist())]
+
+    def count(kind, weights=None):
+        mask = kinds == kind
+        return np.bincount(seconds[mask], weights=weights, minlength=length).tolist()
+
+    builder.series = {
+        "danmaku": count(1),
+        "gifts": count(2),
+        "gift_value": count(2, np.array(gift_values, dtype=np.float64)),
+        "sc": count(3),
+        "sc_value": count(3, sc_prices[kinds == 3])
+    }
+    builder.records = len(rows)
+    return builder
+
+def _read_new_lines(builder, danmaku_file):
+    """从上次读到的位置继续读取完整的行（最后一行可能正在写入）"""
+    with open(danmaku_file, 'rb') as f:
+        f.seek(builder.offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            builder.offset += len(line)
+            try:
+                record = json_codec.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                builder.add_record(record)
+
+def compute(base_name, danmaku_file):
+    """统计整个会话并写入热度文件，无法确定t0时返回None"""
+    timeline = session_timeline(base_name)
+    if timeline is None:
+        return None
+    end = _session_end(timeline, danmaku_file)
+    if danmaku_archive.is_archive(danmaku_file):
+        builder = _build_from_archive(danmaku_archive.get_archive(danmaku_file), timeline, end)
+    else:
+        builder = HeatmapBuilder(timeline, end)
+        _read_new_lines(builder, danmaku_file)
+    result = builder.result()
+    path = heatmap_path(base_name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(json_codec.dumps_bytes(result))
+    os.replace(tmp_path, path)
+    # 录制结束后不再需要增量统计的状态（此时弹幕文件可能已经归档）
+    with _live_lock:
+        _live.pop(os.path.abspath(base_name + danmaku_archive.JSONL_SUFFIX), None)
+    return result
+
+_live = {}
+_live_lock = threading.Lock()
+
+def load(base_name, danmaku_file, live=False):
+    """
+    返回会话的热度统计
+    录制中（live）的会话增量统计，不写文件；已结束的会话优先读取比弹幕文件新的热度文件，否则重新统计并保存
+    """
+    if live:
+        timeline = session_timeline(base_name)
+        if timeline is None:
+            return None
+        key = os.path.abspath(danmaku_file)
+        with _live_lock:
+            builder = _live.get(key)
+            if builder is None:
+                builder = _live[key] = HeatmapBuilder(timeline, time.time())
+            # 断线重连会增加空档，之后的弹幕按新的时间轴统计；录制中的会话统计到当前时刻
+            builder.set_timeline(timeline, time.time())
+            _read_new_lines(builder, danmaku_file)
+            return builder.result()
+    path = heatmap_path(base_name)
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(danmaku_file):
+            with open(path, 'rb') as f:
+                return json_codec.loads(f.read())
+    except (OSError, ValueError):
+        pass
+    return compute(base_name, danmaku_file)
@@ -0,0 +1,300 @@
+import bisect
+import os
+import struct
+import threading
+from recorder.config import Config
+from recorder import json_codec
+from recorder import danmaku_archive
+
+# 索引项：(行号, 该行在弹幕文件中的字节偏移, 该行的时间戳)，定长，只追加
+INDEX_STRUCT = struct.Struct('<QQd')
+TAIL_BLOCK_SIZE = 64 * 1024
+# 分页游标的前缀：JSONL文件为字节偏移，归档文件为行序号
+JSONL_CURSOR = 'j:'
+ARCHIVE_CURSOR = 'a:'
+
+class CursorError(Exception):
+    """分页游标格式不对，或者和弹幕文件对不上（例如翻页途中弹幕文件被归档）"""
+
+def index_path(danmaku_file):
+    """弹幕文件对应的索引文件路径"""
+    return danmaku_file + '.idx'
+
+class IndexBuilder:
+    """
+    在写入弹幕时同步生成索引：每index_every行和时间轴上每一秒的第一行各记一项
+    由DanmuWriter调用，offset和line_no始终指向下一行的开头
+    """
+    def __init__(self, offset=0, line_no=0, last_second=None, index_every=None):
+        self.offset = offset
+        self.line_no = line_no
+        self.last_second = last_second
+        self.index_every = index_every or Config.DANMU_INDEX_EVERY_LINES
+        self.pending = []
+
+    def add(self, line, timestamp):
+        second = int(timestamp or 0)
+        if self.line_no % self.index_every == 0 or second != self.last_second:
+            self.pending.append(INDEX_STRUCT.pack(self.line_no, self.offset, timestamp or 0.0))
+            self.last_second = second
+        self.offset += len(line)
+        self.line_no += 1
+
+    def take(self):
+        """取出尚未写入索引文件的索引项"""
+        data = b''.join(self.pending)
+        self.pending = []
+        return data
+
+def build_index(danmaku_file):
+    """
+    扫描整个弹幕文件重新生成索引（用于没有索引的旧文件，只需执行一次）
+    返回扫描结束时的IndexBuilder，可以继续追加
+    """
+    builder = IndexBuilder()
+    with open(danmaku_file, 'rb') as f, open(index_path(danmaku_file), 'wb') as idx:
+        _index_lines(builder, f, idx)
+    return builder
+
+def _line_timestamp(line):
+    try:
+        return json_codec.loads(line).get('timestamp')
+    except (ValueError, AttributeError):
+        return None
+
+def _index_lines(builder, f, idx):
+    """从f的当前位置读到最后一个完整的行，索引项写入idx"""
+    for line in f:
+        if not line.endswith(b'\n'):
+            # 最后一行不完整，不计入索引
+            break
+        timestamp = _line_timestamp(line)
+        builder.add(line, timestamp if timestamp is not None else builder.last_second)
+        if len(builder.pending) >= 1024:
+            idx.write(builder.take())
+    idx.write(builder.take())
+
+def _resume_index(danmaku_file, size):
+    """
+    从已有索引的最后一项继续：核对该项在弹幕文件中的位置（在文件范围内、和前一项之间的行数一致、
+    时间戳一致），只补上其后的行；索引不存在或和弹幕文件对不上时返回None
+    """
+    path = index_path(danmaku_file)
+    try:
+        index_size = os.path.getsize(path)
+    except OSError:
+        return None
+    if index_size == 0 or index_size % INDEX_STRUCT.size:
+        return None
+    with open(path, 'rb') as idx:
+        idx.seek(max(0, index_size - 2 * INDEX_STRUCT.size))
+        entries = list(INDEX_STRUCT.iter_unpack(idx.read()))
+    line_no, offset, timestamp = entries[-1]
+    # 第一项总是第0行
+    prev_line, prev_offset = entries[0][:2] if len(entries) > 1 else (0, 0)
+    if offset >= size or prev_offset > offset:
+        return None
+    with open(danmaku_file, 'rb') as f:
+        f.seek(prev_offset)
+        between = f.read(offset - prev_offset)
+        if between.count(b'\n') != line_no - prev_line or (between and not between.endswith(b'\n')):
+            return None
+        line = f.readline()
+        if not line.endswith(b'\n'):
+            return None
+        recorded = _line_timestamp(line)
+        if recorded is not None and recorded != timestamp:
+            return None
+        # 和重建索引时扫描到这一行之后的状态一致
+        builder = IndexBuilder(offset + len(line), line_no + 1, int(timestamp))
+        with open(path, 'ab') as idx:
+            _index_lines(builder, f, idx)
+    return builder
+
+def load_builder(danmaku_file):
+    """继续写入已有弹幕文件时，恢复行号和偏移（索引缺失或不一致时重建）"""
+    size = os.path.getsize(danmaku_file) if os.path.exists(danmaku_file) else 0
+    if size == 0:
+        with open(index_path(danmaku_file), 'wb'):
+            pass
+        return IndexBuilder()
+    builder = _resume_index(danmaku_file, size)
+    if builder is None:
+        builder = build_index(danmaku_file)
+    return builder
+
+class DanmakuIndex:
+    """
+    已加载到内存的索引，按行号和时间戳二分查找
+    索引文件只追加，再次访问时只读取新增的部分
+    """
+    def __init__(self, danmaku_file):
+        self.danmaku_file = danmaku_file
+        self.index_file = index_path(danmaku_file)
+        self.loaded_bytes = 0
+        self.lines = []
+        self.offsets = []
+        self.times = []
+        self.lock = threading.Lock()
+
+    def update(self):
+        with self.lock:
+            if not os.path.exists(self.index_file):
+                build_index(self.danmaku_file)
+            size = os.path.getsize(self.index_file)
+            size -= size % INDEX_STRUCT.size
+            if size < self.loaded_bytes:
+                # 索引被重建过，重新加载
+                self.loaded_bytes = 0
+                self.lines, self.offsets, self.times = [], [], []
+            if size == self.loaded_bytes:
+                return
+            with open(self.index_file, 'rb') as f:
+                f.seek(self.loaded_bytes)
+                data = f.read(size - self.loaded_bytes)
+            for line_no, offset, timestamp in INDEX_STRUCT.iter_unpack(data):
+                self.lines.append(line_no)
+                self.offsets.append(offset)
+                # 时间戳可能因为时钟调整略有回退，保持单调便于二分
+                self.times.append(max(timestamp, self.times[-1]) if self.times else timestamp)
+            self.loaded_bytes = size
+
+    def seek_line(self, line_no):
+        """返回不晚于line_no的最近索引项 (行号, 偏移)"""
+        i = bisect.bisect_right(self.lines, line_no) - 1
+        if i < 0:
+            return 0, 0
+        return self.lines[i], self.offsets[i]
+
+    def seek_time(self, timestamp):
+        """返回时间戳不晚于timestamp的最近索引项的偏移"""
+        i = bisect.bisect_left(self.times, timestamp) - 1
+        if i < 0:
+            return 0
+        return self.offsets[i]
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def discard(danmaku_file):
+    """弹幕文件归档后删除它的索引"""
+    with _indexes_lock:
+        _indexes.pop(os.path.abspath(danmaku_file), None)
+    try:
+        os.remove(index_path(danmaku_file))
+    except FileNotFoundError:
+        pass
+
+def get_index(danmaku_file):
+    key = os.path.abspath(danmaku_file)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = DanmakuIndex(danmaku_file)
+    index.update()
+    return index
+
+def _parse(line):
+    try:
+        return json_codec.loads(line)
+    except ValueError:
+        return None
+
+def tail(danmaku_file, limit):
+    """从文件末尾倒着按块读取最后limit条弹幕，不需要读取整个文件"""
+    if danmaku_archive.is_archive(danmaku_file):
+        return danmaku_archive.get_archive(danmaku_file).tail(limit)
+    if limit <= 0:
+        return []
+    with open(danmaku_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        # 多读一个换行，保证第一行是完整的
+        while position > 0 and data.count(b'\n') <= limit:
+            read_size = min(TAIL_BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    lines = data.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    if position > 0:
+        lines = lines[1:]
+    items = [_parse(line) for line in lines[-limit:] if line]
+    return [item for item in items if item is not None]
+
+def _cursor_position(cursor, prefix):
+    if not isinstance(cursor, str) or not cursor.startswith(prefix):
+        raise CursorError("分页游标和弹幕文件不匹配，请从头重新读取")
+    try:
+        position = int(cursor[len(prefix):])
+    except ValueError:
+        raise CursorError("分页游标格式无效")
+    if position < 0:
+        raise CursorError("分页游标格式无效")
+    return position
+
+def page(danmaku_file, cursor=None, offset=None, limit=100, from_ts=None, to_ts=None):
+    """
+    分页读取弹幕
+    cursor为上一页返回的next_cursor，offset为起始行号，二者都没有时从头开始；
+    from_ts/to_ts按时间范围过滤，用索引直接定位到起始位置。
+    返回 {"items": [...], "next_cursor": 下一页的cursor，读完时为None}
+    cursor形如 "j:字节偏移"，已归档的弹幕文件交给danmaku_archive读取，cursor形如 "a:行序号"；
+    游标和文件对不上（类型不同、超出范围、不在行首）时抛出CursorError
+    """
+    if danmaku_archive.is_archive(danmaku_file):
+        archive = danmaku_archive.get_archive(danmaku_file)
+        row = None
+        if cursor is not None:
+            row = _cursor_position(cursor, ARCHIVE_CURSOR)
+            if row > archive.count:
+                raise CursorError("分页游标已失效，请从头重新读取")
+        result = archive.page(row, offset, limit, from_ts, to_ts)
+        if result["next_cursor"] is not None:
+            result["next_cursor"] = f"{ARCHIVE_CURSOR}{result['next_cursor']}"
+        return result
+    index = get_index(danmaku_file)
+    skip_lines = 0
+    if cursor is not None:
+        position = _cursor_position(cursor, JSONL_CURSOR)
+    elif offset is not None:
+        line_no, position = index.seek_line(offset)
+        skip_lines = offset - line_no
+    elif from_ts is not None:
+        position = index.seek_time(from_ts)
+    else:
+        position = 0
+
+    items = []
+    next_cursor = None
+    with open(danmaku_file, 'rb') as f:
+        if cursor is not None:
+            # 游标必须指向某一行的开头
+            f.seek(max(0, position - 1))
+            if position > 0 and f.read(1) != b'\n':
+                raise CursorError("分页游标已失效，请从头重新读取")
+        f.seek(position)
+        while True:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # 文件末尾（或者正在写入的不完整行）
+                break
+            position += len(line)
+            if skip_lines:
+                skip_lines -= 1
+                continue
+            item = _parse(line)
+            if item is None:
+                continue
+            timestamp = item.get('timestamp') or 0
+            if from_ts is not None and timestamp < from_ts:
+                continue
+            if to_ts is not None and timestamp > to_ts:
+                break
+            items.append(item)
+            if len(items) >= limit:
+                next_cursor = f"{JSONL_CURSOR}{position}"
+                break
+    return {"items": items, "next_cursor": next_cursor}
@@ -1,37 +1,161 @@
 import asyncio
 import json
+import re
 import time
 import struct
 import zlib
-import aiofiles
 import websockets
-import threading
+from recorder.config import Config
+from recorder.danmu_writer import DanmuWriter
+from recorder import json_codec
+
+# brotli为可选依赖，安装后使用protover 3（brotli压缩），否则回退到protover 2（zlib压缩）
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# 数据包头部格式（16字节，大端序）：
+# 数据包总长度(4字节)、头部长度(2字节)、协议版本(2字节)、操作码(4字节)、序列号(4字节)
+HEADER_STRUCT = struct.Struct('>IHHII')
+HEADER_LEN = HEADER_STRUCT.size
+
+# 协议版本：0为未压缩JSON，1为心跳回复等整数数据，2为zlib压缩，3为brotli压缩
+PROTO_JSON = 0
+PROTO_ZLIB = 2
+PROTO_BROTLI = 3
+
+# 操作码：2心跳包，3心跳回复（人气值），5通知包（弹幕、礼物等），7认证包，8认证回复
+OP_NOTIFY = 5
+
+def iter_notify_bodies(message):
+    """
+    逐个产出一帧数据中所有通知包(op=5)的JSON数据体（memoryview，不复制）
+    使用memoryview + unpack_from遍历数据包，压缩包解压后压栈继续处理，
+    不使用递归，也不对数据做切片复制，并保持消息原有顺序。
+    """
+    stack = [(memoryview(message), 0)]
+    while stack:
+        buf, offset = stack.pop()
+        end = len(buf)
+        while offset + HEADER_LEN <= end:
+            packet_len, header_len, proto_ver, op_code, _ = HEADER_STRUCT.unpack_from(buf, offset)
+            next_offset = offset + packet_len
+            if packet_len < HEADER_LEN or header_len > packet_len or next_offset > end:
+                # 数据包长度异常，丢弃本帧剩余数据
+                break
+            
+            if op_code == OP_NOTIFY:
+                body = buf[offset + header_len:next_offset]
+                if proto_ver == PROTO_JSON:
+                    yield body
+                elif proto_ver in (PROTO_ZLIB, PROTO_BROTLI):
+                    try:
+                        if proto_ver == PROTO_ZLIB:
+                            inner = zlib.decompress(body)
+                        elif brotli is not None:
+                            inner = brotli.decompress(body)
+                        else:
+                            print("收到brotli压缩数据，但未安装brotli模块")
+                            inner = None
+                    except Exception as e:
+                        print(f"解压数据失败: {e}")
+                        inner = None
+                    if inner:
+                        # 先保存当前位置，解压出的数据处理完后再继续处理本帧剩余的数据包
+                        stack.append((buf, next_offset))
+                        stack.append((memoryview(inner), 0))
+                        break
+            
+            # 移动到下一个包
+            offset = next_offset
+
+# 在原始字节中匹配顶层的cmd字段（B站的通知包中cmd总是第一个键），无需解析整个JSON
+CMD_PATTERN = re.compile(rb'\s*\{\s*"cmd"\s*:\s*"([^"\\]*)"')
+
+class CmdFilter:
+    """
+    按cmd过滤弹幕消息，并统计每种cmd保留/丢弃的数量
+    cmd带有后缀时（如"DANMU_MSG:4:0:2:2:2:0"）按冒号前的部分匹配
+    """
+    def __init__(self, allow=None, deny=None):
+        # allow为空表示不限制，deny优先于allow
+        self.allow = set(allow) if allow else None
+        self.deny = set(deny or ())
+        self.stats = {}  # cmd -> [保留数, 丢弃数]
+        self._decisions = {}  # 原始cmd -> (cmd, 是否保留)
+
+    @staticmethod
+    def peek_cmd(body):
+        """从原始字节中取出cmd，取不到时返回None（需要完整解析）"""
+        match = CMD_PATTERN.match(body)
+        return match.group(1) if match else None
+
+    def accept(self, raw_cmd):
+        """判断是否保留该cmd，raw_cmd可以是bytes或str"""
+        decision = self._decisions.get(raw_cmd)
+        if decision is None:
+            cmd = raw_cmd.decode('utf-8', 'replace') if isinstance(raw_cmd, bytes) else str(raw_cmd)
+            cmd = cmd.split(':', 1)[0]
+            keep = cmd not in self.deny and (self.allow is None or cmd in self.allow)
+            decision = (cmd, keep)
+            if len(self._decisions) < 1024:
+                self._decisions[raw_cmd] = decision
+        cmd, keep = decision
+        counts = self.stats.get(cmd)
+        if counts is None:
+            counts = self.stats[cmd] = [0, 0]
+        counts[0 if keep else 1] += 1
+        return keep
+
+    def get_stats(self):
+        return {cmd: {"kept": counts[0], "dropped": counts[1]} for cmd, counts in dict(self.stats).items()}
 
 class DanmuClient:
-    def __init__(self, room_id, output_file):
+    log_heartbeat = True  # 每次发送心跳时打印日志
+
+    def __init__(self, room_id, output_file, cmd_filter=None, search_index=None):
         self.room_id = room_id
         self.output_file = output_file
         self.ws = None
         self.heartbeat_task = None
         self.running = False
         self.heartbeat_interval = 30  # 心跳间隔（秒）
-        self.loop = None
-        self.websocket_task = None
-        
-    def start(self):
-        self.running = True
-        # 在新线程中运行事件循环
-        self.thread = threading.Thread(target=self._run_async_loop)
-        self.thread.daemon = True
-        self.thread.start()
+        self.reconnect_delay = Config.DANMU_RECONNECT_DELAY  # 掉线重连间隔（秒）
+        self.loop = None  # 由DanmuHub分配的共享事件循环
+        self.stop_event = None
+        self.writer = DanmuWriter(output_file)
+        self.cmd_filter = cmd_filter or CmdFilter(Config.DANMU_CMD_ALLOW, Config.DANMU_CMD_DENY)
+        self.search_index = search_index  # 弹幕搜索索引，写入的弹幕同时交给索引线程
         
-    def _run_async_loop(self):
-        # 创建新的事件循环
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        # 运行WebSocket连接任务
-        self.websocket_task = self.loop.create_task(self._connect())
-        self.loop.run_forever()
+    async def run(self):
+        # 在DanmuHub的共享事件循环中运行，掉线后自动重连，直到录制任务结束
+        self.stop_event = asyncio.Event()
+        self.writer.open()
+        if self.search_index:
+            self.search_index.open(self.output_file, self.room_id, self.writer.index_builder.line_no)
+        try:
+            await self._connect_loop()
+        finally:
+            # 写入缓冲区中剩余的弹幕并关闭文件
+            await self.writer.close()
+            if self.search_index:
+                self.search_index.close(self.output_file)
+        print(f"弹幕客户端任务结束，直播间 {self.room_id}")
+    
+    async def _connect_loop(self):
+        while self.running:
+            await self._connect()
+            if self.running:
+                print(f"{self.reconnect_delay}秒后重连直播间 {self.room_id} 的弹幕服务器")
+                try:
+                    # 等待重连间隔，期间收到停止信号则立即退出
+                    await asyncio.wait_for(self.stop_event.wait(), timeout=self.reconnect_delay)
+                except asyncio.TimeoutError:
+                    pass
         
     async def _connect(self):
         # B站弹幕服务器地址
@@ -83,8 +207,6 @@ class DanmuClient:
             if self.heartbeat_task:
                 self.heartbeat_task.cancel()
                 
-        print(f"弹幕客户端任务结束，直播间 {self.room_id}")
-                
     async def _send_auth(self):
         # 创建认证包
         auth_packet = self._create_auth_packet()
@@ -102,7 +224,7 @@ class DanmuClient:
         auth_info = {
             "uid": 0,
             "roomid": int(self.room_id),
-            "protover": 2,  # 协议版本
+            "protover": PROTO_BROTLI if brotli is not None else PROTO_ZLIB,  # 协议版本（决定服务器下发数据的压缩方式）
             "platform": "web",
             "clientver": "1.14.3",
             "type": 2
@@ -135,7 +257,8 @@ class DanmuClient:
                 heartbeat_packet = self._create_heartbeat_packet()
                 if self.ws and not self.ws.closed:
                     await self.ws.send(heartbeat_packet)
-                    print(f"已发送心跳包到直播间 {self.room_id}")
+                    if self.log_heartbeat:
+                        print(f"已发送心跳包到直播间 {self.room_id}")
             except Exception as e:
                 print(f"发送心跳包出错: {e}")
             
@@ -160,55 +283,28 @@ class DanmuClient:
         
     async def _parse_danmu_message(self, message):
         # 解析弹幕消息
-        offset = 0
-        while offset < len(message):
-            # 解析头部
-            if len(message) < offset + 16:
-                break
-                
-            # 解析头部信息
-            header = message[offset:offset+16]
-            packet_len, header_len, proto_ver, op_code, seq_id = struct.unpack('>IHHII', header)
-            
-            # 获取数据体
-            body = message[offset+header_len:offset+packet_len]
-            
-            # 根据操作码处理不同类型的包
-            if op_code == 5:  # 通知包（弹幕、礼物等）
-                if proto_ver == 2:  # 压缩过的数据
-                    # 解压数据
-                    try:
-                        uncompressed_body = zlib.decompress(body)
-                        # 递归解析解压后的数据
-                        await self._parse_danmu_message(uncompressed_body)
-                    except zlib.error as e:
-                        print(f"解压数据失败: {e}")
-                elif proto_ver == 0:  # 未压缩的数据
-                    # 解析JSON数据
-                    try:
-                        data = json.loads(body.decode('utf-8'))
-                        # 保存弹幕数据
-                        await self._save_danmu_data(data)
-                    except Exception as e:
-                        print(f"解析弹幕数据出错: {e}")
-            
-            # 移动到下一个包
-            offset += packet_len
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        cmd_filter = self.cmd_filter
+        for body in iter_notify_bodies(message):
+            # 先在原始字节中取出cmd，不需要的消息直接丢弃，不做完整的JSON解析
+            raw_cmd = cmd_filter.peek_cmd(body)
+            if raw_cmd is not None and not cmd_filter.accept(raw_cmd):
+                continue
+            # 解析JSON数据
+            try:
+                data = json_codec.loads(body)
+                if raw_cmd is None and not cmd_filter.accept(data.get('cmd', '')):
+                    continue
+                # 保存弹幕数据
+                await self._save_danmu_data(data)
+            except Exception as e:
+                print(f"解析弹幕数据出错: {e}")
             
     async def _save_danmu_data(self, data):
-        # 保存弹幕数据到文件
-        # 只保存指定类型的弹幕
-        cmd_types = [
-            'DANMU_MSG',
-            'SUPER_CHAT_MESSAGE',
-            'SEND_GIFT',
-            'GUARD_BUY',
-            'INTERACT_WORD',
-            'LIVE',
-            'PREPARING'
-        ]
-        
-        if 'cmd' in data and data['cmd'] in cmd_types:
+        # 保存弹幕数据到文件（cmd已经由CmdFilter过滤过）
+        if 'cmd' in data:
+            cmd = data['cmd'].split(':', 1)[0]
             # 构建保存的数据
             danmu_data = {
                 'timestamp': time.time(),
@@ -218,37 +314,59 @@ class DanmuClient:
             }
             
             # 解析特定字段
-            if data['cmd'] == 'DANMU_MSG' and 'info' in data:
+            if cmd == 'DANMU_MSG' and 'info' in data:
                 danmu_data['username'] = data['info'][2][1] if len(data['info']) > 2 and len(data['info'][2]) > 1 else ''
                 danmu_data['content'] = data['info'][1] if len(data['info']) > 1 else ''
             
-            elif data['cmd'] == 'SUPER_CHAT_MESSAGE' and 'data' in data:
+            elif cmd == 'SUPER_CHAT_MESSAGE' and 'data' in data:
                 sc_data = data['data']
                 danmu_data['username'] = sc_data.get('user_info', {}).get('uname', '')
                 danmu_data['content'] = sc_data.get('message', '')
                 danmu_data['price'] = sc_data.get('price', 0)
                 
-            elif data['cmd'] == 'SEND_GIFT' and 'data' in data:
+            elif cmd == 'SEND_GIFT' and 'data' in data:
                 gift_data = data['data']
                 danmu_data['username'] = gift_data.get('uname', '')
                 danmu_data['gift_name'] = gift_data.get('giftName', '')
                 danmu_data['gift_count'] = gift_data.get('num', 0)
                 
-            elif data['cmd'] == 'GUARD_BUY' and 'data' in data:
+            elif cmd == 'GUARD_BUY' and 'data' in data:
                 guard_data = data['data']
                 danmu_data['username'] = guard_data.get('username', '')
                 danmu_data['guard_level'] = guard_data.get('guard_level', 0)
                 
-            # 写入文件
+            # 写入缓冲区，由DanmuWriter批量落盘
             try:
-                async with aiofiles.open(self.output_file, mode='a', encoding='utf-8') as f:
-                    await f.write(json.dumps(danmu_data, ensure_ascii=False) + '\n')
+                self.writer.write(danmu_data)
+                if self.search_index:
+                    self.search_index.feed(self.output_file, self.writer.index_builder.line_no - 1, danmu_data)
             except Exception as e:
                 print(f"保存弹幕数据出错: {e}")
                 
     async def stop(self):
         self.running = False
         
+        # 连接运行在DanmuHub的事件循环中，关闭操作需要提交到该循环执行
+        if self.loop and self.loop.is_running():
+            try:
+                current_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                current_loop = None
+            if current_loop is self.loop:
+                await self._close()
+            else:
+                future = asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+                try:
+                    await asyncio.wrap_future(future)
+                except Exception as e:
+                    print(f"关闭弹幕连接出错: {e}")
+            
+        print(f"已停止抓取直播间 {self.room_id} 的弹幕")
+        
+    async def _close(self):
+        if self.stop_event:
+            self.stop_event.set()
+            
         # 取消心跳任务
         if self.heartbeat_task:
             self.heartbeat_task.cancel()
@@ -259,12 +377,3 @@ class DanmuClient:
                 await self.ws.close()
             except Exception as e:
                 print(f"关闭WebSocket连接出错: {e}")
-            
-        # 停止事件循环
-        if self.loop:
-            try:
-                self.loop.call_soon_threadsafe(self.loop.stop)
-            except Exception as e:
-                print(f"停止事件循环出错: {e}")
-            
-        print(f"已停止抓取直播间 {self.room_id} 的弹幕")
\ No newline at end of file
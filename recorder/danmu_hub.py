@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from recorder.config import Config
+
+class DanmuHub:
+    """
+    弹幕连接集线器：所有直播间的WebSocket连接、心跳和解析任务
+    都复用少量固定的事件循环线程，而不是每个房间单独开一个线程+事件循环。
+    房间按房间号分片到各个事件循环上。
+    """
+    def __init__(self, loop_count=None):
+        self.loop_count = max(1, loop_count or Config.DANMU_HUB_LOOPS)
+        self._loops = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self.clients = {}  # DanmuClient -> concurrent.futures.Future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loops:
+                return
+            for index in range(self.loop_count):
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=self._run_loop,
+                    args=(loop,),
+                    name=f"danmu-hub-{index}",
+                    daemon=True
+                )
+                thread.start()
+                self._loops.append(loop)
+                self._threads.append(thread)
+            print(f"弹幕集线器已启动，事件循环数: {self.loop_count}")
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def _loop_for_room(self, room_id):
+        # 按房间号分片，同一房间始终落在同一个事件循环上
+        try:
+            shard = int(room_id)
+        except (TypeError, ValueError):
+            shard = hash(str(room_id))
+        return self._loops[shard % len(self._loops)]
+
+    def register(self, client):
+        """把弹幕客户端挂到共享事件循环上运行"""
+        self._ensure_started()
+        loop = self._loop_for_room(client.room_id)
+        client.loop = loop
+        client.running = True
+        future = asyncio.run_coroutine_threadsafe(client.run(), loop)
+        self.clients[client] = future
+        print(f"直播间 {client.room_id} 已注册到弹幕集线器，当前连接数: {len(self.clients)}")
+        return future
+
+    async def unregister(self, client, timeout=10):
+        """停止弹幕客户端并从集线器中移除"""
+        future = self.clients.pop(client, None)
+        await client.stop()
+        if future is not None and not future.done():
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"等待直播间 {client.room_id} 的弹幕任务结束超时，强制取消")
+                future.cancel()
+            except Exception as e:
+                print(f"弹幕任务异常结束: {e}")
+        print(f"直播间 {client.room_id} 已从弹幕集线器注销，当前连接数: {len(self.clients)}")
+
+    def get_stats(self):
+        return {
+            "loops": len(self._loops),
+            "connections": len(self.clients)
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import time
+from recorder.config import Config
+from recorder import json_codec
+from recorder.danmaku_index import index_path, load_builder
+
+class DanmuWriter:
+    """
+    单个录制会话的弹幕写入器
+    文件在整个会话期间保持打开，记录先缓存在内存中，
+    达到大小阈值或时间阈值时批量写入，停止时再写入剩余内容。
+    写入的同时生成字节偏移索引（见danmaku_index），索引总是在对应的弹幕写入之后才写入。
+    """
+    def __init__(self, output_file, flush_bytes=None, flush_interval=None, fsync_interval=None):
+        self.output_file = output_file
+        self.flush_bytes = flush_bytes or Config.DANMU_FLUSH_BYTES
+        self.flush_interval = flush_interval or Config.DANMU_FLUSH_INTERVAL
+        # fsync间隔（秒），None表示从不主动fsync，0表示每次写入后都fsync
+        self.fsync_interval = Config.DANMU_FSYNC_INTERVAL if fsync_interval is None else fsync_interval
+        self.file = None
+        self.index_file = None
+        self.index_builder = None
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.flush_task = None
+        self.fsync_future = None
+        self.last_fsync = time.monotonic()
+        # 热路径计数器
+        self.records = 0
+        self.flushes = 0
+        self.bytes_written = 0
+        self.fsyncs = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def open(self):
+        # 必须在事件循环中调用，定时刷新任务挂在当前循环上
+        self.index_builder = load_builder(self.output_file)
+        self.file = open(self.output_file, 'ab')
+        self.index_file = open(index_path(self.output_file), 'ab')
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    def write(self, record):
+        """把一条弹幕记录放入缓冲区，缓冲区满时立即写入文件"""
+        line = json_codec.dumps_bytes(record) + b'\n'
+        if self.index_builder:
+            self.index_builder.add(line, record.get('timestamp'))
+        self.buffer.append(line)
+        self.buffer_bytes += len(line)
+        self.records += 1
+        if self.buffer_bytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer or not self.file:
+            return
+        start = time.perf_counter()
+        batch = len(self.buffer)
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_bytes = 0
+        try:
+            self.file.write(data)
+            self.file.flush()
+            if self.index_file:
+                self.index_file.write(self.index_builder.take())
+                self.index_file.flush()
+        except Exception as e:
+            print(f"写入弹幕文件出错: {e}")
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.flushes += 1
+        self.bytes_written += len(data)
+        self.last_batch = batch
+        self.max_batch = max(self.max_batch, batch)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+        self._maybe_fsync()
+
+    def _maybe_fsync(self):
+        if self.fsync_interval is None:
+            return
+        if self.fsync_future and not self.fsync_future.done():
+            return
+        now = time.monotonic()
+        if now - self.last_fsync < self.fsync_interval:
+            return
+        self.last_fsync = now
+        self.fsyncs += 1
+        # fsync可能很慢，放到线程池里执行，避免阻塞共享的事件循环
+        loop = asyncio.get_running_loop()
+        self.fsync_future = loop.run_in_executor(None, os.fsync, self.file.fileno())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.flush()
+        if self.fsync_future:
+            try:
+                await self.fsync_future
+            except Exception as e:
+                print(f"同步弹幕文件到磁盘出错: {e}")
+        if self.file:
+            try:
+                if self.fsync_interval is not None:
+                    os.fsync(self.file.fileno())
+                self.file.close()
+            except Exception as e:
+                print(f"关闭弹幕文件出错: {e}")
+            self.file = None
+        if self.index_file:
+            try:
+                self.index_file.close()
+            except Exception as e:
+                print(f"关闭弹幕索引文件出错: {e}")
+            self.index_file = None
+
+    def get_stats(self):
+        return {
+            "records": self.records,
+            "flushes": self.flushes,
+            "bytes_written": self.bytes_written,
+            "fsyncs": self.fsyncs,
+            "buffered_records": len(self.buffer),
+            "last_batch": self.last_batch,
+            "max_batch": self.max_batch,
+            "avg_batch": round((self.records - len(self.buffer)) / self.flushes, 2) if self.flushes else 0,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 3) if self.flushes else 0
+        }
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+from collections import deque
+from recorder.config import Config
+
+# MP4容器可以直接封装（无需转码）的编码
+MP4_VIDEO_CODECS = {'h264', 'hevc', 'av1', 'mpeg4'}
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'opus', 'ac3', 'eac3', 'alac', 'flac'}
+
+def get_ffprobe_path(ffmpeg_path=None):
+    """获取ffprobe路径：优先使用配置，其次取ffmpeg同目录下的ffprobe，最后在PATH中查找"""
+    if Config.FFPROBE_PATH:
+        return Config.FFPROBE_PATH
+    ffmpeg_path = ffmpeg_path or Config.FFMPEG_PATH
+    head, sep, tail = ffmpeg_path.rpartition('ffmpeg')
+    if sep:
+        candidate = head + 'ffprobe' + tail
+        if os.path.exists(candidate):
+            return candidate
+    return shutil.which('ffprobe') or 'ffprobe'
+
+def low_priority_command(cmd):
+    """
+    按配置降低转换进程的CPU和IO优先级
+    返回 (命令, create_subprocess_exec的额外参数)
+    """
+    kwargs = {}
+    nice = Config.CONVERT_NICE
+    if os.name == 'nt':
+        # Windows没有nice/ionice，使用进程优先级类
+        if nice:
+            kwargs['creationflags'] = subprocess.IDLE_PRIORITY_CLASS if nice >= 15 else subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        return cmd, kwargs
+    
+    if Config.CONVERT_IONICE_CLASS is not None and shutil.which('ionice'):
+        ionice = ['ionice', '-c', str(Config.CONVERT_IONICE_CLASS)]
+        if Config.CONVERT_IONICE_CLASS == 2:
+            ionice += ['-n', '7']
+        cmd = ionice + cmd
+    if nice and shutil.which('nice'):
+        cmd = ['nice', '-n', str(nice)] + cmd
+    return cmd, kwargs
+
+async def probe_media(path, ffprobe_path=None):
+    """
+    用ffprobe读取媒体文件的时长和音视频编码
+    返回 {"duration": 秒, "video_codecs": [...], "audio_codecs": [...]}，失败返回None
+    """
+    cmd = [
+        ffprobe_path or get_ffprobe_path(),
+        '-v', 'error',
+        '-show_entries', 'format=duration:stream=codec_type,codec_name',
+        '-of', 'json',
+        path
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+    except Exception as e:
+        print(f"运行ffprobe出错: {e}")
+        return None
+
+    if process.returncode != 0:
+        print(f"ffprobe分析文件失败: {stderr.decode('utf-8', errors='ignore')}")
+        return None
+
+    try:
+        data = json.loads(stdout.decode('utf-8', errors='ignore') or '{}')
+    except ValueError:
+        return None
+
+    streams = data.get('streams', [])
+    try:
+        duration = float(data.get('format', {}).get('duration') or 0)
+    except ValueError:
+        duration = 0
+    return {
+        "duration": duration,
+        "video_codecs": [s.get('codec_name') for s in streams if s.get('codec_type') == 'video'],
+        "audio_codecs": [s.get('codec_name') for s in streams if s.get('codec_type') == 'audio']
+    }
+
+def can_remux_to_mp4(info):
+    """判断音视频编码是否可以直接封装进MP4"""
+    if not info or not info["video_codecs"]:
+        return False
+    return (all(codec in MP4_VIDEO_CODECS for codec in info["video_codecs"]) and
+            all(codec in MP4_AUDIO_CODECS for codec in info["audio_codecs"]))
+
+async def read_progress(stream, on_progress):
+    """
+    解析ffmpeg -progress输出
+    输出为逐行的key=value，每组以progress=continue或progress=end结束，每组回调一次
+    """
+    block = {}
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        key, _, value = line.decode('utf-8', errors='ignore').strip().partition('=')
+        if not key:
+            continue
+        block[key] = value
+        if key == 'progress':
+            try:
+                on_progress(block)
+            except Exception as e:
+                print(f"处理FFmpeg进度出错: {e}")
+            block = {}
+
+async def drain_stream(stream, keep_lines=50):
+    """持续读取并丢弃输出，避免管道写满阻塞ffmpeg，返回最后若干行用于排查错误"""
+    tail = deque(maxlen=keep_lines)
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        tail.append(line.decode('utf-8', errors='ignore').rstrip())
+    return list(tail)
+
+def parse_out_time(block):
+    """从一组进度数据中取出已处理的媒体时长（秒）"""
+    value = block.get('out_time_us') or block.get('out_time_ms')
+    try:
+        # 旧版本ffmpeg的out_time_ms实际单位也是微秒
+        return max(0.0, int(value) / 1000000)
+    except (TypeError, ValueError):
+        return None
+
+async def run_ffmpeg(cmd, duration=None, on_percent=None, **kwargs):
+    """
+    运行一条ffmpeg命令（命令中需包含 -progress pipe:1），同时读取进度和错误输出
+    duration为输入时长（秒），用于换算百分比；返回 (返回码, 错误输出的最后若干行)
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        **kwargs
+    )
+
+    def handle_progress(block):
+        if not on_percent or not duration:
+            return
+        out_time = parse_out_time(block)
+        if out_time is not None:
+            on_percent(min(99, int(out_time / duration * 100)))
+
+    _, stderr_tail, returncode = await asyncio.gather(
+        read_progress(process.stdout, handle_progress),
+        drain_stream(process.stderr),
+        process.wait()
+    )
+    return returncode, stderr_tail
+
+async def concat_files(files, output_file, ffmpeg_path=None):
+    """用concat分离器把多个编码参数一致的文件直接拼接（-c copy），返回是否成功"""
+    list_file = f"{os.path.splitext(output_file)[0]}_concat.txt"
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for path in files:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    cmd = [
+        ffmpeg_path or Config.FFMPEG_PATH,
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_file,
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-progress', 'pipe:1',
+        '-nostats',
+        '-loglevel', 'error',
+        output_file
+    ]
+    cmd, kwargs = low_priority_command(cmd)
+    try:
+        returncode, stderr_tail = await run_ffmpeg(cmd, **kwargs)
+    finally:
+        try:
+            os.remove(list_file)
+        except OSError:
+            pass
+    if returncode != 0:
+        print(f"拼接失败，FFmpeg返回码: {returncode}")
+        print("\n".join(stderr_tail))
+        return False
+    return True
@@ -0,0 +1,405 @@
+import asyncio
+import os
+import struct
+import time
+from urllib.parse import urlsplit, urljoin
+from recorder.config import Config
+
+FLV_HEADER = b'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00'  # 含音视频的FLV文件头 + PreviousTagSize0
+TAG_AUDIO = 8
+TAG_VIDEO = 9
+TAG_SCRIPT = 18
+TAG_HEADER_SIZE = 11
+MAX_TAG_SIZE = 16 * 1024 * 1024  # 超过这个大小说明数据已错位
+# tag头：类型(8位)+长度(24位)，时间戳低24位+高8位，StreamID(24位，总是0)
+TAG_HEADER = struct.Struct('>II3x')
+PREVIOUS_TAG_SIZE = struct.Struct('>I')
+
+REQUEST_HEADERS = (
+    "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36\r\n"
+    "Referer: https://live.bilibili.com/35\r\n"
+    "Accept: */*\r\n"
+    "Connection: close\r\n"
+)
+MAX_REDIRECTS = 5
+
+def is_flv_url(url):
+    """原生引擎只能录制HTTP-FLV地址"""
+    return url.startswith(("http://", "https://")) and '.m3u8' not in urlsplit(url).path
+
+class FlvStreamError(Exception):
+    pass
+
+class HttpStream:
+    """
+    最简单的HTTP/1.1 GET：直播流是一个长连接，只需要读响应体，
+    直接用asyncio的流读写，省掉通用HTTP客户端每个数据块的开销
+    支持重定向、chunked和HTTPS
+    """
+    def __init__(self, reader, writer, status, reason, headers):
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    @classmethod
+    async def open(cls, url):
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            use_ssl = parts.scheme == 'https'
+            port = parts.port or (443 if use_ssl else 80)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, port, ssl=True if use_ssl else None, limit=Config.FLV_READ_SIZE),
+                timeout=Config.RECORD_STALL_TIMEOUT
+            )
+            target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\n{REQUEST_HEADERS}\r\n".encode('latin-1'))
+            try:
+                status, reason, headers = await asyncio.wait_for(cls._read_head(reader), timeout=Config.RECORD_STALL_TIMEOUT)
+            except BaseException:
+                writer.close()
+                raise
+            location = headers.get('location')
+            if status in (301, 302, 303, 307, 308) and location:
+                writer.close()
+                url = urljoin(url, location)
+                continue
+            return cls(reader, writer, status, reason, headers)
+        raise FlvStreamError("重定向次数过多")
+
+    @staticmethod
+    async def _read_head(reader):
+        status_line = (await reader.readline()).decode('latin-1').strip()
+        version, _, rest = status_line.partition(' ')
+        code, _, reason = rest.partition(' ')
+        if not version.startswith('HTTP/') or not code.isdigit():
+            raise FlvStreamError(f"无效的HTTP响应: {status_line[:100]}")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return int(code), reason, headers
+
+    async def iter_body(self):
+        """逐块返回响应体，超过RECORD_STALL_TIMEOUT没有数据时抛出TimeoutError"""
+        reader = self.reader
+        timeout = Config.RECORD_STALL_TIMEOUT
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    return
+                remaining = size
+                while remaining:
+                    chunk = await asyncio.wait_for(reader.read(min(remaining, Config.FLV_READ_SIZE)), timeout)
+                    if not chunk:
+                        return
+                    remaining -= len(chunk)
+                    yield chunk
+                await asyncio.wait_for(reader.readline(), timeout)
+        else:
+            remaining = int(self.headers['content-length']) if 'content-length' in self.headers else None
+            while remaining is None or remaining > 0:
+                size = Config.FLV_READ_SIZE if remaining is None else min(remaining, Config.FLV_READ_SIZE)
+                chunk = await asyncio.wait_for(reader.read(size), timeout)
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def close(self):
+        self.writer.close()
+
+class FlvTagReader:
+    """
+    从HTTP响应的数据块中切出完整的FLV tag
+    只解析tag头（类型、长度、时间戳），数据部分原样保留
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header_done = False
+
+    def feed(self, chunk):
+        """追加数据，返回其中完整的tag列表：[(类型, 时间戳毫秒, 数据), ...]"""
+        self.buffer += chunk
+        buffer = self.buffer
+        position = 0
+        if not self.header_done:
+            if len(buffer) < 9:
+                return []
+            if buffer[:3] != b'FLV':
+                raise FlvStreamError("不是FLV数据")
+            # 跳过文件头和PreviousTagSize0
+            position = struct.unpack_from('>I', buffer, 5)[0] + 4
+            if len(buffer) < position:
+                return []
+            self.header_done = True
+        tags = []
+        end = len(buffer)
+        while end - position >= TAG_HEADER_SIZE:
+            tag_type = buffer[position] & 0x1f
+            data_size = int.from_bytes(buffer[position + 1:position + 4], 'big')
+            if data_size > MAX_TAG_SIZE or tag_type not in (TAG_AUDIO, TAG_VIDEO, TAG_SCRIPT):
+                raise FlvStreamError(f"无效的FLV tag: type={tag_type} size={data_size}")
+            tag_end = position + TAG_HEADER_SIZE + data_size + 4
+            if tag_end > end:
+                break
+            # 时间戳：低24位 + 扩展的高8位
+            timestamp = int.from_bytes(buffer[position + 4:position + 7], 'big') | (buffer[position + 7] << 24)
+            data = bytes(buffer[position + TAG_HEADER_SIZE:tag_end - 4])
+            tags.append((tag_type, timestamp, data))
+            position = tag_end
+        if position:
+            del buffer[:position]
+        return tags
+
+def append_tag(buffer, tag_type, timestamp, data):
+    """按新的时间戳把一个tag（含PreviousTagSize）追加到buffer，直接写入避免多次拼接复制数据"""
+    timestamp = max(0, int(timestamp)) & 0xffffffff
+    size = len(data)
+    buffer += TAG_HEADER.pack((tag_type << 24) | size, ((timestamp & 0xffffff) << 8) | (timestamp >> 24))
+    buffer += data
+    buffer += PREVIOUS_TAG_SIZE.pack(size + TAG_HEADER_SIZE)
+
+def reset_metadata_duration(data):
+    """onMetaData里的duration是源的时长，对分段和中途开始的录制不成立，清零后由播放器按实际数据计算"""
+    position = data.find(b'\x00\x08duration\x00')
+    if position < 0 or len(data) < position + 19:
+        return data
+    return data[:position + 11] + bytes(8) + data[position + 19:]
+
+def is_keyframe(data):
+    """视频tag是否为关键帧（兼容Enhanced RTMP的扩展头）"""
+    return bool(data) and (data[0] >> 4) & 0x07 == 1
+
+def is_sequence_header(tag_type, data):
+    """AVC/HEVC/AAC的解码配置，每个新文件开头都要重新写入"""
+    if len(data) < 2:
+        return False
+    if tag_type == TAG_VIDEO:
+        if data[0] & 0x80:
+            # Enhanced RTMP：低4位为PacketType，0为SequenceStart
+            return data[0] & 0x0f == 0
+        return data[0] & 0x0f in (7, 12) and data[1] == 0
+    if tag_type == TAG_AUDIO:
+        return data[0] >> 4 == 10 and data[1] == 0
+    return False
+
+def _write_and_close(file, data):
+    try:
+        if data:
+            file.write(data)
+    finally:
+        file.close()
+
+class FlvRecorder:
+    """
+    不启动ffmpeg，直接用asyncio拉取HTTP-FLV流写入文件（只适用于直接复制的FLV录制）
+    - 解析tag头修正时间戳：每个文件从0开始，跳变或回退时接着上一帧继续
+    - 分段录制时在关键帧处切换文件，新文件开头补上脚本数据和解码配置
+    - 数据先攒在内存里，够FLV_WRITE_BUFFER再在线程中一次写入磁盘
+    与VideoRecorder的接口保持一致，由RecordingTask按任务选择
+    """
+    def __init__(self, stream_url, output_file, duration_seconds=None, segment_seconds=None, segment_start=0):
+        self.stream_url = stream_url
+        self.output_file = output_file
+        self.duration_seconds = duration_seconds
+        self.segment_seconds = segment_seconds
+        base_name = os.path.splitext(output_file)[0]
+        self.segment_pattern = f"{base_name}_%03d.flv"
+        self.segment_start = segment_start
+        self.closed_segments = []
+        self._unpolled = []
+
+        self.stats = {
+            "bitrate_kbps": None,
+            "fps": None,
+            "speed": None,
+            "frames": 0,
+            "drop_frames": 0,
+            "dup_frames": 0,
+            "total_size": 0,  # 已收到的字节数
+            "out_time": 0,
+            "updated_at": None
+        }
+        self.stderr_tail = []  # 出错信息，和ffmpeg的stderr一样供上层判断
+        self.returncode = None
+        self.started_at = None
+        self._task = None
+
+        # 写入状态
+        self.file = None
+        self.current_file = None
+        self.buffer = bytearray()
+        self._pending_write = None
+        self.metadata = None  # 第一个onMetaData脚本tag
+        self.sequence_headers = {}  # tag类型 -> 最近的解码配置
+        # 时间戳修正
+        self.last_in = None
+        self.last_out = 0
+        self.file_base = 0  # 当前文件开头对应的输出时间戳
+        self._window = (time.time(), 0, 0, 0)  # 统计窗口：(时刻, 字节数, 帧数, 输出时间戳)
+
+    @property
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    @property
+    def current_segment(self):
+        """当前正在写入的分段文件"""
+        return self.segment_pattern % (self.segment_start + len(self.closed_segments))
+
+    def poll_closed_segments(self):
+        """返回自上次调用以来新关闭的分段文件"""
+        new_segments, self._unpolled = self._unpolled, []
+        return new_segments
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.output_file), exist_ok=True)
+        print(f"开始录制视频(原生FLV): {self.output_file}")
+        self.started_at = time.time()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            response = await HttpStream.open(self.stream_url)
+            try:
+                if response.status >= 400:
+                    raise FlvStreamError(f"HTTP {response.status} {response.reason}")
+                self._open_file(self.current_segment if self.segment_seconds else self.output_file)
+                reader = FlvTagReader()
+                async for chunk in response.iter_body():
+                    self.stats["total_size"] += len(chunk)
+                    for tag_type, timestamp, data in reader.feed(chunk):
+                        if await self._handle_tag(tag_type, timestamp, data):
+                            self.returncode = 0
+                            return
+                    self._update_stats()
+            finally:
+                response.close()
+            self.returncode = 0
+            print(f"直播流已结束: {self.stream_url}")
+        except asyncio.CancelledError:
+            self.returncode = 0
+            raise
+        except Exception as e:
+            self.returncode = 1
+            self.stderr_tail = (self.stderr_tail + [f"{type(e).__name__}: {e}"])[-20:]
+            print(f"原生FLV录制出错: {type(e).__name__}: {e}")
+        finally:
+            await self._close_file()
+
+    async def _handle_tag(self, tag_type, timestamp, data):
+        """写入一个tag，达到录制时长时返回True"""
+        if tag_type == TAG_SCRIPT:
+            if self.metadata is None:
+                self.metadata = data = reset_metadata_duration(data)
+                await self._write(TAG_SCRIPT, 0, data)
+            return False
+        out = self._fix_timestamp(timestamp)
+        if self.duration_seconds and out >= self.duration_seconds * 1000:
+            return True
+        if is_sequence_header(tag_type, data):
+            self.sequence_headers[tag_type] = data
+        elif tag_type == TAG_VIDEO:
+            self.stats["frames"] += 1
+            if (self.segment_seconds and is_keyframe(data)
+                    and out - self.file_base >= self.segment_seconds * 1000):
+                await self._next_segment(out)
+        self.last_out = out
+        await self._write(tag_type, out - self.file_base, data)
+        return False
+
+    def _fix_timestamp(self, timestamp):
+        """输入时间戳转换为连续的输出时间戳：正常情况下保持相对间隔，跳变或明显回退时接着上一帧"""
+        if self.last_in is None:
+            delta = 0
+        else:
+            delta = timestamp - self.last_in
+            # 音视频交错时时间戳会有几十毫秒的回退，属于正常情况
+            if delta < -Config.FLV_MAX_TIMESTAMP_JUMP or delta > Config.FLV_MAX_TIMESTAMP_JUMP:
+                delta = 0
+        self.last_in = timestamp
+        return max(self.file_base, self.last_out + delta)
+
+    def _open_file(self, path):
+        self.file = open(path, 'wb')
+        self.current_file = path
+        self.buffer += FLV_HEADER
+
+    async def _next_segment(self, out):
+        """在关键帧处切换到下一个分段，新文件开头补上元数据和解码配置"""
+        closed = self.current_file
+        await self._close_file()
+        self.closed_segments.append(closed)
+        self._unpolled.append(closed)
+        self.file_base = out
+        self._open_file(self.current_segment)
+        if self.metadata is not None:
+            append_tag(self.buffer, TAG_SCRIPT, 0, self.metadata)
+        for tag_type, data in self.sequence_headers.items():
+            append_tag(self.buffer, tag_type, 0, data)
+
+    async def _write(self, tag_type, timestamp, data):
+        append_tag(self.buffer, tag_type, timestamp, data)
+        if len(self.buffer) >= Config.FLV_WRITE_BUFFER:
+            await self._flush()
+
+    async def _flush(self):
+        if not self.buffer:
+            return
+        data, self.buffer = bytes(self.buffer), bytearray()
+        # 录制被取消时线程中的写入仍会完成，关闭文件前要等它结束
+        self._pending_write = asyncio.ensure_future(asyncio.to_thread(self.file.write, data))
+        await asyncio.shield(self._pending_write)
+        self._pending_write = None
+
+    async def _close_file(self):
+        if self.file is None:
+            return
+        if self._pending_write is not None:
+            await asyncio.wait([self._pending_write])
+            self._pending_write = None
+        file, data = self.file, bytes(self.buffer)
+        self.file, self.buffer = None, bytearray()
+        # 最后一块写入和关闭都在线程中进行，录制被再次取消时线程仍会完成关闭
+        await asyncio.shield(asyncio.to_thread(_write_and_close, file, data))
+
+    def _update_stats(self):
+        now = time.time()
+        stats = self.stats
+        stats["out_time"] = round(self.last_out / 1000, 2)
+        stats["updated_at"] = now
+        window_start, size, frames, out = self._window
+        elapsed = now - window_start
+        if elapsed >= 2:
+            stats["bitrate_kbps"] = round((stats["total_size"] - size) * 8 / elapsed / 1000, 1)
+            stats["fps"] = round((stats["frames"] - frames) / elapsed, 2)
+            stats["speed"] = round((self.last_out - out) / 1000 / elapsed, 3)
+            self._window = (now, stats["total_size"], stats["frames"], self.last_out)
+
+    async def stop(self):
+        if self.is_running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.segment_seconds:
+            # 最后一个分段在停止时关闭
+            if self.current_file and self.current_file not in self.closed_segments and os.path.exists(self.current_file):
+                self.closed_segments.append(self.current_file)
+                self._unpolled.append(self.current_file)
+            print(f"分段录制已结束，共 {len(self.closed_segments)} 个分段")
+        elif os.path.exists(self.output_file):
+            print(f"录制文件大小: {os.path.getsize(self.output_file)} 字节")
+        else:
+            print(f"警告: 录制文件未创建 {self.output_file}")
+        if self.stderr_tail:
+            print(f"原生FLV录制错误: {chr(10).join(self.stderr_tail)}")
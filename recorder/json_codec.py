@@ -0,0 +1,66 @@
+"""
+弹幕JSON编解码层
+安装了orjson或msgspec时使用它们（快数倍），否则回退到标准库json。
+弹幕客户端、弹幕写入器和API接口都通过这里编解码，输出统一为UTF-8（不转义中文）。
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+def _std_loads(data):
+    if isinstance(data, memoryview):
+        data = str(data, 'utf-8')
+    return json.loads(data)
+
+def _std_dumps_bytes(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+if orjson is not None:
+    BACKEND = "orjson"
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson不支持超过64位的整数等少数情况，交给标准库处理
+            return _std_loads(data)
+
+    def dumps_bytes(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return _std_dumps_bytes(obj)
+
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError:
+            return _std_loads(data)
+
+    def dumps_bytes(obj):
+        try:
+            return _encoder.encode(obj)
+        except (TypeError, msgspec.EncodeError):
+            return _std_dumps_bytes(obj)
+
+else:
+    BACKEND = "json"
+    loads = _std_loads
+    dumps_bytes = _std_dumps_bytes
+
+def dumps(obj):
+    """编码为str"""
+    return dumps_bytes(obj).decode('utf-8')
@@ -1,14 +1,33 @@
 import os
+import re
 import json
 import time
+import shutil
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from recorder.video_recorder import VideoRecorder
+from recorder.video_recorder import VideoRecorder, stop_orphan_ffmpeg
+from recorder.flv_capture import FlvRecorder, is_flv_url
 from recorder.danmu_client import DanmuClient
+from recorder.danmu_hub import DanmuHub
 from recorder.config import Config
+from recorder.ffmpeg_tools import probe_media, can_remux_to_mp4, run_ffmpeg, low_priority_command, concat_files
+from recorder.convert_queue import ConversionScheduler
+from recorder.catalog import RecordingsCatalog
+from recorder.session_meta import write_meta, read_meta
+from recorder.task_store import TaskStore
+from recorder.status_events import StatusBroadcaster
+from recorder.clip_export import ClipExporter
+from recorder.search_index import SearchIndex
+from recorder.room_watch import WatchList
+from recorder import danmaku_archive, danmaku_index, danmaku_heatmap
+from recorder.utils import stream_resolver
+from recorder.stream_resolver import url_host, url_expires_soon
 
 class RecordingTask:
-    def __init__(self, task_id, room_id, stream_url=None, duration_seconds=None, output_dir=None):
+    def __init__(self, task_id, room_id, stream_url=None, duration_seconds=None, output_dir=None, danmu_hub=None, converter=None,
+                 segment_seconds=None, on_segment=None, catalog=None, resolver=None, stream_candidates=None, engine=None,
+                 on_state_change=None, search_index=None):
         self.task_id = task_id
         self.room_id = room_id
         self.stream_url = stream_url
@@ -21,9 +40,47 @@ class RecordingTask:
         self.danmaku_file = None
         self.video_recorder = None
         self.danmu_client = None
+        self.danmu_hub = danmu_hub or DanmuHub()
+        self.converter = converter or ConversionScheduler()
+        self.catalog = catalog  # 录制文件索引，开始和结束时更新
+        self.search_index = search_index  # 弹幕搜索索引
+        self.convert_job = None
+        # 分段录制：segment_seconds为0或None表示录成单个文件
+        self.segment_seconds = segment_seconds
+        self.on_segment = on_segment  # 分段关闭时的回调，由RecordingManager提供
+        self.segments = []  # 已关闭的分段FLV文件
+        self.segment_jobs = []  # 各分段的转换任务
+        self.base_name = None  # 不含扩展名的输出文件路径
         self.record_progress = 0  # 录制进度（百分比）
         self.convert_progress = 0  # 转换进度（百分比）
+        self.convert_mode = None  # 实际使用的转换方式：remux 或 transcode
         self.elapsed_time = 0  # 已录制时间（秒）
+        self.meta = {}  # 会话元数据，保存在 {base_name}_meta.json
+        self.record_stats = {}  # FFmpeg实时录制状态：码率、帧率、速度、丢帧、已写入字节等
+        # 断线重连：resolver为StreamResolver，None表示沿用原地址（自定义流地址）
+        # stream_candidates为按测速排序的候选地址，断线时依次换用后面的备用节点
+        self.resolver = resolver
+        self.stream_candidates = list(stream_candidates or ([stream_url] if stream_url else []))
+        self.candidate_index = 0
+        # 录制引擎：ffmpeg 或 native（原生HTTP-FLV），原生引擎只使用FLV地址
+        self.engine = engine or Config.RECORD_ENGINE
+        if self.engine == "native":
+            flv_candidates = [url for url in self.stream_candidates if is_flv_url(url)]
+            if flv_candidates:
+                self.stream_candidates = flv_candidates
+                self.stream_url = flv_candidates[0]
+            else:
+                print(f"直播间 {room_id} 没有HTTP-FLV地址，改用ffmpeg录制")
+                self.engine = "ffmpeg"
+        # 实时预览HLS目录，由ffmpeg额外输出，原生引擎不支持
+        self.live_dir = os.path.join(Config.LIVE_DIR, task_id) if Config.LIVE_PREVIEW and self.engine == "ffmpeg" else None
+        self.part_index = 0  # 当前是第几次连接录下的部分
+        self.media_offset = 0  # 之前各部分的媒体总时长（秒）
+        self.reconnects = 0
+        self.gap_seconds = 0  # 断线造成的空档总时长（秒）
+        self.pending_gap = None  # 正在重连的空档，新的部分开始写入后记入元数据
+        self.on_state_change = on_state_change  # 状态变化时的回调，由RecordingManager保存到任务库
+        self.last_persist = 0
 
     async def start(self):
         self.status = "recording"
@@ -34,57 +91,471 @@ class RecordingTask:
         room_dir = os.path.join(self.output_dir, str(self.room_id))
         os.makedirs(room_dir, exist_ok=True)
         
-        self.video_file = os.path.join(room_dir, f"{self.room_id}_{timestamp}.flv")
-        self.danmaku_file = os.path.join(room_dir, f"{self.room_id}_{timestamp}_danmaku.jsonl")
+        self.base_name = os.path.join(room_dir, f"{self.room_id}_{timestamp}")
+        self.video_file = f"{self.base_name}.flv"
+        self.danmaku_file = f"{self.base_name}_danmaku.jsonl"
         
         # 启动视频录制
-        self.video_recorder = VideoRecorder(self.stream_url, self.video_file, Config.FFMPEG_PATH)
-        self.video_recorder.start()
+        self.video_recorder = self._create_recorder(self.video_file, self.duration_seconds)
+        await self.video_recorder.start()
+        if self.segment_seconds:
+            self.video_file = self.video_recorder.current_segment
+            asyncio.create_task(self._watch_segments())
+        
+        # 会话元数据：t0为录制文件中媒体时间0对应的时刻，弹幕按它与视频对齐
+        # 先用开始时间，拿到ffmpeg的进度后再校正
+        self.meta = {
+            "session_id": os.path.basename(self.base_name),
+            "room_id": self.room_id,
+            "t0": self.start_time.timestamp(),
+            "t0_source": "start_time"
+        }
+        self._save_meta()
         
-        # 启动弹幕抓取
-        self.danmu_client = DanmuClient(self.room_id, self.danmaku_file)
-        self.danmu_client.start()
+        if self.catalog:
+            self.catalog.add_session(os.path.basename(self.base_name), self.room_id, self.video_file, self.danmaku_file)
         
-        # 启动进度更新任务
-        asyncio.create_task(self._update_progress())
+        # 启动弹幕抓取（挂到共享的弹幕集线器上，不再单独开线程）
+        self.danmu_client = DanmuClient(self.room_id, self.danmaku_file, search_index=self.search_index)
+        self.danmu_hub.register(self.danmu_client)
+        
+        # 启动断线重连监视（进度由RecordingManager的定时器统一更新）
+        asyncio.create_task(self._supervise())
         
         # 如果设置了录制时长，启动定时停止任务
         if self.duration_seconds:
             asyncio.create_task(self._schedule_stop())
+        self._persist()
 
-    async def _update_progress(self):
-        """定期更新录制进度"""
-        while self.status == "recording":
+    def to_record(self):
+        """任务的持久化状态，也是状态接口返回的基础字段"""
+        recorder = self.video_recorder
+        pid = recorder.process.pid if isinstance(recorder, VideoRecorder) and recorder.process else None
+        return {
+            "task_id": self.task_id,
+            "room_id": self.room_id,
+            "stream_url": self.stream_url,
+            "auto_url": self.resolver is not None,
+            "engine": self.engine,
+            "stream_candidates": len(self.stream_candidates),
+            "stream_candidate_index": self.candidate_index,
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "end_time": self.end_time.isoformat() if self.end_time else None,
+            "duration_seconds": self.duration_seconds,
+            "output_dir": self.output_dir,
+            "base_name": self.base_name,
+            "video_file": self.video_file,
+            "danmaku_file": self.danmaku_file,
+            "status": self.status,
+            "record_progress": self.record_progress,
+            "convert_progress": self.convert_progress,
+            "convert_mode": self.convert_mode,
+            "segment_seconds": self.segment_seconds,
+            "segments": len(self.segments),
+            "segments_converted": sum(1 for job in self.segment_jobs if job.state == "done"),
+            "part_index": self.part_index,
+            "elapsed_time": self.elapsed_time,
+            "record_stats": self.record_stats,
+            "reconnects": self.reconnects,
+            "gap_seconds": round(self.gap_seconds, 1),
+            "pid": pid,
+            "updated_at": time.time()
+        }
+
+    def to_status(self):
+        """状态接口和状态推送使用的完整信息：持久化字段加上运行中才有的实时信息"""
+        info = self.to_record()
+        info.update({
+            "convert_job": self.convert_job.to_dict() if self.convert_job else None,
+            "live_url": f"/live/{self.task_id}/index.m3u8" if self.live_dir and self.status == "recording" else None,
+            "danmaku_stats": self.danmu_client.writer.get_stats() if self.danmu_client else None,
+            "danmaku_cmd_stats": self.danmu_client.cmd_filter.get_stats() if self.danmu_client else None
+        })
+        return info
+
+    def _persist(self):
+        self.last_persist = time.time()
+        if self.on_state_change:
+            try:
+                self.on_state_change(self)
+            except Exception as e:
+                print(f"保存任务状态出错: {e}")
+
+    def _restore(self, record):
+        """按保存的状态恢复任务字段（服务重启后）"""
+        self.start_time = datetime.fromisoformat(record["start_time"])
+        self.end_time = datetime.fromisoformat(record["end_time"]) if record.get("end_time") else None
+        self.base_name = record["base_name"]
+        self.video_file = record.get("video_file")
+        self.danmaku_file = record.get("danmaku_file")
+        self.part_index = record.get("part_index", 0)
+        self.elapsed_time = record.get("elapsed_time", 0)
+        self.record_progress = record.get("record_progress", 0)
+        self.convert_progress = record.get("convert_progress", 0)
+        self.record_stats = record.get("record_stats") or {}
+        self.reconnects = record.get("reconnects", 0)
+        self.gap_seconds = record.get("gap_seconds", 0)
+        self.convert_mode = record.get("convert_mode")
+
+    async def resume(self, record):
+        """
+        服务重启后继续录制：结束残留的ffmpeg，已录好的部分按分段处理（和断线重连一样），
+        再开始录制新的部分，重启造成的空档记入元数据
+        """
+        self._restore(record)
+        self.status = "recording"
+        await stop_orphan_ffmpeg(record.get("pid"), self.base_name)
+        self.meta = read_meta(self.base_name) or {
+            "session_id": os.path.basename(self.base_name),
+            "room_id": self.room_id,
+            "t0": self.start_time.timestamp(),
+            "t0_source": "start_time"
+        }
+        last_write, next_index = self._recover_parts()
+        # 保存的进度最多落后TASK_STATE_INTERVAL秒，用最后写入文件的时间补上
+        updated_at = record.get("updated_at") or time.time()
+        self.media_offset = self.elapsed_time + max(0, (last_write or updated_at) - updated_at)
+        self.elapsed_time = self.media_offset
+        print(f"恢复录制任务 {self.task_id}，已录制 {round(self.media_offset)} 秒，{len(self.segments)} 个部分")
+
+        remaining = None
+        if self.duration_seconds:
+            remaining = self.duration_seconds - (datetime.now() - self.start_time).total_seconds()
+            if remaining <= 1:
+                # 重启期间已经到了录制时长，直接合并已录好的部分
+                self.status = "converting"
+                self.end_time = datetime.now()
+                self._persist()
+                asyncio.create_task(self._finalize_segments())
+                return
+
+        self.danmu_client = DanmuClient(self.room_id, self.danmaku_file, search_index=self.search_index)
+        self.danmu_hub.register(self.danmu_client)
+        if self.resolver:
+            # 保存的流地址早已过期
+            await self._refresh_candidates()
+        # 非分段录制的各部分也按分段命名，part_index决定下一个部分的序号
+        self.part_index = max(next_index - 1, 0)
+        await self._start_next_part("restart", last_write or updated_at, next_index)
+        if self.status != "recording":
+            return
+        if self.segment_seconds:
+            asyncio.create_task(self._watch_segments())
+        asyncio.create_task(self._supervise())
+        if remaining:
+            asyncio.create_task(self._schedule_stop(remaining))
+
+    async def recover_conversion(self, record):
+        """服务重启后重新转换上次录完还没转换完的文件"""
+        self._restore(record)
+        self.status = "converting"
+        final_file = f"{self.base_name}.mp4"
+        if self.segment_seconds or self.part_index > 0:
+            self._recover_parts()
+            if not self.segments and os.path.exists(final_file):
+                # 上次已经拼接完成，只是没来得及保存状态
+                self.video_file = final_file
+                self.convert_progress = 100
+                self._finish()
+                return
+            print(f"重新转换任务 {self.task_id} 的 {len(self.segment_jobs)} 个分段")
+            asyncio.create_task(self._finalize_segments())
+        elif self.video_file and self.video_file.endswith('.flv') and os.path.exists(self.video_file):
+            print(f"重新转换任务 {self.task_id}: {self.video_file}")
+            self.convert_job = self.converter.submit(self)
+        else:
+            if os.path.exists(final_file):
+                self.video_file = final_file
+            self._finish()
+
+    def _recover_parts(self):
+        """
+        按磁盘上的文件恢复已录好的部分（保存的状态可能落后于实际进度）：
+        FLV还在的重新放入转换队列，只剩MP4的说明已转换完成，直接参与最后的拼接
+        返回 (最后写入文件的时间, 下一个部分的序号)
+        """
+        last_write = None
+        single_file = f"{self.base_name}.flv"
+        if not self.segment_seconds and os.path.exists(single_file):
+            # 非分段录制的第一个部分，和断线重连时一样改为分段的命名方式
+            last_write = os.path.getmtime(single_file)
+            os.replace(single_file, f"{self.base_name}_000.flv")
+        directory = os.path.dirname(self.base_name)
+        pattern = re.compile(re.escape(os.path.basename(self.base_name)) + r'_(\d{3})\.(flv|mp4)$')
+        found = {}
+        for entry in os.scandir(directory):
+            match = pattern.match(entry.name)
+            if match:
+                found.setdefault(int(match.group(1)), set()).add(match.group(2))
+                mtime = entry.stat().st_mtime
+                last_write = mtime if last_write is None else max(last_write, mtime)
+        self.segments = []
+        self.segment_jobs = []
+        for index in sorted(found):
+            segment_file = f"{self.base_name}_{index:03d}.flv"
+            if "flv" not in found[index]:
+                self.segments.append(segment_file)
+            elif os.path.getsize(segment_file) > 0:
+                self._add_segment(segment_file)
+            else:
+                os.remove(segment_file)
+        return last_write, max(found) + 1 if found else 0
+
+    def update_progress(self):
+        """更新录制进度，由RecordingManager的定时器每秒对所有录制中的任务调用一次"""
+        if self.status == "recording" and self.video_recorder:
             if self.start_time:
-                self.elapsed_time = (datetime.now() - self.start_time).total_seconds()
+                # 优先使用ffmpeg实际写入的媒体时长，拉流卡顿时不会虚高；还没有进度时用墙上时间
+                self.record_stats = dict(self.video_recorder.stats)
+                media_time = self.record_stats.get("out_time")
+                if media_time or self.part_index:
+                    self.elapsed_time = self.media_offset + (media_time or 0)
+                    if self.part_index == 0 and self.meta.get("t0_source") == "start_time" and media_time >= 2:
+                        # 连接建立和首帧到达需要时间，用ffmpeg实际写入的媒体时长反推t0
+                        self.meta["t0"] = self.record_stats["updated_at"] - media_time
+                        self.meta["t0_source"] = "ffmpeg"
+                        self._save_meta()
+                else:
+                    self.elapsed_time = (datetime.now() - self.start_time).total_seconds()
                 if self.duration_seconds:
                     self.record_progress = min(100, int((self.elapsed_time / self.duration_seconds) * 100))
                 else:
                     self.record_progress = -1  # 表示无限制录制
-            
-            await asyncio.sleep(1)  # 每秒更新一次
+            if time.time() - self.last_persist >= Config.TASK_STATE_INTERVAL:
+                self._persist()
 
-    async def _schedule_stop(self):
-        await asyncio.sleep(self.duration_seconds)
+    def _create_recorder(self, output_file, duration_seconds, segment_start=0):
+        if self.engine == "native":
+            return FlvRecorder(
+                self.stream_url,
+                output_file,
+                duration_seconds=duration_seconds,
+                segment_seconds=self.segment_seconds,
+                segment_start=segment_start
+            )
+        return VideoRecorder(
+            self.stream_url,
+            output_file,
+            Config.FFMPEG_PATH,
+            duration_seconds=duration_seconds,
+            segment_seconds=self.segment_seconds,
+            live_dir=self.live_dir,
+            segment_start=segment_start
+        )
+
+    async def _supervise(self):
+        """监视ffmpeg：进程退出或长时间没有新数据写入时，重新获取流地址并继续录制到新的分段"""
+        failures = 0  # 连续失败次数，用于加长重连等待
+        last_size = -1
+        last_growth = time.time()
+        while self.status == "recording":
+            await asyncio.sleep(1)
+            if self.status != "recording":
+                break
+            recorder = self.video_recorder
+            size = recorder.stats["total_size"]
+            now = time.time()
+            if size != last_size:
+                last_size, last_growth = size, now
+                if size > 0:
+                    failures = 0
+                    self._close_gap(recorder)
+            if recorder.is_running and now - last_growth < Config.RECORD_STALL_TIMEOUT:
+                continue
+            if self.duration_seconds and (datetime.now() - self.start_time).total_seconds() >= self.duration_seconds - 1:
+                # 已到录制时长，ffmpeg是正常结束，等待定时停止
+                continue
+            if recorder.is_running:
+                reason = "stall"
+            else:
+                reason = f"exit({recorder.returncode if recorder.started_at else 'start failed'})"
+            delay = min(Config.RECORD_RECONNECT_MAX_DELAY, Config.RECORD_RECONNECT_DELAY * (2 ** failures))
+            failures += 1
+            try:
+                await self._reconnect(reason, delay)
+            except Exception as e:
+                print(f"重新连接出错: {e}")
+            last_size, last_growth = -1, time.time()
+
+    async def _reconnect(self, reason, delay):
+        old = self.video_recorder
+        gap_start = old.stats["updated_at"] or old.started_at or time.time()
+        print(f"直播间 {self.room_id} 录制中断（{reason}），{delay}秒后重新连接")
+        await old.stop()
+        if self.status != "recording":
+            return
+        self.media_offset += old.stats["out_time"]
+        
+        # 已经录好的内容作为分段，立即在后台转换
+        segment_start = 0
+        if self.segment_seconds:
+            self._collect_segments()
+            segment_start = old.segment_start + len(old.closed_segments)
+        else:
+            self._close_part()
+        
+        await asyncio.sleep(delay)
+        if self.resolver and self.status == "recording":
+            await self._switch_stream_url(old)
+        if self.status != "recording":
+            return
+        await self._start_next_part(reason, gap_start, segment_start)
+
+    async def _start_next_part(self, reason, gap_start, segment_start):
+        """断线后开始录制新的部分，新的部分开始写入时记录空档"""
+        self.part_index += 1
+        self.reconnects += 1
+        remaining = None
+        if self.duration_seconds:
+            remaining = max(1, int(self.duration_seconds - (datetime.now() - self.start_time).total_seconds()))
+        if self.segment_seconds:
+            output_file = f"{self.base_name}.flv"
+        else:
+            output_file = f"{self.base_name}_{self.part_index:03d}.flv"
+        self.pending_gap = {"at": round(self.media_offset, 3), "start": gap_start, "reason": reason}
+        self.video_recorder = self._create_recorder(output_file, remaining, segment_start)
+        await self.video_recorder.start()
+        if self.status != "recording":
+            # 启动期间任务被停止
+            await self.video_recorder.stop()
+            return
+        self.video_file = self.video_recorder.current_segment if self.segment_seconds else output_file
+        self._persist()
+
+    async def _switch_stream_url(self, old):
+        """
+        断线后选择下一个流地址：先换用排名靠后的备用节点，
+        备用节点用完、地址快过期或返回403时重新获取并测速排序
+        """
+        self.resolver.report_failure(self.stream_url)
+        expired = url_expires_soon(self.stream_url) or any('403' in line for line in old.stderr_tail)
+        if not expired and self.candidate_index + 1 < len(self.stream_candidates):
+            self.candidate_index += 1
+            self.stream_url = self.stream_candidates[self.candidate_index]
+            print(f"切换到备用CDN节点: {url_host(self.stream_url)}")
+            return
+        await self._refresh_candidates()
+
+    async def _refresh_candidates(self):
+        """重新获取流地址并测速排序"""
+        try:
+            candidates = await self.resolver.get_ranked_urls(self.room_id, refresh=True)
+        except Exception as e:
+            print(f"重新获取流地址失败: {e}")
+            return
+        if self.engine == "native":
+            candidates = [url for url in candidates if is_flv_url(url)]
+        if candidates:
+            self.stream_candidates = candidates
+            self.candidate_index = 0
+            self.stream_url = candidates[0]
+            print(f"重新获取流地址，使用CDN节点: {url_host(self.stream_url)}")
+
+    def _close_part(self):
+        """非分段录制断线时，把已录好的文件作为一个分段，录制结束后和之后的部分拼接成一个MP4"""
+        part_file = self.video_file
+        if self.part_index == 0:
+            # 第一个部分改用分段的命名方式，避免和最终的 {base_name}.mp4 重名
+            renamed = f"{self.base_name}_000.flv"
+            try:
+                os.replace(part_file, renamed)
+                part_file = renamed
+            except OSError as e:
+                print(f"重命名录制文件失败: {e}")
+        self.video_file = part_file
+        if os.path.exists(part_file) and os.path.getsize(part_file) > 0:
+            self._add_segment(part_file)
+        else:
+            # 连接失败时ffmpeg可能只创建了空文件
+            try:
+                os.remove(part_file)
+            except OSError:
+                pass
+
+    def _close_gap(self, recorder):
+        """新的部分开始写入数据，记录这次断线的空档"""
+        if not self.pending_gap:
+            return
+        gap = self.pending_gap
+        self.pending_gap = None
+        stats = recorder.stats
+        end = stats["updated_at"] - stats["out_time"] if stats["updated_at"] else time.time()
+        gap["end"] = end
+        gap["seconds"] = round(max(0.0, end - gap["start"]), 3)
+        self.gap_seconds += gap["seconds"]
+        self.meta.setdefault("gaps", []).append(gap)
+        self.meta["reconnects"] = self.reconnects
+        self._save_meta()
+        print(f"直播间 {self.room_id} 已重新连接，空档 {gap['seconds']} 秒")
+
+    def _save_meta(self):
+        try:
+            write_meta(self.base_name, self.meta)
+        except Exception as e:
+            print(f"写入会话元数据出错: {e}")
+
+    async def _schedule_stop(self, delay=None):
+        await asyncio.sleep(self.duration_seconds if delay is None else delay)
         await self.stop()
 
+    async def _watch_segments(self):
+        """分段录制时定期检查新关闭的分段"""
+        while self.status == "recording":
+            self._collect_segments()
+            await asyncio.sleep(2)
+
+    def _collect_segments(self):
+        for segment_file in self.video_recorder.poll_closed_segments():
+            print(f"分段已关闭: {segment_file}")
+            self._add_segment(segment_file)
+        if self.status == "recording":
+            self.video_file = self.video_recorder.current_segment
+
+    def _add_segment(self, segment_file):
+        if self.on_segment:
+            self.on_segment(self, segment_file)
+        else:
+            self.segments.append(segment_file)
+
     async def stop(self):
+        if self.status != "recording":
+            # 手动停止和定时停止可能先后触发，只处理一次
+            return
         self.status = "converting"  # 更新状态为转换中
         self.end_time = datetime.now()
+        self._persist()
+        if self.meta:
+            # 结束时间用来限定弹幕统计的范围
+            self.meta["end"] = self.end_time.timestamp()
+            self._save_meta()
         
         print(f"停止录制任务，当前状态: {self.status}")
         
         # 停止视频录制
         if self.video_recorder:
-            self.video_recorder.stop()
+            await self.video_recorder.stop()
+            self.record_stats = dict(self.video_recorder.stats)
+        # 录制结束后实时预览的切片不再需要
+        if self.live_dir:
+            shutil.rmtree(self.live_dir, ignore_errors=True)
         
         # 停止弹幕抓取
         if self.danmu_client:
             try:
-                await self.danmu_client.stop()
+                await self.danmu_hub.unregister(self.danmu_client)
             except Exception as e:
                 print(f"停止弹幕客户端出错: {e}")
         
+        # 分段录制：ffmpeg退出时会写完最后一个分段，之后只需等待各分段转换完成再拼接
+        # 非分段录制中途断线重连过时，各部分同样按分段处理
+        if self.segment_seconds or self.part_index > 0:
+            if self.segment_seconds:
+                self._collect_segments()
+            elif self.video_file not in self.segments:
+                self._close_part()
+            asyncio.create_task(self._finalize_segments())
+            return
+        
         # 等待一段时间，确保文件完全写入
         print("等待文件写入完成...")
         await asyncio.sleep(3)  # 增加等待时间
@@ -110,56 +581,49 @@ class RecordingTask:
                     print(f"文件大小稳定计数: {stable_count}/3")
                 else:
                     print(f"视频文件已消失: {self.video_file}")
-                    self.status = "stopped"
+                    self._finish()
                     return
             print("文件大小已稳定，准备转换")
         else:
             print(f"视频文件不存在，跳过稳定性检查: {self.video_file}")
         
-        # 转换视频格式为MP4
+        # 转换视频格式为MP4（放入管理器的转换队列，受并发数限制）
         if self.video_file and os.path.exists(self.video_file):
             print(f"准备转换文件: {self.video_file}")
-            await self._convert_to_mp4()
+            self.convert_job = self.converter.submit(self)
         else:
             print(f"视频文件不存在，无法转换: {self.video_file}")
-            self.status = "stopped"
+            self._finish()
+    
+    def _finish(self):
+        """录制和转换全部结束，按最终文件更新录制索引"""
+        self.status = "stopped"
+        if self.catalog:
+            try:
+                self.catalog.refresh_room(self.room_id)
+            except Exception as e:
+                print(f"更新录制索引出错: {e}")
+        self._persist()
     
     async def _convert_to_mp4(self):
-        """将FLV文件转换为MP4格式"""
+        """将FLV文件转换为MP4格式（默认只换封装，必要时才转码）"""
         if not self.video_file or not os.path.exists(self.video_file):
             print(f"无法转换: 文件不存在或路径无效: {self.video_file}")
-            self.status = "stopped"
-            return
+            self._finish()
+            return False
             
         # 生成MP4文件名
         mp4_file = self.video_file.replace('.flv', '.mp4')
         
-        # 使用ffmpeg进行转换，进行适当的编码以确保兼容性
-        cmd = [
-            Config.FFMPEG_PATH,
-            '-i', self.video_file,
-            '-c:v', 'libx264',  # 使用H.264视频编码
-            '-c:a', 'aac',      # 使用AAC音频编码
-            '-strict', 'experimental',
-            '-y',  # 覆盖输出文件
-            mp4_file
-        ]
-        
+        success = False
         try:
-            print(f"开始转换视频格式: {self.video_file} -> {mp4_file}")
-            print(f"FFmpeg命令: {' '.join(cmd)}")
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            # 更新转换进度
-            self.convert_progress = 10  # 开始转换
+            self.convert_progress = 0
             
-            stdout, stderr = await process.communicate()
+            def on_percent(percent):
+                self.convert_progress = percent
             
-            if process.returncode == 0:
+            success = await self._convert_file(self.video_file, mp4_file, on_percent)
+            if success:
                 print(f"视频格式转换成功: {mp4_file}")
                 # 保存原始文件路径，以便删除
                 original_file = self.video_file
@@ -174,9 +638,6 @@ class RecordingTask:
                 except Exception as e:
                     print(f"删除原始FLV文件失败: {e}")
             else:
-                print(f"视频格式转换失败: {stderr.decode()}")
-                print(f"转换错误详情: {stderr.decode()}")
-                print(f"FFmpeg返回码: {process.returncode}")
                 # 如果转换失败，仍然保留原始FLV文件路径
                 print("使用原始FLV文件作为视频源")
                 self.convert_progress = -1  # 表示转换失败
@@ -188,23 +649,327 @@ class RecordingTask:
             print("使用原始FLV文件作为视频源")
             self.convert_progress = -1  # 表示转换失败
         finally:
-            self.status = "stopped"  # 最终状态设为stopped
+            self._finish()  # 最终状态设为stopped
+        return success
+    
+    async def _convert_segment(self, segment_file):
+        """把一个已关闭的分段换封装为MP4，成功后删除分段FLV"""
+        mp4_file = segment_file.replace('.flv', '.mp4')
+        try:
+            success = await self._convert_file(segment_file, mp4_file)
+        except Exception as e:
+            print(f"分段转换出错: {e}")
+            return False
+        if success:
+            try:
+                os.remove(segment_file)
+            except Exception as e:
+                print(f"删除分段FLV文件失败: {e}")
+        return success
+    
+    async def _finalize_segments(self):
+        """等待所有分段转换完成后，用concat直接拼接成完整的MP4（不重新编码）"""
+        try:
+            jobs = list(self.segment_jobs)
+            for index, job in enumerate(jobs):
+                await job.wait()
+                self.convert_progress = int((index + 1) / len(jobs) * 90)
+            
+            parts = [segment.replace('.flv', '.mp4') for segment in self.segments]
+            if not parts or not all(os.path.exists(part) for part in parts):
+                print(f"部分分段转换失败，保留分段文件: {self.segments}")
+                self.convert_progress = -1
+                existing = [f for f in parts + self.segments if os.path.exists(f)]
+                self.video_file = existing[0] if existing else None
+                return
+            
+            final_file = f"{self.base_name}.mp4"
+            if len(parts) == 1:
+                os.replace(parts[0], final_file)
+                success = True
+            else:
+                print(f"拼接 {len(parts)} 个分段: {final_file}")
+                success = await concat_files(parts, final_file, Config.FFMPEG_PATH)
+                if success:
+                    for part in parts:
+                        try:
+                            os.remove(part)
+                        except Exception as e:
+                            print(f"删除分段文件失败: {e}")
+            
+            if success:
+                self.video_file = final_file
+                self.convert_progress = 100
+                try:
+                    os.remove(f"{self.base_name}_segments.csv")
+                except OSError:
+                    pass
+            else:
+                print("分段拼接失败，保留各分段MP4文件")
+                self.video_file = parts[0]
+                self.convert_progress = -1
+        except Exception as e:
+            print(f"合并分段出错: {e}")
+            self.convert_progress = -1
+        finally:
+            self._finish()
+    
+    async def _convert_file(self, source_file, mp4_file, on_percent=None):
+        """把source_file转成mp4_file：源编码兼容时直接复制流，否则或复制失败时重新编码"""
+        # B站直播流本身就是H.264/HEVC + AAC，通常可以直接复制到MP4，不需要重新编码
+        media_info = await probe_media(source_file)
+        remux = Config.CONVERT_MODE == "remux" and (media_info is None or can_remux_to_mp4(media_info))
+        duration = media_info["duration"] if media_info else None
+        
+        success = False
+        if remux:
+            success = await self._run_conversion(source_file, mp4_file, "remux", duration, media_info, on_percent)
+            if not success:
+                print("直接封装失败，改为重新编码")
+        if not success:
+            success = await self._run_conversion(source_file, mp4_file, "transcode", duration, media_info, on_percent)
+        return success
+    
+    async def _run_conversion(self, source_file, mp4_file, mode, duration, media_info, on_percent=None):
+        """执行一次ffmpeg转换，mode为remux（复制流）或transcode（重新编码）"""
+        cmd = [Config.FFMPEG_PATH, '-y', '-i', source_file]
+        if mode == "remux":
+            cmd += ['-c', 'copy']
+            # HEVC需要hvc1标签，浏览器和苹果设备才能播放
+            if media_info and 'hevc' in media_info["video_codecs"]:
+                cmd += ['-tag:v', 'hvc1']
+        else:
+            cmd += [
+                '-c:v', 'libx264',  # 使用H.264视频编码
+                '-c:a', 'aac'       # 使用AAC音频编码
+            ]
+        cmd += [
+            '-movflags', '+faststart',  # moov前置，网页播放时无需下载完整文件
+            '-progress', 'pipe:1',
+            '-nostats',
+            '-loglevel', 'error',
+            mp4_file
+        ]
+        
+        self.convert_mode = mode
+        print(f"开始转换视频格式({mode}): {source_file} -> {mp4_file}")
+        print(f"FFmpeg命令: {' '.join(cmd)}")
+        
+        # 转换在后台进行，降低进程优先级，避免影响正在进行的录制
+        cmd, kwargs = low_priority_command(cmd)
+        returncode, stderr_tail = await run_ffmpeg(cmd, duration, on_percent, **kwargs)
+        if returncode != 0:
+            print(f"视频格式转换失败({mode})，FFmpeg返回码: {returncode}")
+            print(f"转换错误详情: {chr(10).join(stderr_tail)}")
+            return False
+        return True
 
 class RecordingManager:
     def __init__(self):
         self.tasks = {}
+        # 所有任务的弹幕连接共享同一个集线器
+        self.danmu_hub = DanmuHub()
+        # 所有任务的MP4转换共用一个有并发上限的队列
+        self.converter = ConversionScheduler()
+        # 录制文件索引，替代每次请求都遍历输出目录
+        self.catalog = RecordingsCatalog()
+        # 任务状态保存到SQLite，重启后恢复；结束的任务从内存中移除，历史从库中分页查询
+        self.store = TaskStore() if Config.TASK_DB_PATH else None
+        # 状态推送：一个定时器统一更新所有任务的进度，只把变化的字段推送给订阅者
+        self.events = StatusBroadcaster()
+        self.sent_status = {}  # task_id -> 上次推送的状态
+        self.ticker = None
+        # 弹幕归档在单独的线程中逐个进行，不占用事件循环
+        self.archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="danmaku-archive")
+        # 剪辑导出有单独的队列，不和录制后的转换互相等待
+        self.clips = ClipExporter()
+        # 弹幕搜索索引在单独的线程中写入
+        self.search = SearchIndex() if Config.SEARCH_DB_PATH else None
+        # 开播自动录制的关注列表
+        self.watchlist = WatchList(self)
 
-    def create_task(self, room_id, stream_url=None, duration_seconds=None, output_dir=None):
-        task_id = f"{room_id}_{int(time.time())}"
-        task = RecordingTask(task_id, room_id, stream_url, duration_seconds, output_dir)
+    def create_task(self, room_id, stream_url=None, duration_seconds=None, output_dir=None, segment_seconds=None,
+                    stream_candidates=None, engine=None, task_id=None):
+        task_id = task_id or f"{room_id}_{int(time.time())}"
+        if segment_seconds is None:
+            segment_seconds = Config.SEGMENT_SECONDS
+        # 索引只覆盖默认输出目录，自定义目录的录制不登记
+        indexed = os.path.abspath(output_dir or Config.OUTPUT_DIR) == os.path.abspath(self.catalog.output_dir)
+        task = RecordingTask(
+            task_id, room_id, stream_url, duration_seconds, output_dir,
+            danmu_hub=self.danmu_hub,
+            converter=self.converter,
+            segment_seconds=segment_seconds,
+            on_segment=self.register_segment,
+            catalog=self.catalog if indexed else None,
+            # 自动获取的流地址断线时换用备用节点或重新获取；自定义流地址沿用原地址
+            resolver=stream_resolver if stream_candidates else None,
+            stream_candidates=stream_candidates,
+            engine=engine,
+            on_state_change=self.task_changed,
+            search_index=self.search
+        )
         self.tasks[task_id] = task
+        self._ensure_ticker()
         return task
 
-    async def start_task(self, room_id, stream_url=None, duration_seconds=None, output_dir=None):
-        task = self.create_task(room_id, stream_url, duration_seconds, output_dir)
+    def task_changed(self, task):
+        """任务状态发生变化（开始、重连、停止、转换结束等）：保存并立即推送"""
+        self.persist_task(task)
+        self.publish_task(task)
+        if task.status == "stopped" and task.danmaku_file and (Config.DANMU_ARCHIVE or Config.HEATMAP):
+            self.archive_danmaku(task.danmaku_file, task.room_id, task.base_name)
+
+    def persist_task(self, task):
+        """保存任务状态，已结束的任务不再保留在内存中"""
+        if not self.store:
+            return
+        self.store.save(task.to_record())
+        if task.status == "stopped":
+            self.tasks.pop(task.task_id, None)
+
+    def publish_task(self, task):
+        """和上次推送的状态比较，只推送变化的字段"""
+        info = task.to_status()
+        previous = self.sent_status.get(task.task_id, {})
+        changes = {key: value for key, value in info.items() if key != "updated_at" and previous.get(key) != value}
+        if task.status == "stopped":
+            self.sent_status.pop(task.task_id, None)
+        else:
+            self.sent_status[task.task_id] = info
+        if changes:
+            self.events.publish({"type": "task", "task_id": task.task_id, "changes": changes})
+
+    def _ensure_ticker(self):
+        if self.ticker is None or self.ticker.done():
+            self.ticker = asyncio.create_task(self._tick())
+
+    async def _tick(self):
+        """每秒更新所有录制中任务的进度，并推送各任务（含转换中的）变化的部分；没有任务时退出"""
+        while self.tasks:
+            await asyncio.sleep(Config.STATUS_TICK_INTERVAL)
+            for task in list(self.tasks.values()):
+                try:
+                    task.update_progress()
+                    self.publish_task(task)
+                except Exception as e:
+                    print(f"更新任务 {task.task_id} 状态出错: {e}")
+
+    async def recover(self):
+        """服务启动时恢复上次没有结束的任务：录制中的继续录制，转换中的重新排队转换"""
+        for record in self.store.active() if self.store else []:
+            task = self.create_task(
+                record["room_id"], record["stream_url"], record["duration_seconds"], record["output_dir"],
+                record["segment_seconds"], engine=record["engine"], task_id=record["task_id"]
+            )
+            if record.get("auto_url"):
+                task.resolver = stream_resolver
+            try:
+                if record["status"] == "recording" and record.get("base_name"):
+                    await task.resume(record)
+                elif record.get("base_name"):
+                    await task.recover_conversion(record)
+                else:
+                    task._finish()
+            except Exception as e:
+                print(f"恢复任务 {record['task_id']} 出错: {e}")
+                task._finish()
+        if Config.DANMU_ARCHIVE and Config.DANMU_ARCHIVE_BACKFILL:
+            self.archive_finished_sessions()
+        if self.search and Config.SEARCH_BACKFILL:
+            self.index_finished_sessions()
+        # 恢复的任务已经在录制，关注的直播间不会重复开始
+        await self.watchlist.load()
+
+    def archive_danmaku(self, danmaku_file, room_id, base_name=None):
+        """
+        在后台线程中处理已结束会话的弹幕：JSONL压缩为列式归档，完成后更新录制索引；
+        给出base_name时再生成热度统计（旧会话的热度在第一次请求时生成）
+        """
+        def on_done(future):
+            if future.result():
+                self.catalog.refresh_room(room_id)
+        future = asyncio.get_running_loop().run_in_executor(
+            self.archive_executor, self._process_danmaku, danmaku_file, base_name
+        )
+        future.add_done_callback(on_done)
+
+    def _process_danmaku(self, danmaku_file, base_name):
+        stats = self._archive_danmaku(danmaku_file) if Config.DANMU_ARCHIVE else None
+        danmaku_file = danmaku_archive.locate(danmaku_file)
+        if Config.HEATMAP and base_name and os.path.exists(danmaku_file):
+            try:
+                result = danmaku_heatmap.compute(base_name, danmaku_file)
+                if result:
+                    print(f"弹幕热度已统计: {danmaku_heatmap.heatmap_path(base_name)}，{len(result['highlights'])} 个高能片段")
+            except Exception as e:
+                print(f"统计弹幕热度出错 {danmaku_file}: {e}")
+        return stats
+
+    def _archive_danmaku(self, danmaku_file):
+        if not danmaku_file.endswith(danmaku_archive.JSONL_SUFFIX) or not os.path.exists(danmaku_file):
+            return None
+        try:
+            stats = danmaku_archive.compact(danmaku_file)
+        except Exception as e:
+            print(f"弹幕归档出错 {danmaku_file}: {e}")
+            return None
+        danmaku_index.discard(danmaku_file)
+        print(f"弹幕已归档: {stats['archive_file']}，{stats['records']} 条，"
+              f"{stats['source_bytes']} -> {stats['archive_bytes']} 字节，用时 {stats['seconds']} 秒")
+        return stats
+
+    def archive_finished_sessions(self):
+        """把录制索引中已结束、还没有归档的会话弹幕放入归档队列（录制中的任务除外）"""
+        active = {os.path.abspath(task.danmaku_file) for task in self.tasks.values()
+                  if task.danmaku_file and task.status != "stopped"}
+        _, sessions = self.catalog.list_sessions()
+        for info in sessions:
+            danmaku_file = info["danmaku_file"]
+            if danmaku_file and danmaku_file.endswith(danmaku_archive.JSONL_SUFFIX) and os.path.abspath(danmaku_file) not in active:
+                self.archive_danmaku(danmaku_file, info["room_id"])
+
+    def index_finished_sessions(self):
+        """为录制索引中已结束的会话补建搜索索引（已经完整索引过的会话由索引线程跳过）"""
+        active = {os.path.abspath(task.danmaku_file) for task in self.tasks.values()
+                  if task.danmaku_file and task.status != "stopped"}
+        _, sessions = self.catalog.list_sessions()
+        for info in sessions:
+            danmaku_file = info["danmaku_file"]
+            if danmaku_file and os.path.abspath(danmaku_file) not in active:
+                self.search.backfill(danmaku_file, info["room_id"])
+
+    def is_recording(self, base_name):
+        """该会话是否正在录制（弹幕文件还在写入）"""
+        base_name = os.path.abspath(base_name)
+        return any(task.base_name and os.path.abspath(task.base_name) == base_name
+                   for task in self.get_running_tasks())
+
+    def list_history(self, limit, offset=0):
+        """已结束的任务，按开始时间倒序分页，返回 (记录列表, 总数)"""
+        if self.store:
+            return self.store.history(limit, offset)
+        stopped = [task.to_record() for task in self.tasks.values() if task.status == "stopped"]
+        stopped.sort(key=lambda record: record["start_time"] or "", reverse=True)
+        return stopped[offset:offset + limit], len(stopped)
+
+    async def start_task(self, room_id, stream_url=None, duration_seconds=None, output_dir=None, segment_seconds=None,
+                         stream_candidates=None, engine=None):
+        task = self.create_task(room_id, stream_url, duration_seconds, output_dir, segment_seconds, stream_candidates, engine)
         await task.start()
         return task
 
+    def register_segment(self, task, segment_file):
+        """登记一个刚关闭的分段，并立即放入转换队列在后台换封装为MP4"""
+        task.segments.append(segment_file)
+        job = self.converter.submit(
+            task,
+            source_file=segment_file,
+            runner=lambda: task._convert_segment(segment_file)
+        )
+        task.segment_jobs.append(job)
+        self.publish_task(task)
+
     async def stop_task(self, task_id):
         if task_id in self.tasks:
             task = self.tasks[task_id]
@@ -0,0 +1,197 @@
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+import anyio
+from starlette.responses import Response
+from recorder.config import Config
+
+MAX_RANGES = 16  # 单个请求最多接受的区间数，超出时按普通请求返回整个文件
+
+def parse_range_header(header, file_size):
+    """
+    按RFC 7233解析Range请求头
+    返回 [(start, end), ...]（闭区间，已合并重叠部分）；
+    格式无效时返回None（忽略Range头），没有可满足的区间时返回[]（应返回416）
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if not first:
+                # bytes=-500：最后500字节
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                start, end = max(0, file_size - suffix), file_size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                end = file_size - 1 if end is None else min(end, file_size - 1)
+        except ValueError:
+            return None
+        if start < file_size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # 合并重叠或相邻的区间，避免同一段数据被重复发送
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _read_at(fd, file, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    file.seek(offset)
+    return file.read(size)
+
+class RangeFileResponse(Response):
+    """
+    支持Range的文件响应，用于视频拖动播放
+    - 完整支持RFC 7233：单区间、后缀区间（bytes=-N）、开放区间（bytes=N-）和多区间（multipart/byteranges）
+    - 返回ETag和Last-Modified，处理If-None-Match/If-Modified-Since（304）和If-Range
+    - 服务器支持http.response.zerocopysend扩展时直接用sendfile发送，否则在线程中按大块读取
+    """
+    def __init__(self, path, request, media_type=None, chunk_size=None):
+        self.path = path
+        self.request = request
+        self.media_type = media_type or 'application/octet-stream'
+        self.chunk_size = chunk_size or Config.VIDEO_CHUNK_SIZE
+        self.background = None
+        self.status_code = 200
+        self.ranges = None
+        self.boundary = None
+        self.stat_result = os.stat(path)
+        if not stat.S_ISREG(self.stat_result.st_mode):
+            raise RuntimeError(f"不是普通文件: {path}")
+        self.file_size = self.stat_result.st_size
+        self.etag = f'"{self.stat_result.st_mtime_ns:x}-{self.file_size:x}"'
+        self.last_modified = formatdate(self.stat_result.st_mtime, usegmt=True)
+        self.init_headers({
+            'accept-ranges': 'bytes',
+            'etag': self.etag,
+            'last-modified': self.last_modified
+        })
+        self._evaluate_request()
+
+    def _not_modified(self):
+        headers = self.request.headers
+        if_none_match = headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or self.etag in tags
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since:
+            try:
+                return int(self.stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _if_range_matches(self):
+        if_range = self.request.headers.get('if-range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # If-Range要求强比较，弱ETag永远不匹配
+            return if_range == self.etag
+        return if_range == self.last_modified
+
+    def _evaluate_request(self):
+        if self.request.method in ('GET', 'HEAD') and self._not_modified():
+            self.status_code = 304
+            return
+        range_header = self.request.headers.get('range')
+        if not range_header or not self._if_range_matches():
+            self.headers['content-length'] = str(self.file_size)
+            self.headers['content-type'] = self.media_type
+            return
+        ranges = parse_range_header(range_header, self.file_size)
+        if ranges is None:
+            self.headers['content-length'] = str(self.file_size)
+            self.headers['content-type'] = self.media_type
+            return
+        if not ranges:
+            self.status_code = 416
+            self.headers['content-range'] = f'bytes */{self.file_size}'
+            self.headers['content-length'] = '0'
+            return
+
+        self.status_code = 206
+        self.ranges = ranges
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.headers['content-range'] = f'bytes {start}-{end}/{self.file_size}'
+            self.headers['content-length'] = str(end - start + 1)
+            self.headers['content-type'] = self.media_type
+        else:
+            self.boundary = os.urandom(12).hex()
+            length = sum(len(self._part_header(start, end)) + (end - start + 1) + 2 for start, end in ranges)
+            length += len(self._closing_boundary())
+            self.headers['content-length'] = str(length)
+            self.headers['content-type'] = f'multipart/byteranges; boundary={self.boundary}'
+
+    def _part_header(self, start, end):
+        return (f'--{self.boundary}\r\n'
+                f'Content-Type: {self.media_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{self.file_size}\r\n\r\n').encode('latin-1')
+
+    def _closing_boundary(self):
+        return f'--{self.boundary}--\r\n'.encode('latin-1')
+
+    async def __call__(self, scope, receive, send):
+        await send({
+            'type': 'http.response.start',
+            'status': self.status_code,
+            'headers': self.raw_headers
+        })
+        if scope.get('method') == 'HEAD' or self.status_code in (304, 416):
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        zerocopy = 'http.response.zerocopysend' in scope.get('extensions', {})
+        ranges = self.ranges or [(0, self.file_size - 1)]
+        with open(self.path, 'rb') as file:
+            fd = file.fileno()
+            for start, end in ranges:
+                if self.boundary:
+                    await send({'type': 'http.response.body', 'body': self._part_header(start, end), 'more_body': True})
+                if zerocopy:
+                    await send({
+                        'type': 'http.response.zerocopysend',
+                        'file': fd,
+                        'offset': start,
+                        'count': end - start + 1,
+                        'more_body': True
+                    })
+                else:
+                    position = start
+                    while position <= end:
+                        size = min(self.chunk_size, end - position + 1)
+                        chunk = await anyio.to_thread.run_sync(_read_at, fd, file, size, position)
+                        if not chunk:
+                            break
+                        position += len(chunk)
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if self.boundary:
+                    await send({'type': 'http.response.body', 'body': b'\r\n', 'more_body': True})
+            closing = self._closing_boundary() if self.boundary else b''
+            await send({'type': 'http.response.body', 'body': closing, 'more_body': False})
@@ -0,0 +1,221 @@
+"""
+开播自动录制
+关注列表中的每个直播间保持一个只接收开播/下播通知的弹幕连接（挂在共享的DanmuHub上，不写文件，
+其余消息在原始字节中按cmd丢弃，不做JSON解析）。收到LIVE时开始录制，收到PREPARING时停止录制并排队转换。
+每次连接（包括断线重连）成功后查询一次直播状态，补上连接断开期间错过的通知。
+"""
+import asyncio
+import time
+from recorder.config import Config
+from recorder.danmu_client import DanmuClient, CmdFilter
+from recorder.utils import stream_resolver
+
+STATUS_CMDS = ('LIVE', 'PREPARING')
+# 弹幕连接认证完成（不是B站的cmd），收到后查询一次直播状态
+CONNECTED = 'CONNECTED'
+
+class RoomWatcher(DanmuClient):
+    """只接收开播/下播通知的弹幕连接，on_status(cmd)在DanmuHub的事件循环线程中调用"""
+    log_heartbeat = False
+
+    def __init__(self, room_id, on_status):
+        super().__init__(room_id, None, cmd_filter=CmdFilter(STATUS_CMDS))
+        self.on_status = on_status
+
+    async def run(self):
+        # 不写弹幕文件，只保持连接
+        self.stop_event = asyncio.Event()
+        await self._connect_loop()
+
+    async def _send_auth(self):
+        await super()._send_auth()
+        self.on_status(CONNECTED)
+
+    async def _save_danmu_data(self, data):
+        self.on_status(data.get('cmd', '').split(':', 1)[0])
+
+class WatchedRoom:
+    def __init__(self, room_id, real_room_id, segment_seconds=None, engine=None):
+        self.room_id = room_id
+        self.real_room_id = real_room_id
+        self.segment_seconds = segment_seconds
+        self.engine = engine
+        self.watcher = None
+        self.live = None  # 最近一次得知的直播状态，None表示还不知道
+        self.task_id = None  # 自动开始的录制任务
+        self.starting = None  # 进行中的开始录制过程
+        self.last_event = None
+        self.last_event_at = None
+        self.starts = 0
+
+    def options(self):
+        return {
+            "room_id": self.room_id,
+            "real_room_id": self.real_room_id,
+            "segment_seconds": self.segment_seconds,
+            "engine": self.engine
+        }
+
+class WatchList:
+    """
+    关注的直播间，由RecordingManager持有
+    弹幕连接的回调转回主事件循环处理；同一直播间同时只有一个开始录制的过程，
+    已经在录制（包括手动开始的录制）时不会重复开始
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.rooms = {}  # room_id -> WatchedRoom
+        self.loop = None
+
+    async def load(self):
+        """启动时恢复保存的关注列表，连接错开建立，避免同时向弹幕服务器发起大量连接"""
+        for options in self.manager.store.watchlist() if self.manager.store else []:
+            try:
+                self._watch(WatchedRoom(
+                    options["room_id"], options["real_room_id"], options.get("segment_seconds"), options.get("engine")
+                ))
+            except Exception as e:
+                print(f"恢复关注的直播间 {options.get('room_id')} 出错: {e}")
+            await asyncio.sleep(Config.WATCH_CONNECT_INTERVAL)
+
+    async def add(self, room_id, segment_seconds=None, engine=None):
+        """关注直播间，已经关注时更新录制参数；返回直播间的状态"""
+        room_id = str(room_id)
+        room = self.rooms.get(room_id)
+        if room is None:
+            # 弹幕服务器只认真实房间号
+            real_room_id, _ = await stream_resolver.get_room_info(room_id)
+            room = WatchedRoom(room_id, real_room_id, segment_seconds, engine)
+            self._watch(room)
+        else:
+            room.segment_seconds = segment_seconds
+            room.engine = engine
+        if self.manager.store:
+            self.manager.store.save_watch(room.options())
+        return self.to_dict(room)
+
+    def _watch(self, room):
+        self.loop = asyncio.get_running_loop()
+        room.watcher = RoomWatcher(room.real_room_id, lambda cmd: self.loop.call_soon_threadsafe(self._on_status, room, cmd))
+        self.rooms[room.room_id] = room
+        self.manager.danmu_hub.register(room.watcher)
+
+    async def remove(self, room_id):
+        """取消关注（不停止正在进行的录制），不存在时返回False"""
+        room = self.rooms.pop(str(room_id), None)
+        if room is None:
+            return False
+        if room.starting:
+            room.starting.cancel()
+        if self.manager.store:
+            self.manager.store.remove_watch(room.room_id)
+        await self.manager.danmu_hub.unregister(room.watcher)
+        return True
+
+    def _on_status(self, room, cmd):
+        if self.rooms.get(room.room_id) is not room:
+            return
+        if cmd == CONNECTED:
+            asyncio.create_task(self._check(room))
+            return
+        room.last_event = cmd
+        room.last_event_at = time.time()
+        print(f"关注的直播间 {room.room_id} 收到 {cmd}")
+        self._apply(room, cmd == 'LIVE')
+
+    async def _check(self, room):
+        """按接口返回的直播状态补上错过的开播/下播"""
+        try:
+            _, live_status = await stream_resolver.get_room_info(room.room_id, refresh=True)
+        except Exception as e:
+            print(f"查询直播间 {room.room_id} 的直播状态失败: {e}")
+            return
+        if self.rooms.get(room.room_id) is room:
+            self._apply(room, live_status == 1)
+
+    def _apply(self, room, live):
+        room.live = live
+        if live:
+            if (room.starting and not room.starting.done()) or self._recording_task(room):
+                return
+            room.starting = asyncio.create_task(self._start(room))
+        else:
+            if room.starting and not room.starting.done():
+                room.starting.cancel()
+            task = self.manager.get_task(room.task_id) if room.task_id else None
+            if task and task.status == "recording":
+                # 停止录制后由任务自己把录像放入转换队列
+                print(f"直播间 {room.room_id} 下播，停止录制: {task.task_id}")
+                asyncio.create_task(self.manager.stop_task(task.task_id))
+
+    def _recording_task(self, room):
+        """该直播间正在进行的录制（自动或手动开始的）"""
+        for task in self.manager.get_running_tasks():
+            if str(task.room_id) in (room.room_id, room.real_room_id):
+                return task
+        return None
+
+    async def _start(self, room):
+        # 刚开播时可能还取不到流地址，隔一段时间重试
+        for attempt in range(Config.WATCH_START_RETRIES):
+            if attempt:
+                await asyncio.sleep(Config.WATCH_RETRY_DELAY)
+            if not room.live or self.rooms.get(room.room_id) is not room:
+                return
+            try:
+                candidates = await stream_resolver.get_ranked_urls(room.room_id, refresh=True)
+            except Exception as e:
+                print(f"获取直播间 {room.room_id} 流地址失败: {e}")
+                continue
+            if not candidates:
+                continue
+            # 开始录制的过程不能从中间取消（任务已登记、录制进程已启动时取消会留下无人管理的录制），
+            # 下播或取消关注时等它完成后再决定是否停止
+            start = asyncio.ensure_future(self.manager.start_task(
+                room_id=room.room_id,
+                stream_url=candidates[0],
+                segment_seconds=room.segment_seconds,
+                stream_candidates=candidates,
+                engine=room.engine
+            ))
+            try:
+                task = await asyncio.shield(start)
+            except asyncio.CancelledError:
+                start.add_done_callback(lambda future: self._started_after_cancel(room, future))
+                raise
+            except Exception as e:
+                print(f"直播间 {room.room_id} 开始录制失败: {e}")
+                continue
+            room.task_id = task.task_id
+            room.starts += 1
+            print(f"直播间 {room.room_id} 开播，已开始录制: {task.task_id}")
+            return
+        print(f"直播间 {room.room_id} 开播，但尝试 {Config.WATCH_START_RETRIES} 次都没能开始录制")
+
+    def _started_after_cancel(self, room, future):
+        """开始录制的过程在取消后完成：已经下播则立即停止，否则（如取消关注）保留录制"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        task = future.result()
+        if room.live or self.rooms.get(room.room_id) is not room:
+            room.task_id = task.task_id
+            return
+        print(f"直播间 {room.room_id} 在开始录制过程中下播，停止录制: {task.task_id}")
+        asyncio.create_task(self.manager.stop_task(task.task_id))
+
+    def to_dict(self, room):
+        task = self._recording_task(room)
+        info = room.options()
+        info.update({
+            "live": room.live,
+            "recording": task is not None,
+            "task_id": task.task_id if task else room.task_id,
+            "connected": bool(room.watcher and room.watcher.ws and not room.watcher.ws.closed),
+            "last_event": room.last_event,
+            "last_event_at": room.last_event_at,
+            "starts": room.starts
+        })
+        return info
+
+    def list(self):
+        return [self.to_dict(room) for room in self.rooms.values()]
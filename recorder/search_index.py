@@ -0,0 +1,362 @@
+"""
+弹幕全文搜索
+DANMU_MSG和SC的内容保存到SQLite FTS5索引。中文没有空格分词，每段连续的文字切成相邻两个字的二元组
+（最后一个字单独作为一项，单字查询按前缀匹配），英文和数字按单词，查询时按同样的规则切分后作为短语匹配。
+录制中的弹幕由DanmuClient交给索引线程批量写入，接收弹幕的协程不访问数据库；
+已有的弹幕文件（JSONL或归档）在启动时补建索引，每个会话记录已经索引到的行号，可以从中断处继续。
+"""
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from recorder.config import Config
+from recorder import json_codec
+from recorder import danmaku_archive
+from recorder import danmaku_index
+from recorder.session_meta import session_timeline, media_offset
+
+INDEXED_CMDS = ('DANMU_MSG', 'SUPER_CHAT_MESSAGE')
+# 一段连续的英文数字，或一段连续的其它文字（中日韩文字等），标点、空白和表情都是分隔
+RUN_PATTERN = re.compile(r'[0-9a-z]+|[^\W\d_a-z]+')
+# 索引线程的控制消息
+STOP = object()
+
+def tokenize(text):
+    """切分为索引项：英文数字整个单词为一项，其它文字为相邻两字的二元组加上最后一个字"""
+    tokens = []
+    for run in RUN_PATTERN.findall(text.lower()):
+        if run.isascii():
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+    return tokens
+
+def build_query(text):
+    """
+    把搜索词转换为FTS5查询，每一段文字为一个短语，各段都要出现（AND）
+    单字和英文单词按前缀匹配（"好" 能匹配 "好的"，"hel" 能匹配 "hello"）
+    """
+    phrases = []
+    for run in RUN_PATTERN.findall(text.lower()):
+        if run.isascii() or len(run) == 1:
+            phrases.append(f'"{run}"*')
+        else:
+            phrases.append('"' + ' '.join(run[i:i + 2] for i in range(len(run) - 1)) + '"')
+    return ' AND '.join(phrases)
+
+def session_key(danmaku_file):
+    """弹幕文件（JSONL或归档）对应的 (session_id, base_name)"""
+    path = os.path.abspath(danmaku_file)
+    for suffix in (danmaku_archive.JSONL_SUFFIX, danmaku_archive.ARCHIVE_SUFFIX):
+        if path.endswith(suffix):
+            base_name = path[:-len(suffix)]
+            return os.path.basename(base_name), base_name
+    base_name = os.path.splitext(path)[0]
+    return os.path.basename(base_name), base_name
+
+def _indexable(cmd, content):
+    return isinstance(cmd, str) and cmd.split(':', 1)[0] in INDEXED_CMDS and isinstance(content, str) and content != ''
+
+class SearchIndex:
+    """
+    弹幕搜索索引，由RecordingManager持有
+    所有写入都在一个后台线程中进行：feed只是把弹幕放进队列，队列积压超过上限时丢弃，
+    丢弃过的会话不再推进已索引的行号，会话结束时从弹幕文件中补上（同一行重复写入会被忽略）
+    """
+    def __init__(self, db_path=None, queue_size=None):
+        self.db_path = db_path or Config.SEARCH_DB_PATH
+        self.queue_size = queue_size or Config.SEARCH_QUEUE_SIZE
+        self.queue = queue.Queue()
+        self.lagging = set()  # 丢弃过弹幕的弹幕文件，这些会话的已索引行号不再推进
+        self.dropped = 0
+        self.indexed = 0
+        self.scanned_sessions = 0
+        self.last_commit_ms = 0.0
+        db = self._connect()
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, room_id TEXT, base_name TEXT, next_line INTEGER, complete INTEGER)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, session_id TEXT, line INTEGER, timestamp REAL, "
+            "cmd TEXT, username TEXT, content TEXT, price REAL, UNIQUE (session_id, line))"
+        )
+        # 不保存原文（原文在messages表中），只保存倒排索引
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(tokens, content='', tokenize='unicode61')")
+        db.commit()
+        db.close()
+        # 查询使用单独的连接，WAL下不会被写入阻塞
+        self.reader = self._connect()
+        self.reader_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="search-index", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # ---- 以下方法可以在任何线程中调用 ----
+
+    def open(self, danmaku_file, room_id, start_line):
+        """开始（或继续）写入弹幕文件，start_line为接下来写入的行号"""
+        self.queue.put(("open", danmaku_file, str(room_id), start_line))
+
+    def feed(self, danmaku_file, line, record):
+        """录制中写入的一条弹幕（第line行），只放入队列，不等待"""
+        if not _indexable(record.get('cmd'), record.get('content')):
+            return
+        if self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            self.lagging.add(danmaku_file)
+            return
+        self.queue.put(("message", danmaku_file, line, record))
+
+    def close(self, danmaku_file):
+        """弹幕文件写入结束：补上没有索引的行，之后不再扫描这个会话"""
+        self.queue.put(("scan", danmaku_file, None))
+
+    def backfill(self, danmaku_file, room_id):
+        """为已有的弹幕文件建立索引（已经完整索引过的会话直接跳过）"""
+        self.queue.put(("scan", danmaku_file, str(room_id)))
+
+    def remove(self, session_id):
+        self.queue.put(("remove", session_id))
+
+    def shutdown(self, timeout=10):
+        """写入队列中剩余的弹幕后结束索引线程"""
+        self.queue.put(STOP)
+        self.thread.join(timeout)
+
+    # ---- 索引线程 ----
+
+    def _run(self):
+        db = self._connect()
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                break
+            # 攒一批再提交，减少事务次数
+            batch = [item]
+            deadline = time.monotonic() + Config.SEARCH_COMMIT_INTERVAL
+            while len(batch) < Config.SEARCH_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    self.queue.put(STOP)
+                    break
+                batch.append(item)
+            try:
+                self._process(db, batch)
+            except Exception as e:
+                db.rollback()
+                print(f"写入弹幕搜索索引出错: {e}")
+        db.close()
+
+    def _process(self, db, batch):
+        start = time.perf_counter()
+        cursors = {}  # 本批中各会话的已索引行号
+        for item in batch:
+            kind = item[0]
+            if kind == "message":
+                _, danmaku_file, line, record = item
+                session_id, _ = session_key(danmaku_file)
+                self._insert(db, session_id, line, record)
+                if danmaku_file not in self.lagging:
+                    cursors[session_id] = line + 1
+            else:
+                # 控制消息之前的弹幕先提交，保证扫描从正确的行号开始
+                self._save_cursors(db, cursors)
+                cursors = {}
+                db.commit()
+                if kind == "open":
+                    self._open(db, *item[1:])
+                elif kind == "scan":
+                    self._scan(db, *item[1:])
+                elif kind == "remove":
+                    self._remove(db, item[1])
+        self._save_cursors(db, cursors)
+        db.commit()
+        self.last_commit_ms = round((time.perf_counter() - start) * 1000, 3)
+
+    def _save_cursors(self, db, cursors):
+        for session_id, next_line in cursors.items():
+            db.execute("UPDATE sessions SET next_line = MAX(next_line, ?) WHERE session_id = ?", (next_line, session_id))
+
+    def _insert(self, db, session_id, line, record):
+        content = record.get('content')
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO messages (session_id, line, timestamp, cmd, username, content, price) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (session_id, line, record.get('timestamp'), record.get('cmd'), record.get('username'), content, record.get('price'))
+        )
+        if cursor.rowcount:
+            db.execute("INSERT INTO messages_fts (rowid, tokens) VALUES (?, ?)", (cursor.lastrowid, ' '.join(tokenize(content))))
+            self.indexed += 1
+
+    def _session(self, db, danmaku_file, room_id):
+        """返回会话的 (next_line, complete)，不存在时创建"""
+        session_id, base_name = session_key(danmaku_file)
+        row = db.execute("SELECT next_line, complete FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row:
+            return row
+        db.execute(
+            "INSERT INTO sessions (session_id, room_id, base_name, next_line, complete) VALUES (?, ?, ?, 0, 0)",
+            (session_id, room_id, base_name)
+        )
+        return 0, 0
+
+    def _open(self, db, danmaku_file, room_id, start_line):
+        session_id, _ = session_key(danmaku_file)
+        next_line, _ = self._session(db, danmaku_file, room_id)
+        db.execute("UPDATE sessions SET complete = 0 WHERE session_id = ?", (session_id,))
+        # 上次运行时写入但没有来得及索引的行
+        if next_line < start_line:
+            self._index_file(db, danmaku_file, session_id, next_line, start_line)
+        db.commit()
+
+    def _scan(self, db, danmaku_file, room_id):
+        session_id, _ = session_key(danmaku_file)
+        source = danmaku_archive.locate(danmaku_file)
+        if not os.path.exists(source):
+            return
+        next_line, complete = self._session(db, source, room_id)
+        if complete:
+            return
+        self._index_file(db, source, session_id, next_line, None)
+        db.execute("UPDATE sessions SET complete = 1 WHERE session_id = ?", (session_id,))
+        db.commit()
+        self.lagging.discard(danmaku_file)
+        self.scanned_sessions += 1
+
+    def _index_file(self, db, danmaku_file, session_id, start_line, end_line):
+        """索引弹幕文件中 [start_line, end_line) 的行，end_line为None表示到文件末尾"""
+        line = start_line
+        if danmaku_archive.is_archive(danmaku_file):
+            # 按归档中记录的原JSONL行号定位和写入（归档时跳过的损坏行没有对应的记录），只读取需要的几列
+            archive = danmaku_archive.get_archive(danmaku_file)
+            cmds = archive.column('cmd')
+            contents = archive.column('content')
+            end = archive.line_count if end_line is None else min(end_line, archive.line_count)
+            columns = None
+            for row in range(archive.row_of(start_line), archive.row_of(end)):
+                if not _indexable(cmds[row], contents[row]):
+                    continue
+                if columns is None:
+                    columns = [archive.column(name) for name in ('timestamp', 'username', 'price')]
+                self._insert(db, session_id, archive.line_of(row), {
+                    'cmd': cmds[row],
+                    'content': contents[row],
+                    'timestamp': columns[0][row],
+                    'username': columns[1][row],
+                    'price': columns[2][row]
+                })
+            line = max(end, start_line)
+        else:
+            # 用弹幕文件的行号索引直接定位到start_line附近
+            line_no, position = danmaku_index.get_index(danmaku_file).seek_line(start_line) if start_line else (0, 0)
+            with open(danmaku_file, 'rb') as f:
+                f.seek(position)
+                for data in f:
+                    if end_line is not None and line_no >= end_line or not data.endswith(b'\n'):
+                        break
+                    # 大文件分批提交，中断后从最近一次提交的位置继续；
+                    # 此时前line_no行都已处理完，和它们的索引在同一个事务中提交
+                    if line_no > start_line and line_no % Config.SEARCH_BATCH_SIZE == 0:
+                        db.execute("UPDATE sessions SET next_line = MAX(next_line, ?) WHERE session_id = ?", (line_no, session_id))
+                        db.commit()
+                    line_no += 1
+                    if line_no <= start_line:
+                        continue
+                    line = line_no
+                    # 先在原始字节中排除不需要索引的cmd，减少解析
+                    if b'"DANMU_MSG' not in data and b'"SUPER_CHAT_MESSAGE' not in data:
+                        continue
+                    try:
+                        record = json_codec.loads(data)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and _indexable(record.get('cmd'), record.get('content')):
+                        self._insert(db, session_id, line_no - 1, record)
+        db.execute("UPDATE sessions SET next_line = MAX(next_line, ?) WHERE session_id = ?", (line, session_id))
+
+    def _remove(self, db, session_id):
+        rows = db.execute("SELECT id, content FROM messages WHERE session_id = ?", (session_id,)).fetchall()
+        # 不保存原文的FTS5表删除时需要提供当初写入的内容
+        db.executemany(
+            "INSERT INTO messages_fts (messages_fts, rowid, tokens) VALUES ('delete', ?, ?)",
+            ((row_id, ' '.join(tokenize(content))) for row_id, content in rows)
+        )
+        db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    # ---- 查询 ----
+
+    def search(self, text, room_id=None, session_id=None, cmd=None, from_ts=None, to_ts=None, limit=50, offset=0):
+        """
+        搜索弹幕内容，按时间倒序分页
+        每条结果附带room_id、session_id和offset（在录像中的秒数，断线空档内的弹幕为空档开始的位置）
+        """
+        match = build_query(text)
+        if not match:
+            return {"items": [], "has_more": False}
+        conditions = ["messages_fts MATCH ?"]
+        params = [match]
+        for column, value in (("s.room_id", room_id), ("m.session_id", session_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(str(value))
+        if cmd is not None:
+            conditions.append("m.cmd = ?")
+            params.append(cmd)
+        if from_ts is not None:
+            conditions.append("m.timestamp >= ?")
+            params.append(from_ts)
+        if to_ts is not None:
+            conditions.append("m.timestamp <= ?")
+            params.append(to_ts)
+        sql = (
+            "SELECT m.session_id, s.room_id, s.base_name, m.line, m.timestamp, m.cmd, m.username, m.content, m.price "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN sessions s ON s.session_id = m.session_id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY m.timestamp DESC LIMIT ? OFFSET ?"
+        )
+        with self.reader_lock:
+            rows = self.reader.execute(sql, params + [limit + 1, offset]).fetchall()
+        timelines = {}
+        items = []
+        for session_id, room, base_name, line, timestamp, cmd, username, content, price in rows[:limit]:
+            if base_name not in timelines:
+                timelines[base_name] = session_timeline(base_name)
+            timeline = timelines[base_name]
+            item = {
+                "session_id": session_id,
+                "room_id": room,
+                "line": line,
+                "timestamp": timestamp,
+                "offset": round(media_offset(timeline, timestamp), 3) if timeline and timestamp is not None else None,
+                "cmd": cmd,
+                "username": username,
+                "content": content
+            }
+            if price is not None:
+                item["price"] = price
+            items.append(item)
+        return {"items": items, "has_more": len(rows) > limit}
+
+    def get_stats(self):
+        with self.reader_lock:
+            sessions, complete = self.reader.execute("SELECT COUNT(*), COALESCE(SUM(complete), 0) FROM sessions").fetchone()
+        return {
+            "sessions": sessions,
+            "sessions_complete": complete,
+            "queue_depth": self.queue.qsize(),
+            "indexed": self.indexed,
+            "dropped": self.dropped,
+            "scanned_sessions": self.scanned_sessions,
+            "last_commit_ms": self.last_commit_ms
+        }
@@ -0,0 +1,75 @@
+import os
+from datetime import datetime
+from recorder import json_codec
+
+def meta_path(base_name):
+    """录制会话元数据文件路径，base_name为不含扩展名的输出文件路径"""
+    return f"{base_name}_meta.json"
+
+def write_meta(base_name, meta):
+    """写入会话元数据（先写临时文件再替换，避免读到写了一半的文件）"""
+    path = meta_path(base_name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(json_codec.dumps_bytes(meta))
+    os.replace(tmp_path, path)
+
+def read_meta(base_name):
+    """读取会话元数据，不存在或损坏时返回None"""
+    try:
+        with open(meta_path(base_name), 'rb') as f:
+            return json_codec.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def session_timeline(base_name):
+    """
+    会话的时间轴：{"t0": 媒体时间0对应的Unix时间戳, "gaps": [断线空档, ...], "end": 录制结束的Unix时间戳}
+    优先使用元数据，旧的录制没有元数据时按文件名中的开始时间估算t0；录制中或较早的录制end为None
+    """
+    meta = read_meta(base_name)
+    if meta and meta.get("t0"):
+        return {"t0": meta["t0"], "gaps": meta.get("gaps", []), "end": meta.get("end")}
+    session_id = os.path.basename(base_name)
+    parts = session_id.split("_")
+    try:
+        t0 = datetime.strptime(f"{parts[-2]}_{parts[-1]}", "%Y%m%d_%H%M%S").timestamp()
+    except (ValueError, IndexError):
+        return None
+    return {"t0": t0, "gaps": [], "end": None}
+
+def wall_time(timeline, offset):
+    """
+    媒体时间（秒）转换为Unix时间戳
+    每个空档记录了发生时的媒体时间at和持续时间seconds，之后的媒体时间都要加上空档时长
+    """
+    ts = timeline["t0"] + offset
+    for gap in timeline["gaps"]:
+        if gap["at"] <= offset:
+            ts += gap["seconds"]
+    return ts
+
+def media_offset(timeline, ts):
+    """Unix时间戳转换为媒体时间（秒），落在空档内的时刻对应空档开始的位置"""
+    shift = 0
+    for gap in timeline["gaps"]:
+        gap_start = timeline["t0"] + gap["at"] + shift
+        if ts < gap_start:
+            break
+        if ts < gap_start + gap["seconds"]:
+            return gap["at"]
+        shift += gap["seconds"]
+    return ts - timeline["t0"] - shift
+
+
+def in_gap(timeline, ts):
+    """Unix时间戳是否落在断线空档内（这段时间没有视频）"""
+    shift = 0
+    for gap in timeline["gaps"]:
+        gap_start = timeline["t0"] + gap["at"] + shift
+        if ts < gap_start:
+            return False
+        if ts < gap_start + gap["seconds"]:
+            return True
+        shift += gap["seconds"]
+    return False
@@ -0,0 +1,44 @@
+import asyncio
+from recorder.config import Config
+
+# 订阅者的队列满了（消费太慢）时收到这个标记，丢弃积压的事件，重新发送全量快照
+RESYNC = {"type": "resync"}
+
+class StatusBroadcaster:
+    """
+    把任务状态的变化推送给所有订阅者（SSE连接）
+    每个订阅者一个有上限的队列，发布时不等待，慢的连接不会拖住管理器
+    """
+    def __init__(self, queue_size=None):
+        self.queue_size = queue_size or Config.STATUS_EVENT_QUEUE_SIZE
+        self.subscribers = set()
+        self.published = 0
+        self.resyncs = 0
+
+    def subscribe(self):
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event):
+        if not self.subscribers:
+            return
+        self.published += 1
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+                self.resyncs += 1
+
+    def get_stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "resyncs": self.resyncs
+        }
@@ -0,0 +1,301 @@
+import asyncio
+import time
+from urllib.parse import urlsplit, parse_qs
+import httpx
+from recorder.config import Config
+
+class HostStats:
+    """单个CDN节点的测速统计（指数加权平均），在所有任务之间共享"""
+    def __init__(self):
+        self.ttfb = None  # 首字节时间（秒）
+        self.throughput = None  # 起始阶段的下载速度（字节/秒）
+        self.probes = 0
+        self.failures = 0  # 近期失败次数，成功一次减一
+        self.last_probe = None
+
+    def record(self, ttfb, throughput):
+        alpha = Config.CDN_STATS_ALPHA
+        self.ttfb = ttfb if self.ttfb is None else alpha * ttfb + (1 - alpha) * self.ttfb
+        if throughput is not None:
+            self.throughput = throughput if self.throughput is None else alpha * throughput + (1 - alpha) * self.throughput
+        self.probes += 1
+        self.failures = max(0, self.failures - 1)
+        self.last_probe = time.time()
+
+    def record_failure(self):
+        self.failures += 1
+        self.last_probe = time.time()
+
+    def score(self):
+        """预计取到测速数据量所需的时间（秒），越小越好；近期失败过的节点加罚时"""
+        if self.ttfb is None:
+            return float('inf') if self.failures else Config.CDN_PROBE_TIMEOUT
+        score = self.ttfb
+        if self.throughput:
+            score += Config.CDN_PROBE_BYTES / self.throughput
+        return score + self.failures * Config.CDN_FAILURE_PENALTY
+
+    def to_dict(self):
+        return {
+            "ttfb_ms": round(self.ttfb * 1000, 1) if self.ttfb is not None else None,
+            "throughput_kbps": round(self.throughput * 8 / 1000, 1) if self.throughput else None,
+            "probes": self.probes,
+            "failures": self.failures,
+            "score": round(self.score(), 3) if self.score() != float('inf') else None
+        }
+
+def url_host(url):
+    return urlsplit(url).netloc
+
+def url_expires_soon(url, margin=None):
+    """B站流地址带有expires参数（Unix时间戳），快到期时需要重新获取"""
+    margin = Config.CDN_EXPIRE_MARGIN if margin is None else margin
+    try:
+        expires = int(parse_qs(urlsplit(url).query).get('expires', [''])[0])
+    except ValueError:
+        return False
+    return expires - time.time() < margin
+
+class StreamResolver:
+    """
+    异步获取B站直播流地址
+    - 共用一个带连接池的httpx.AsyncClient（keep-alive、超时）
+    - 短号到真实房间号的映射、playinfo结果按TTL缓存
+    - 同一房间的并发请求只发一次，其他请求等待同一个结果
+    """
+    def __init__(self, api_base=None, room_ttl=None, play_info_ttl=None, timeout=None):
+        self.api_base = (api_base or Config.BILIBILI_API_BASE).rstrip('/')
+        self.room_ttl = Config.RESOLVER_ROOM_TTL if room_ttl is None else room_ttl
+        self.play_info_ttl = Config.RESOLVER_PLAY_INFO_TTL if play_info_ttl is None else play_info_ttl
+        self.timeout = timeout or Config.RESOLVER_TIMEOUT
+        self.client = None
+        self.room_cache = {}  # 短号 -> (真实房间号, 直播状态, 过期时间)
+        self.play_info_cache = {}  # 真实房间号 -> (流地址列表, 过期时间)
+        self.stream_codecs = {}  # 真实房间号 -> {流地址: 视频编码}
+        self.inflight = {}  # 请求键 -> 进行中的asyncio.Task
+        self.host_stats = {}  # CDN节点 -> HostStats
+        # 统计
+        self.requests = 0
+        self.cache_hits = 0
+        self.deduplicated = 0
+
+    def _get_client(self):
+        # 客户端绑定事件循环，第一次使用时在当前循环中创建
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                headers=Config.BILIBILI_API_HEADERS,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                follow_redirects=True
+            )
+        return self.client
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _get_json(self, path, params):
+        self.requests += 1
+        response = await self._get_client().get(f"{self.api_base}{path}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def _dedupe(self, key, factory):
+        """同一个key同时只执行一次factory()，其他调用者等待同一个结果"""
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.deduplicated += 1
+        # shield：某个调用者被取消时不影响其他等待同一结果的调用者
+        return await asyncio.shield(task)
+
+    async def get_room_info(self, room_id, refresh=False):
+        """返回 (真实房间号, 直播状态)，直播状态1为直播中；refresh为True时不使用缓存（需要最新的直播状态）"""
+        room_id = str(room_id)
+        cached = self.room_cache.get(room_id)
+        if cached and cached[2] > time.monotonic() and not refresh:
+            self.cache_hits += 1
+            return cached[0], cached[1]
+        return await self._dedupe(('room', room_id), lambda: self._fetch_room_info(room_id))
+
+    async def _fetch_room_info(self, room_id):
+        data = await self._get_json('/room/v1/Room/room_init', {'id': room_id})
+        if data.get('code') != 0:
+            raise ValueError(f"获取直播间信息失败: {data.get('message') or data.get('msg')}")
+        info = data.get('data', {})
+        real_room_id = str(info['room_id'])
+        live_status = info.get('live_status')
+        expires = time.monotonic() + self.room_ttl
+        self.room_cache[room_id] = (real_room_id, live_status, expires)
+        self.room_cache[real_room_id] = (real_room_id, live_status, expires)
+        return real_room_id, live_status
+
+    async def get_stream_urls(self, room_id):
+        """返回直播间可用的流地址列表，按优先顺序排列（HLS优先）"""
+        real_room_id, _ = await self.get_room_info(room_id)
+        cached = self.play_info_cache.get(real_room_id)
+        if cached and cached[1] > time.monotonic():
+            self.cache_hits += 1
+            return cached[0]
+        return await self._dedupe(('play', real_room_id), lambda: self._fetch_stream_urls(real_room_id))
+
+    async def _fetch_stream_urls(self, real_room_id):
+        data = await self._get_json('/xlive/web-room/v2/index/getRoomPlayInfo', {
+            'room_id': real_room_id,
+            'protocol': '0,1',
+            'format': '0,1,2',
+            'codec': '0,1',
+            'qn': 10000,
+            'platform': 'web',
+            'ptype': 8,
+            'dolby': 5,
+            'panorama': 1
+        })
+        urls = []
+        if data.get('code') == 0:
+            play_info = ((data.get('data') or {}).get('playurl_info') or {}).get('playurl') or {}
+            urls, codecs = parse_play_info_urls(play_info.get('stream', []))
+            self.stream_codecs[real_room_id] = codecs
+        if not urls:
+            # 回退到旧的API
+            data = await self._get_json('/room/v1/Room/playUrl', {'cid': real_room_id, 'qn': 10000, 'platform': 'web'})
+            if data.get('code') == 0:
+                urls = [item['url'] for item in (data.get('data') or {}).get('durl') or [] if item.get('url')]
+        if urls:
+            self.play_info_cache[real_room_id] = (urls, time.monotonic() + self.play_info_ttl)
+        return urls
+
+    async def get_ranked_urls(self, room_id, refresh=False):
+        """返回按测速结果排序的流地址列表，第一个为首选，其余作为断线时的备用节点"""
+        if refresh:
+            self.invalidate(room_id)
+        urls = await self.get_stream_urls(room_id)
+        cached = self.room_cache.get(str(room_id))
+        real_room_id = cached[0] if cached else str(room_id)
+        return await self.rank(urls, self.stream_codecs.get(real_room_id))
+
+    async def rank(self, urls, codecs=None):
+        """
+        并发测速所有候选地址，按节点的历史统计排序
+        保持原有的格式优先级（HLS优先），同一格式内按视频编码（codecs为 {流地址: 编码}，AVC优先）、
+        再按节点速度排序
+        """
+        probe_urls = urls[:Config.CDN_PROBE_MAX]
+        # 同一节点的不同格式只测一次
+        by_host = {}
+        for url in probe_urls:
+            by_host.setdefault(url_host(url), url)
+        await asyncio.gather(*[self.probe(url) for url in by_host.values()])
+        groups = {}
+        for index, url in enumerate(probe_urls):
+            groups.setdefault(_format_of(url), []).append((index, url))
+        codecs = codecs or {}
+        preference = Config.STREAM_CODEC_PREFERENCE
+
+        def codec_rank(url):
+            codec = codecs.get(url)
+            return preference.index(codec) if codec in preference else len(preference)
+
+        ranked = []
+        for group in groups.values():
+            group.sort(key=lambda item: (codec_rank(item[1]), self._host(url_host(item[1])).score(), item[0]))
+            ranked += [url for _, url in group]
+        return ranked + urls[Config.CDN_PROBE_MAX:]
+
+    async def probe(self, url):
+        """测量首字节时间和起始阶段的下载速度，读够CDN_PROBE_BYTES或超时后断开"""
+        stats = self._host(url_host(url))
+        start = time.monotonic()
+        try:
+            ttfb, throughput = await asyncio.wait_for(self._probe(url, start), timeout=Config.CDN_PROBE_TIMEOUT)
+        except Exception as e:
+            stats.record_failure()
+            print(f"CDN节点测速失败 {url_host(url)}: {type(e).__name__} {str(e).splitlines()[0] if str(e) else ''}")
+            return None
+        stats.record(ttfb, throughput)
+        return ttfb, throughput
+
+    async def _probe(self, url, start):
+        ttfb = None
+        first_at = None
+        received = 0
+        async with self._get_client().stream('GET', url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_raw():
+                now = time.monotonic()
+                if ttfb is None:
+                    ttfb = now - start
+                    first_at = now
+                received += len(chunk)
+                if received >= Config.CDN_PROBE_BYTES:
+                    break
+        if ttfb is None:
+            ttfb = time.monotonic() - start
+        # 播放列表等很小的响应测不出速度，只比较首字节时间
+        elapsed = time.monotonic() - first_at if first_at else 0
+        throughput = received / elapsed if received >= Config.CDN_PROBE_BYTES // 4 and elapsed > 0 else None
+        return ttfb, throughput
+
+    def report_failure(self, url):
+        """录制过程中某个节点断流或卡住，记入该节点的统计"""
+        self._host(url_host(url)).record_failure()
+
+    def _host(self, host):
+        stats = self.host_stats.get(host)
+        if stats is None:
+            stats = self.host_stats[host] = HostStats()
+        return stats
+
+    async def resolve(self, room_id):
+        """返回测速最快的流地址，失败返回None"""
+        try:
+            urls = await self.get_ranked_urls(room_id)
+        except Exception as e:
+            print(f"获取直播间 {room_id} 流地址失败: {e}")
+            return None
+        return urls[0] if urls else None
+
+    def invalidate(self, room_id):
+        """流地址失效（如过期、403）时清除缓存，下次重新获取"""
+        cached = self.room_cache.get(str(room_id))
+        real_room_id = cached[0] if cached else str(room_id)
+        self.play_info_cache.pop(real_room_id, None)
+
+    def get_stats(self):
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "deduplicated": self.deduplicated,
+            "cached_rooms": len(self.room_cache),
+            "cached_play_info": len(self.play_info_cache),
+            "hosts": {host: stats.to_dict() for host, stats in self.host_stats.items()}
+        }
+
+def _format_of(url):
+    return 'hls' if '.m3u8' in urlsplit(url).path else 'stream'
+
+def parse_play_info_urls(streams):
+    """
+    从getRoomPlayInfo的stream列表中取出所有流地址，HLS（m3u8）优先，其次按接口返回顺序
+    返回 (流地址列表, {流地址: 视频编码})
+    """
+    hls, others = [], []
+    codecs = {}
+    for stream in streams:
+        for fmt in stream.get('format', []):
+            for codec in fmt.get('codec', []):
+                base_url = codec.get('base_url', '')
+                if not base_url:
+                    continue
+                for url_info in codec.get('url_info', []):
+                    url = f"{url_info.get('host', '')}{base_url}{url_info.get('extra', '')}"
+                    codecs[url] = codec.get('codec_name')
+                    if stream.get('protocol_name') == 'http_hls' and fmt.get('format_name') == 'm3u8':
+                        hls.append(url)
+                    else:
+                        others.append(url)
+    return hls + others, codecs
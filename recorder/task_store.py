@@ -0,0 +1,63 @@
+import sqlite3
+from recorder.config import Config
+from recorder import json_codec
+
+ACTIVE_STATUSES = ("pending", "recording", "converting")
+
+class TaskStore:
+    """
+    录制任务状态保存到SQLite
+    服务重启后据此恢复未完成的任务；结束的任务不再常驻内存，状态接口从这里分页查询
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path or Config.TASK_DB_PATH
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        # WAL：写入频繁（每个任务定期保存一次），读写互不阻塞
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, room_id TEXT, status TEXT, start_time TEXT, data TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, start_time)")
+        # 开播自动录制的直播间列表
+        self.db.execute("CREATE TABLE IF NOT EXISTS watchlist (room_id TEXT PRIMARY KEY, data TEXT)")
+        self.db.commit()
+
+    def save(self, record):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, room_id, status, start_time, data) VALUES (?, ?, ?, ?, ?)",
+                (record["task_id"], str(record["room_id"]), record["status"], record.get("start_time") or "", json_codec.dumps(record))
+            )
+
+    def get(self, task_id):
+        row = self.db.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json_codec.loads(row[0]) if row else None
+
+    def active(self):
+        """上次运行时还没有结束的任务"""
+        placeholders = ", ".join("?" * len(ACTIVE_STATUSES))
+        rows = self.db.execute(
+            f"SELECT data FROM tasks WHERE status IN ({placeholders}) ORDER BY start_time", ACTIVE_STATUSES
+        ).fetchall()
+        return [json_codec.loads(row[0]) for row in rows]
+
+    def history(self, limit, offset=0):
+        """已结束的任务，按开始时间倒序分页，返回 (记录列表, 总数)"""
+        total = self.db.execute("SELECT COUNT(*) FROM tasks WHERE status = 'stopped'").fetchone()[0]
+        rows = self.db.execute(
+            "SELECT data FROM tasks WHERE status = 'stopped' ORDER BY start_time DESC LIMIT ? OFFSET ?", (limit, offset)
+        ).fetchall()
+        return [json_codec.loads(row[0]) for row in rows], total
+
+    def save_watch(self, options):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO watchlist (room_id, data) VALUES (?, ?)",
+                            (str(options["room_id"]), json_codec.dumps(options)))
+
+    def remove_watch(self, room_id):
+        with self.db:
+            self.db.execute("DELETE FROM watchlist WHERE room_id = ?", (str(room_id),))
+
+    def watchlist(self):
+        return [json_codec.loads(row[0]) for row in self.db.execute("SELECT data FROM watchlist ORDER BY room_id")]
+
+    def close(self):
+        self.db.close()
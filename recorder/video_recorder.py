@@ -1,105 +1,327 @@
-import subprocess
-import os
-import signal
-import time
-import shutil
-
-class VideoRecorder:
-    def __init__(self, stream_url, output_file, ffmpeg_path=None):
-        self.stream_url = stream_url
-        self.output_file = output_file
-        # 如果没有指定ffmpeg路径，则尝试在系统PATH中查找
-        self.ffmpeg_path = ffmpeg_path or self._find_ffmpeg()
-        self.process = None
-
-    def _find_ffmpeg(self):
-        """查找系统中的ffmpeg可执行文件"""
-        # 首先检查系统PATH中是否有ffmpeg
-        ffmpeg_executable = shutil.which("ffmpeg")
-        if ffmpeg_executable:
-            return ffmpeg_executable
-        # 如果没有找到，返回默认值
-        return "ffmpeg"
-
-    def start(self):
-        # 确保输出目录存在
-        output_dir = os.path.dirname(self.output_file)
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # 构建ffmpeg命令 - 使用兼容FLV的编码器
-        cmd = [
-            self.ffmpeg_path,
-            "-user_agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "-headers", "Referer: https://live.bilibili.com/35",
-            "-i", self.stream_url,
-            "-c", "copy",       # 直接复制流，不重新编码（最快且兼容性最好）
-            "-f", "flv",        # 输出格式为FLV
-            "-t", str(self._get_duration_from_stream_url()),  # 持续时间，避免无限录制
-            "-y",               # 覆盖输出文件
-            self.output_file
-        ]
-        
-        print(f"开始录制视频: {self.output_file}")
-        print(f"FFmpeg路径: {self.ffmpeg_path}")
-        print(f"命令: {' '.join(cmd)}")
-        
-        # 检查ffmpeg是否可用
-        try:
-            subprocess.run([self.ffmpeg_path, "-version"], 
-                          stdout=subprocess.DEVNULL, 
-                          stderr=subprocess.DEVNULL, 
-                          check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print(f"错误: 找不到FFmpeg或FFmpeg路径不正确: {self.ffmpeg_path}")
-            return
-        
-        # 启动ffmpeg进程
-        try:
-            self.process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-                # 在Windows上不使用shell=True，避免路径问题
-            )
-        except Exception as e:
-            print(f"启动FFmpeg进程失败: {e}")
-            return
-        
-        print(f"FFmpeg进程已启动，PID: {self.process.pid}")
-    
-    def _get_duration_from_stream_url(self):
-        # 从流URL中获取录制时长，这里简单返回一个默认值
-        # 在实际应用中，应该从任务配置中获取时长
-        return 35  # 返回35秒，比预期稍长一点以确保完整录制
-
-    def stop(self):
-        if self.process and self.process.poll() is None:
-            # 终止ffmpeg进程
-            try:
-                self.process.terminate()
-                stdout, stderr = self.process.communicate(timeout=10)
-                if stdout:
-                    print(f"FFmpeg stdout: {stdout.decode('utf-8', errors='ignore')}")
-                if stderr:
-                    print(f"FFmpeg stderr: {stderr.decode('utf-8', errors='ignore')}")
-            except subprocess.TimeoutExpired:
-                # 如果进程没有正常退出，强制杀死
-                self.process.kill()
-                stdout, stderr = self.process.communicate()
-                if stdout:
-                    print(f"FFmpeg stdout: {stdout.decode('utf-8', errors='ignore')}")
-                if stderr:
-                    print(f"FFmpeg stderr: {stderr.decode('utf-8', errors='ignore')}")
-            
-            print(f"停止录制视频: {self.output_file}")
-            
-            # 检查文件是否创建成功
-            if os.path.exists(self.output_file):
-                file_size = os.path.getsize(self.output_file)
-                print(f"录制文件大小: {file_size} 字节")
-            else:
-                print(f"警告: 录制文件未创建 {self.output_file}")
-        elif self.process:
-            print(f"FFmpeg进程已经结束，返回码: {self.process.returncode}")
-        else:
-            print("FFmpeg进程未启动")
\ No newline at end of file
+import asyncio
+import os
+import signal
+import time
+import shutil
+from recorder.config import Config
+from recorder.ffmpeg_tools import read_progress, drain_stream, parse_out_time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+class VideoRecorder:
+    def __init__(self, stream_url, output_file, ffmpeg_path=None, duration_seconds=None, segment_seconds=None, live_dir=None,
+                 segment_start=0):
+        self.stream_url = stream_url
+        self.output_file = output_file
+        # 如果没有指定ffmpeg路径，则尝试在系统PATH中查找
+        self.ffmpeg_path = ffmpeg_path or self._find_ffmpeg()
+        self.process = None
+        self.duration_seconds = duration_seconds
+        
+        # 分段录制：使用ffmpeg的segment封装器，每segment_seconds秒切换一个新文件
+        # 分段文件名为 {原文件名}_000.flv、{原文件名}_001.flv ...
+        # 每个分段写完后ffmpeg会在csv列表文件中追加一行，据此得知哪些分段已经关闭
+        self.segment_seconds = segment_seconds
+        base_name = os.path.splitext(output_file)[0]
+        self.segment_pattern = f"{base_name}_%03d.flv"
+        self.segment_list_file = f"{base_name}_segments.csv"
+        self.segment_start = segment_start  # 断线重连后新进程的分段序号从这里继续
+        self.closed_segments = []
+        self._segment_list_offset = 0
+        
+        # 实时预览：同一个ffmpeg进程额外输出一路HLS（只保留最近几个切片），不需要再从B站拉一次流
+        self.live_dir = live_dir
+        self.live_playlist = os.path.join(live_dir, "index.m3u8") if live_dir else None
+        
+        # 通过 -progress pipe:1 实时读取的录制状态
+        self.stats = {
+            "bitrate_kbps": None,  # 输出码率
+            "fps": None,
+            "speed": None,  # 处理速度，直播源正常时约为1.0
+            "frames": 0,
+            "drop_frames": 0,
+            "dup_frames": 0,
+            "total_size": 0,  # 已写入字节数
+            "out_time": 0,  # 已录制的媒体时长（秒）
+            "updated_at": None
+        }
+        self.stderr_tail = []
+        self._reader_task = None
+        self.started_at = None
+
+    def _find_ffmpeg(self):
+        """查找系统中的ffmpeg可执行文件"""
+        # 首先检查系统PATH中是否有ffmpeg
+        ffmpeg_executable = shutil.which("ffmpeg")
+        if ffmpeg_executable:
+            return ffmpeg_executable
+        # 如果没有找到，返回默认值
+        return "ffmpeg"
+
+    async def start(self):
+        # 确保输出目录存在
+        output_dir = os.path.dirname(self.output_file)
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # 构建ffmpeg命令 - 使用兼容FLV的编码器
+        cmd = [
+            self.ffmpeg_path,
+            "-user_agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+            "-headers", "Referer: https://live.bilibili.com/35",
+        ]
+        if self.stream_url.startswith(("http://", "https://")):
+            # 读取超时（微秒），CDN不再发送数据时ffmpeg会退出，由上层重新连接
+            cmd += ["-rw_timeout", str(int(Config.RECORD_STALL_TIMEOUT * 1000000))]
+        cmd += [
+            "-i", self.stream_url,
+            "-c", "copy",       # 直接复制流，不重新编码（最快且兼容性最好）
+            "-progress", "pipe:1",  # 进度写到stdout，由后台协程解析
+            "-nostats",
+        ]
+        if self.duration_seconds:
+            cmd += ["-t", str(self.duration_seconds)]  # 持续时间，避免无限录制
+        if self.segment_seconds:
+            # 断线重连时沿用同一个列表文件，先删掉上一个进程写的，避免在ffmpeg清空它之前读到旧的分段
+            try:
+                os.remove(self.segment_list_file)
+            except OSError:
+                pass
+            cmd += [
+                "-f", "segment",
+                "-segment_time", str(self.segment_seconds),
+                "-segment_start_number", str(self.segment_start),
+                "-segment_format", "flv",
+                "-reset_timestamps", "1",  # 每个分段的时间戳从0开始，可以单独播放
+                "-segment_list", self.segment_list_file,
+                "-segment_list_type", "csv",
+                "-y",
+                self.segment_pattern
+            ]
+        else:
+            cmd += [
+                "-f", "flv",        # 输出格式为FLV
+                "-y",               # 覆盖输出文件
+                self.output_file
+            ]
+        if self.live_dir:
+            os.makedirs(self.live_dir, exist_ok=True)
+            cmd += self._live_output_args()
+        
+        print(f"开始录制视频: {self.output_file}")
+        print(f"FFmpeg路径: {self.ffmpeg_path}")
+        print(f"命令: {' '.join(cmd)}")
+        
+        # 启动ffmpeg进程，stdin用于发送q让ffmpeg正常结束并写完文件尾
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            print(f"错误: 找不到FFmpeg或FFmpeg路径不正确: {self.ffmpeg_path}")
+            return
+        except Exception as e:
+            print(f"启动FFmpeg进程失败: {e}")
+            return
+        
+        print(f"FFmpeg进程已启动，PID: {self.process.pid}")
+        self.started_at = time.time()
+        # 持续读取stdout和stderr，否则长时间录制时管道写满会让ffmpeg卡住
+        self._reader_task = asyncio.create_task(self._read_output())
+    
+    async def _read_output(self):
+        try:
+            _, self.stderr_tail = await asyncio.gather(
+                read_progress(self.process.stdout, self._handle_progress),
+                drain_stream(self.process.stderr)
+            )
+        except Exception as e:
+            print(f"读取FFmpeg输出出错: {e}")
+    
+    def _handle_progress(self, block):
+        """解析一组进度数据，更新录制状态"""
+        stats = self.stats
+        bitrate = block.get('bitrate', '').replace('kbits/s', '').strip()
+        speed = block.get('speed', '').rstrip('x').strip()
+        stats["bitrate_kbps"] = _to_number(bitrate, float, stats["bitrate_kbps"])
+        stats["fps"] = _to_number(block.get('fps'), float, stats["fps"])
+        stats["speed"] = _to_number(speed, float, stats["speed"])
+        for key, name in (("frames", "frame"), ("drop_frames", "drop_frames"),
+                          ("dup_frames", "dup_frames"), ("total_size", "total_size")):
+            stats[key] = _to_number(block.get(name), int, stats[key])
+        out_time = parse_out_time(block)
+        if out_time is not None:
+            stats["out_time"] = round(out_time, 2)
+        stats["updated_at"] = time.time()
+    
+    @property
+    def is_running(self):
+        return self.process is not None and self.process.returncode is None
+    
+    @property
+    def returncode(self):
+        return self.process.returncode if self.process else None
+    
+    def _live_output_args(self):
+        """第二路输出：HLS实时预览，输出选项只作用于它自己，所以需要重复-c和-t"""
+        fmp4 = Config.LIVE_SEGMENT_TYPE == "fmp4"
+        args = ["-c", "copy"]
+        if self.duration_seconds:
+            args += ["-t", str(self.duration_seconds)]
+        args += [
+            "-f", "hls",
+            "-hls_time", str(Config.LIVE_HLS_TIME),
+            "-hls_list_size", str(Config.LIVE_HLS_LIST_SIZE),
+            # 删除滑出窗口的切片；先写临时文件再改名，避免播放器读到写了一半的切片
+            "-hls_flags", "delete_segments+independent_segments+temp_file",
+            "-hls_segment_type", "fmp4" if fmp4 else "mpegts",
+            "-hls_segment_filename", os.path.join(self.live_dir, "seg_%05d.m4s" if fmp4 else "seg_%05d.ts"),
+            "-y",
+            self.live_playlist
+        ]
+        return args
+
+    def poll_closed_segments(self):
+        """读取分段列表文件，返回自上次调用以来新关闭的分段文件"""
+        if not self.segment_seconds or not os.path.exists(self.segment_list_file):
+            return []
+        new_segments = []
+        try:
+            with open(self.segment_list_file, 'rb') as f:
+                f.seek(self._segment_list_offset)
+                data = f.read()
+        except OSError as e:
+            print(f"读取分段列表出错: {e}")
+            return []
+        # 只处理完整的行，最后一行可能还没写完
+        end = data.rfind(b'\n') + 1
+        self._segment_list_offset += end
+        for line in data[:end].decode('utf-8', errors='ignore').splitlines():
+            filename = line.split(',', 1)[0].strip().strip('"')
+            if not filename:
+                continue
+            if not os.path.isabs(filename):
+                filename = os.path.join(os.path.dirname(self.output_file), os.path.basename(filename))
+            self.closed_segments.append(filename)
+            new_segments.append(filename)
+        return new_segments
+
+    @property
+    def current_segment(self):
+        """当前正在写入的分段文件"""
+        return self.segment_pattern % (self.segment_start + len(self.closed_segments))
+
+    async def stop(self):
+        if self.is_running:
+            # 先发送q让ffmpeg正常退出，超时再终止，最后强制杀死
+            try:
+                self.process.stdin.write(b'q')
+                await self.process.stdin.drain()
+                self.process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                self.process.terminate()
+                try:
+                    await asyncio.wait_for(self.process.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    # 如果进程没有正常退出，强制杀死
+                    self.process.kill()
+                    await self.process.wait()
+            if self._reader_task:
+                await self._reader_task
+            if self.process.returncode != 0 and self.stderr_tail:
+                print(f"FFmpeg stderr: {chr(10).join(self.stderr_tail)}")
+            
+            print(f"停止录制视频: {self.output_file}")
+            
+            # 检查文件是否创建成功
+            if self.segment_seconds:
+                print(f"分段录制已结束，分段列表: {self.segment_list_file}")
+            elif os.path.exists(self.output_file):
+                file_size = os.path.getsize(self.output_file)
+                print(f"录制文件大小: {file_size} 字节")
+            else:
+                print(f"警告: 录制文件未创建 {self.output_file}")
+        elif self.process:
+            print(f"FFmpeg进程已经结束，返回码: {self.process.returncode}")
+        else:
+            print("FFmpeg进程未启动")
+
+
+def _to_number(value, cast, default):
+    """把进度中的数值转换为数字，N/A等无效值时保留原值"""
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _process_cmdline(pid):
+    """进程的命令行，进程不存在或无法读取时返回None；安装了psutil时使用psutil（Windows），否则读/proc"""
+    if psutil is not None:
+        try:
+            return "\0".join(psutil.Process(pid).cmdline()).encode()
+        except (psutil.Error, OSError):
+            return None
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _process_alive(pid):
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            # 第三个字段是进程状态，Z为已退出未回收
+            return f.read().rsplit(b")", 1)[1].split()[0] != b"Z"
+    except (OSError, IndexError):
+        return False
+
+
+async def stop_orphan_ffmpeg(pid, marker):
+    """
+    服务重启后结束上次残留的ffmpeg进程：先发SIGINT（ffmpeg会像收到q一样写完文件尾），超时再终止
+    只处理命令行中包含marker（输出文件名）的进程，避免误杀复用了同一PID的其它进程
+    """
+    if not pid:
+        return False
+    if psutil is None and not os.path.isdir("/proc"):
+        print(f"警告: 没有安装psutil，无法检查上次残留的FFmpeg进程（PID: {pid}），如果仍在运行请手动结束")
+        return False
+    cmdline = _process_cmdline(pid)
+    if cmdline is None or marker.encode() not in cmdline:
+        return False
+    print(f"结束上次残留的FFmpeg进程，PID: {pid}")
+    if os.name == "nt":
+        # Windows上不能向其它控制台的进程发送SIGINT，os.kill只能直接终止（TerminateProcess）
+        steps = ((signal.SIGTERM, 5),)
+    else:
+        steps = ((signal.SIGINT, 10), (signal.SIGTERM, 5), (signal.SIGKILL, 5))
+    for sig, timeout in steps:
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            return True
+        except OSError as e:
+            print(f"结束FFmpeg进程 {pid} 出错: {e}")
+            return False
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+            if not _process_alive(pid):
+                return True
+    return True
@@ -0,0 +1,240 @@
+"""
+StreamResolver 对本地模拟的B站接口和CDN节点（httpx.MockTransport）的测试：
+TTL缓存、并发请求合并、接口回退和候选地址的排序
+"""
+import asyncio
+from urllib.parse import urlsplit
+import httpx
+from recorder.stream_resolver import StreamResolver
+
+API_BASE = "http://api.test"
+REAL_ROOM_ID = 5000
+
+
+def codec_entry(codec_name, base_url, hosts):
+    return {
+        "codec_name": codec_name,
+        "base_url": base_url,
+        "url_info": [{"host": host, "extra": "?expires=9999999999"} for host in hosts]
+    }
+
+
+def play_info(streams):
+    return {"code": 0, "data": {"playurl_info": {"playurl": {"stream": streams}}}}
+
+
+def flv_stream(*codecs):
+    return {
+        "protocol_name": "http_stream",
+        "format": [{"format_name": "flv", "codec": list(codecs)}]
+    }
+
+
+def hls_stream(*codecs):
+    return {
+        "protocol_name": "http_hls",
+        "format": [{"format_name": "m3u8", "codec": list(codecs)}]
+    }
+
+
+class StubBilibili:
+    """
+    模拟的接口和CDN：记录每个路径的请求次数，
+    cdn_delays为各CDN节点的响应延迟（秒），不在其中的节点返回404
+    """
+    def __init__(self, streams=None, play_info_code=0, cdn_delays=None, api_delay=0):
+        self.streams = streams or []
+        self.play_info_code = play_info_code
+        self.cdn_delays = cdn_delays or {}
+        self.api_delay = api_delay
+        self.calls = {}
+
+    async def handler(self, request):
+        url = urlsplit(str(request.url))
+        host = f"{url.scheme}://{url.netloc}"
+        self.calls[url.path] = self.calls.get(url.path, 0) + 1
+        if host == API_BASE:
+            await asyncio.sleep(self.api_delay)
+            if url.path == '/room/v1/Room/room_init':
+                return httpx.Response(200, json={"code": 0, "data": {"room_id": REAL_ROOM_ID, "live_status": 1}})
+            if url.path == '/xlive/web-room/v2/index/getRoomPlayInfo':
+                if self.play_info_code != 0:
+                    return httpx.Response(200, json={"code": self.play_info_code, "message": "error"})
+                return httpx.Response(200, json=play_info(self.streams))
+            if url.path == '/room/v1/Room/playUrl':
+                return httpx.Response(200, json={"code": 0, "data": {"durl": [{"url": "http://legacy.test/live.flv"}]}})
+            return httpx.Response(404)
+        if host not in self.cdn_delays:
+            return httpx.Response(404)
+        await asyncio.sleep(self.cdn_delays[host])
+        return httpx.Response(200, content=self._flv_body())
+
+    async def _flv_body(self):
+        # 按块流式返回，和真实的直播流一样由测速读取原始数据
+        for _ in range(4):
+            yield b'\0' * 1024
+
+
+def make_resolver(stub, **kwargs):
+    resolver = StreamResolver(api_base=API_BASE, **kwargs)
+    resolver.client = httpx.AsyncClient(transport=httpx.MockTransport(stub.handler))
+    return resolver
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_room_info_and_play_info_are_cached_until_ttl():
+    stub = StubBilibili(streams=[flv_stream(codec_entry('avc', '/live/1.flv', ['http://a.test']))])
+
+    async def scenario():
+        resolver = make_resolver(stub, play_info_ttl=0.2)
+        first = await resolver.get_stream_urls('1')
+        second = await resolver.get_stream_urls('1')
+        assert first == second == ['http://a.test/live/1.flv?expires=9999999999']
+        assert stub.calls['/room/v1/Room/room_init'] == 1
+        assert stub.calls['/xlive/web-room/v2/index/getRoomPlayInfo'] == 1
+        # 真实房间号也能直接命中缓存
+        assert await resolver.get_room_info(str(REAL_ROOM_ID)) == (str(REAL_ROOM_ID), 1)
+        assert stub.calls['/room/v1/Room/room_init'] == 1
+
+        await asyncio.sleep(0.25)
+        await resolver.get_stream_urls('1')
+        assert stub.calls['/xlive/web-room/v2/index/getRoomPlayInfo'] == 2
+        # 房间号映射的TTL更长，没有重新请求
+        assert stub.calls['/room/v1/Room/room_init'] == 1
+        assert resolver.get_stats()["cache_hits"] >= 3
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_refresh_bypasses_the_cache():
+    stub = StubBilibili(streams=[flv_stream(codec_entry('avc', '/live/1.flv', ['http://a.test']))],
+                        cdn_delays={'http://a.test': 0})
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        await resolver.get_room_info('1')
+        await resolver.get_room_info('1', refresh=True)
+        assert stub.calls['/room/v1/Room/room_init'] == 2
+        await resolver.get_ranked_urls('1')
+        await resolver.get_ranked_urls('1', refresh=True)
+        assert stub.calls['/xlive/web-room/v2/index/getRoomPlayInfo'] == 2
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_concurrent_requests_are_deduplicated():
+    stub = StubBilibili(streams=[flv_stream(codec_entry('avc', '/live/1.flv', ['http://a.test']))], api_delay=0.05)
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        results = await asyncio.gather(*[resolver.get_stream_urls('1') for _ in range(10)])
+        assert all(result == results[0] for result in results)
+        assert stub.calls['/room/v1/Room/room_init'] == 1
+        assert stub.calls['/xlive/web-room/v2/index/getRoomPlayInfo'] == 1
+        assert resolver.get_stats()["deduplicated"] >= 9
+        assert not resolver.inflight
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request():
+    stub = StubBilibili(streams=[flv_stream(codec_entry('avc', '/live/1.flv', ['http://a.test']))], api_delay=0.05)
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        cancelled = asyncio.ensure_future(resolver.get_room_info('1'))
+        waiting = asyncio.ensure_future(resolver.get_room_info('1'))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        assert await waiting == (str(REAL_ROOM_ID), 1)
+        assert stub.calls['/room/v1/Room/room_init'] == 1
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_falls_back_to_legacy_play_url_api():
+    stub = StubBilibili(play_info_code=-400)
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        assert await resolver.get_stream_urls('1') == ['http://legacy.test/live.flv']
+        assert stub.calls['/room/v1/Room/playUrl'] == 1
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_candidates_ranked_by_format_then_host_speed():
+    hosts = ['http://slow.test', 'http://dead.test', 'http://fast.test']
+    stub = StubBilibili(
+        streams=[
+            flv_stream(codec_entry('avc', '/live/1.flv', hosts)),
+            hls_stream(codec_entry('avc', '/live/1.m3u8', hosts)),
+        ],
+        cdn_delays={'http://slow.test': 0.3, 'http://fast.test': 0.01}
+    )
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        ranked = await resolver.get_ranked_urls('1')
+        # HLS优先；同一格式内按测速结果，失败的节点排在最后
+        assert [urlsplit(url).netloc for url in ranked] == [
+            'fast.test', 'slow.test', 'dead.test',
+            'fast.test', 'slow.test', 'dead.test'
+        ]
+        assert all('.m3u8' in url for url in ranked[:3])
+        stats = resolver.get_stats()["hosts"]
+        assert stats['dead.test']["failures"] == 1
+        assert stats['fast.test']["score"] < stats['slow.test']["score"]
+        # 每个节点只测一次（用该节点的第一个地址）
+        assert stub.calls['/live/1.m3u8'] == 3
+        assert '/live/1.flv' not in stub.calls
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_avc_ranked_before_hevc_on_faster_host():
+    stub = StubBilibili(
+        streams=[flv_stream(
+            codec_entry('hevc', '/live/1_hevc.flv', ['http://fast.test']),
+            codec_entry('avc', '/live/1.flv', ['http://slow.test']),
+        )],
+        cdn_delays={'http://slow.test': 0.2, 'http://fast.test': 0.01}
+    )
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        ranked = await resolver.get_ranked_urls('1')
+        assert [urlsplit(url).path for url in ranked] == ['/live/1.flv', '/live/1_hevc.flv']
+        await resolver.aclose()
+
+    run(scenario())
+
+
+def test_reported_failure_demotes_host():
+    stub = StubBilibili(
+        streams=[flv_stream(codec_entry('avc', '/live/1.flv', ['http://a.test', 'http://b.test']))],
+        cdn_delays={'http://a.test': 0.01, 'http://b.test': 0.05}
+    )
+
+    async def scenario():
+        resolver = make_resolver(stub)
+        ranked = await resolver.get_ranked_urls('1')
+        assert urlsplit(ranked[0]).netloc == 'a.test'
+        # 录制中a节点断流，重新测速也失败，排到b之后
+        resolver.report_failure(ranked[0])
+        del stub.cdn_delays['http://a.test']
+        ranked = await resolver.get_ranked_urls('1', refresh=True)
+        assert [urlsplit(url).netloc for url in ranked] == ['b.test', 'a.test']
+        assert resolver.get_stats()["hosts"]['a.test']["failures"] == 2
+        await resolver.aclose()
+
+    run(scenario())